@@ -33,11 +33,29 @@ import ida_segment
 import ida_nalt
 import ida_moves
 import ida_name
+import ida_fixup
+import ida_auto
 import idautils
 
+import os
 import sys
+import mmap
 import re
+import struct
+import bisect
+import time
+import json
+import tempfile
 import logging
+import contextlib
+import collections
+import uuid
+
+try:
+    # optional, only used to prefilter AFX_MSGMAP candidates
+    import numpy as np
+except ImportError:
+    np = None
 
 debug = False
 
@@ -1633,6 +1651,143 @@ AfxSig = [
     ("AfxSig_INPUTDEVICECHANGE", "void (AFX_MSG_CALL CWnd::*pfn_INPUTDEVICECHANGE)(unsigned short);"),
 ]
 
+# Well-known COM, OLE and ActiveX interface IDs, see IIDIndex
+KNOWN_IIDS = [
+    ("00000000-0000-0000-C000-000000000046", "IID_IUnknown"),
+    ("00000001-0000-0000-C000-000000000046", "IID_IClassFactory"),
+    ("00000002-0000-0000-C000-000000000046", "IID_IMalloc"),
+    ("00000003-0000-0000-C000-000000000046", "IID_IMarshal"),
+    ("0000000A-0000-0000-C000-000000000046", "IID_ILockBytes"),
+    ("0000000B-0000-0000-C000-000000000046", "IID_IStorage"),
+    ("0000000C-0000-0000-C000-000000000046", "IID_IStream"),
+    ("0000000D-0000-0000-C000-000000000046", "IID_IEnumSTATSTG"),
+    ("0000000E-0000-0000-C000-000000000046", "IID_IBindCtx"),
+    ("0000000F-0000-0000-C000-000000000046", "IID_IMoniker"),
+    ("00000010-0000-0000-C000-000000000046", "IID_IRunningObjectTable"),
+    ("00000012-0000-0000-C000-000000000046", "IID_IRootStorage"),
+    ("00000016-0000-0000-C000-000000000046", "IID_IMessageFilter"),
+    ("00000018-0000-0000-C000-000000000046", "IID_IStdMarshalInfo"),
+    ("00000019-0000-0000-C000-000000000046", "IID_IExternalConnection"),
+    ("00000020-0000-0000-C000-000000000046", "IID_IMultiQI"),
+    ("0000002F-0000-0000-C000-000000000046", "IID_IRecordInfo"),
+    ("00000100-0000-0000-C000-000000000046", "IID_IEnumUnknown"),
+    ("00000101-0000-0000-C000-000000000046", "IID_IEnumString"),
+    ("00000102-0000-0000-C000-000000000046", "IID_IEnumMoniker"),
+    ("00000103-0000-0000-C000-000000000046", "IID_IEnumFORMATETC"),
+    ("00000104-0000-0000-C000-000000000046", "IID_IEnumOLEVERB"),
+    ("00000105-0000-0000-C000-000000000046", "IID_IEnumSTATDATA"),
+    ("00000109-0000-0000-C000-000000000046", "IID_IPersistStream"),
+    ("0000010A-0000-0000-C000-000000000046", "IID_IPersistStorage"),
+    ("0000010B-0000-0000-C000-000000000046", "IID_IPersistFile"),
+    ("0000010C-0000-0000-C000-000000000046", "IID_IPersist"),
+    ("0000010D-0000-0000-C000-000000000046", "IID_IViewObject"),
+    ("0000010E-0000-0000-C000-000000000046", "IID_IDataObject"),
+    ("0000010F-0000-0000-C000-000000000046", "IID_IAdviseSink"),
+    ("00000110-0000-0000-C000-000000000046", "IID_IDataAdviseHolder"),
+    ("00000111-0000-0000-C000-000000000046", "IID_IOleAdviseHolder"),
+    ("00000112-0000-0000-C000-000000000046", "IID_IOleObject"),
+    ("00000113-0000-0000-C000-000000000046", "IID_IOleInPlaceObject"),
+    ("00000114-0000-0000-C000-000000000046", "IID_IOleWindow"),
+    ("00000115-0000-0000-C000-000000000046", "IID_IOleInPlaceUIWindow"),
+    ("00000116-0000-0000-C000-000000000046", "IID_IOleInPlaceFrame"),
+    ("00000117-0000-0000-C000-000000000046", "IID_IOleInPlaceActiveObject"),
+    ("00000118-0000-0000-C000-000000000046", "IID_IOleClientSite"),
+    ("00000119-0000-0000-C000-000000000046", "IID_IOleInPlaceSite"),
+    ("0000011A-0000-0000-C000-000000000046", "IID_IParseDisplayName"),
+    ("0000011B-0000-0000-C000-000000000046", "IID_IOleContainer"),
+    ("0000011C-0000-0000-C000-000000000046", "IID_IOleItemContainer"),
+    ("0000011D-0000-0000-C000-000000000046", "IID_IOleLink"),
+    ("0000011E-0000-0000-C000-000000000046", "IID_IOleCache"),
+    ("00000121-0000-0000-C000-000000000046", "IID_IDropSource"),
+    ("00000122-0000-0000-C000-000000000046", "IID_IDropTarget"),
+    ("00000125-0000-0000-C000-000000000046", "IID_IAdviseSink2"),
+    ("00000126-0000-0000-C000-000000000046", "IID_IRunnableObject"),
+    ("00000127-0000-0000-C000-000000000046", "IID_IViewObject2"),
+    ("00000128-0000-0000-C000-000000000046", "IID_IOleCache2"),
+    ("00000129-0000-0000-C000-000000000046", "IID_IOleCacheControl"),
+    ("0000013D-0000-0000-C000-000000000046", "IID_IClientSecurity"),
+    ("0000013E-0000-0000-C000-000000000046", "IID_IServerSecurity"),
+    ("00000146-0000-0000-C000-000000000046", "IID_IGlobalInterfaceTable"),
+    ("00020400-0000-0000-C000-000000000046", "IID_IDispatch"),
+    ("00020401-0000-0000-C000-000000000046", "IID_ITypeInfo"),
+    ("00020402-0000-0000-C000-000000000046", "IID_ITypeLib"),
+    ("00020403-0000-0000-C000-000000000046", "IID_ITypeComp"),
+    ("00020404-0000-0000-C000-000000000046", "IID_IEnumVARIANT"),
+    ("00020405-0000-0000-C000-000000000046", "IID_ICreateTypeInfo"),
+    ("00020406-0000-0000-C000-000000000046", "IID_ICreateTypeLib"),
+    ("00020411-0000-0000-C000-000000000046", "IID_ITypeLib2"),
+    ("00020412-0000-0000-C000-000000000046", "IID_ITypeInfo2"),
+    ("00020D00-0000-0000-C000-000000000046", "IID_IRichEditOle"),
+    ("00020D03-0000-0000-C000-000000000046", "IID_IRichEditOleCallback"),
+    ("000214E2-0000-0000-C000-000000000046", "IID_IShellBrowser"),
+    ("000214E3-0000-0000-C000-000000000046", "IID_IShellView"),
+    ("000214E4-0000-0000-C000-000000000046", "IID_IContextMenu"),
+    ("000214E6-0000-0000-C000-000000000046", "IID_IShellFolder"),
+    ("000214E8-0000-0000-C000-000000000046", "IID_IShellExtInit"),
+    ("000214EE-0000-0000-C000-000000000046", "IID_IShellLinkA"),
+    ("000214F9-0000-0000-C000-000000000046", "IID_IShellLinkW"),
+    ("0002E000-0000-0000-C000-000000000046", "IID_IEnumGUID"),
+    ("0002E012-0000-0000-C000-000000000046", "IID_ICatRegister"),
+    ("01E44665-24AC-101B-84ED-08002B2EC713", "IID_IPropertyPage2"),
+    ("1C2056CC-5EF4-101B-8BC8-00AA003E3B29", "IID_IOleInPlaceObjectWindowless"),
+    ("1CF2B120-547D-101B-8E65-08002B2BD119", "IID_IErrorInfo"),
+    ("22F03340-547D-101B-8E65-08002B2BD119", "IID_ICreateErrorInfo"),
+    ("22F55881-280B-11D0-A8A9-00A0C90C2004", "IID_IPersistPropertyBag2"),
+    ("22F55882-280B-11D0-A8A9-00A0C90C2004", "IID_IPropertyBag2"),
+    ("3127CA40-446E-11CE-8135-00AA004BB851", "IID_IErrorLog"),
+    ("332C4425-26CB-11D0-B483-00C04FD90119", "IID_IHTMLDocument2"),
+    ("34A715A0-6587-11D0-924A-0020AFC7AC4D", "DIID_DWebBrowserEvents2"),
+    ("376BD3AA-3845-101B-84ED-08002B2EC713", "IID_IPerPropertyBrowsing"),
+    ("37D84F60-42CB-11CE-8135-00AA004BB851", "IID_IPersistPropertyBag"),
+    ("3AF24290-0C96-11CE-A0CF-00AA00600AB8", "IID_IAdviseSinkEx"),
+    ("3AF24292-0C96-11CE-A0CF-00AA00600AB8", "IID_IViewObjectEx"),
+    ("4657278B-411B-11D2-839A-00C04FD918D0", "IID_IDropTargetHelper"),
+    ("55272A00-42CB-11CE-8135-00AA004BB851", "IID_IPropertyBag"),
+    ("55980BA0-35AA-11CF-B671-00AA004CD6D8", "IID_IPointerInactive"),
+    ("618736E0-3C3D-11CF-810C-00AA00389B71", "IID_IAccessible"),
+    ("6D5140C1-7436-11CE-8034-00AA006009FA", "IID_IServiceProvider"),
+    ("742B0E01-14E6-101B-914E-00AA00300CAB", "IID_ISimpleFrameSite"),
+    ("79EAC9C1-BAF9-11CE-8C82-00AA004BA90B", "IID_IBindStatusCallback"),
+    ("7BF80980-BF32-101A-8BBB-00AA00300CAB", "IID_IPicture"),
+    ("7BF80981-BF32-101A-8BBB-00AA00300CAB", "IID_IPictureDisp"),
+    ("7FD52380-4E07-101B-AE2D-08002B2EC713", "IID_IPersistStreamInit"),
+    ("894AD3B0-EF97-11CE-9BC9-00AA00608E01", "IID_IOleUndoUnit"),
+    ("922EADA0-3424-11CF-B670-00AA004CD6D8", "IID_IOleInPlaceSiteWindowless"),
+    ("9BFBBC02-EFF1-101A-84ED-00AA00341D07", "IID_IPropertyNotifySink"),
+    ("9C2CAD80-3424-11CF-B670-00AA004CD6D8", "IID_IOleInPlaceSiteEx"),
+    ("A6BC3AC0-DBAA-11CE-9DE3-00AA004BB851", "IID_IProvideClassInfo2"),
+    ("A6EF9860-C720-11D0-9337-00A0C90DCAA9", "IID_IDispatchEx"),
+    ("B196B283-BAB4-101A-B69C-00AA00341D07", "IID_IProvideClassInfo"),
+    ("B196B284-BAB4-101A-B69C-00AA00341D07", "IID_IConnectionPointContainer"),
+    ("B196B285-BAB4-101A-B69C-00AA00341D07", "IID_IEnumConnectionPoints"),
+    ("B196B286-BAB4-101A-B69C-00AA00341D07", "IID_IConnectionPoint"),
+    ("B196B287-BAB4-101A-B69C-00AA00341D07", "IID_IEnumConnections"),
+    ("B196B288-BAB4-101A-B69C-00AA00341D07", "IID_IOleControl"),
+    ("B196B289-BAB4-101A-B69C-00AA00341D07", "IID_IOleControlSite"),
+    ("B196B28B-BAB4-101A-B69C-00AA00341D07", "IID_ISpecifyPropertyPages"),
+    ("B196B28C-BAB4-101A-B69C-00AA00341D07", "IID_IPropertyPageSite"),
+    ("B196B28D-BAB4-101A-B69C-00AA00341D07", "IID_IPropertyPage"),
+    ("B196B28F-BAB4-101A-B69C-00AA00341D07", "IID_IClassFactory2"),
+    ("B722BCC5-4E68-101B-A2BC-00AA00404770", "IID_IOleDocument"),
+    ("B722BCC6-4E68-101B-A2BC-00AA00404770", "IID_IOleDocumentView"),
+    ("B722BCC7-4E68-101B-A2BC-00AA00404770", "IID_IOleDocumentSite"),
+    ("B722BCC9-4E68-101B-A2BC-00AA00404770", "IID_IPrint"),
+    ("B722BCCA-4E68-101B-A2BC-00AA00404770", "IID_IContinueCallback"),
+    ("B722BCCB-4E68-101B-A2BC-00AA00404770", "IID_IOleCommandTarget"),
+    ("BD1AE5E0-A6AE-11CE-BD37-504200C10000", "IID_IPersistMemory"),
+    ("BD3F23C0-D43E-11CF-893B-00AA00BDCE1A", "IID_IDocHostUIHandler"),
+    ("BEF6E002-A874-101A-8BBA-00AA00300CAB", "IID_IFont"),
+    ("BEF6E003-A874-101A-8BBA-00AA00300CAB", "IID_IFontDisp"),
+    ("CB5BDC81-93C1-11CF-8F20-00805F2CD064", "IID_IObjectSafety"),
+    ("CF51ED10-62FE-11CF-BF86-00A0C9034836", "IID_IQuickActivate"),
+    ("D001F200-EF97-11CE-9BC9-00AA00608E01", "IID_IOleUndoManager"),
+    ("D30C1661-CDAF-11D0-8A3E-00C04FC9E26E", "IID_IWebBrowser2"),
+    ("DE5BF786-477A-11D2-839D-00C04FD918D0", "IID_IDragSourceHelper"),
+    ("DF0B3D60-548F-101B-8E65-08002B2BD119", "IID_ISupportErrorInfo"),
+    ("FC4801A1-2BA9-11CF-A229-00AA003D7352", "IID_IBindHost"),
+    ("FC4801A3-2BA9-11CF-A229-00AA003D7352", "IID_IObjectWithSite"),
+]
+
 IS64 = idc.__EA64__
 
 # AFX_MSGMAPs names
@@ -1670,12 +1825,18 @@ S_CRuntimeClass = "CRuntimeClass"
 S_CRuntimeClass_v7 = "CRuntimeClass_v7"
 # public: static struct CRuntimeClass const 'CClassName'::class'CClassName'
 S_CRTC_Name = "?class%s@%s@@2UCRuntimeClass@@B"
-# public: virtual struct CRuntimeClass * 'CClassName'::GetRuntimeClass(void)const
-S_CRTC_GetRTC = "?GetRuntimeClass@%s@@UEBAPEAUCRuntimeClass@@XZ"
-# protected: static struct CRuntimeClass * 'CClassName'::_GetBaseClass(void)
-S_CRTC_GetBaseClass = "?_GetBaseClass@%s@@KAPEAUCRuntimeClass@@XZ"
-# public: static class CObject * 'CClassName'::CreateObject(void)
-S_CRTC_CreateObject = "?CreateObject@%s@@SAPEAVCObject@@XZ"
+# x64 pointers are __ptr64 (PEA), x86 static members are PASCAL (__stdcall, G)
+if IS64:
+    # public: virtual struct CRuntimeClass * 'CClassName'::GetRuntimeClass(void)const
+    S_CRTC_GetRTC = "?GetRuntimeClass@%s@@UEBAPEAUCRuntimeClass@@XZ"
+    # protected: static struct CRuntimeClass * 'CClassName'::_GetBaseClass(void)
+    S_CRTC_GetBaseClass = "?_GetBaseClass@%s@@KAPEAUCRuntimeClass@@XZ"
+    # public: static class CObject * 'CClassName'::CreateObject(void)
+    S_CRTC_CreateObject = "?CreateObject@%s@@SAPEAVCObject@@XZ"
+else:
+    S_CRTC_GetRTC = "?GetRuntimeClass@%s@@UBEPAUCRuntimeClass@@XZ"
+    S_CRTC_GetBaseClass = "?_GetBaseClass@%s@@KGPAUCRuntimeClass@@XZ"
+    S_CRTC_CreateObject = "?CreateObject@%s@@SGPAVCObject@@XZ"
 
 MENU_PATH = "Search/%s/" % PLUGIN_NAME
 POPUP_PATH = "%s/" % PLUGIN_NAME
@@ -1693,6 +1854,7 @@ class logger_t(object):
         if file_loglevel != None:
             self.file_loglevel = file_loglevel
 
+        self.filelog = None
         self.log = logging.getLogger()
         if not len(self.log.handlers):
             self.log.setLevel(logging.DEBUG)
@@ -1712,17 +1874,31 @@ class logger_t(object):
 
                 self.log.addHandler(self.filelog)
 
-    def debug(self, msg):
-        return self.log.debug(msg)
+        # checked by hot loops before building any debug message
+        self.debug_enabled = self.is_enabled(logging.DEBUG)
+
+    def is_enabled(self, level):
+        """ True if a record of this level passes the filter of at least one handler """
+        if not self.log.isEnabledFor(level):
+            return False
+        if level in self.stream_loglevel:
+            return True
+        return self.filelog is not None and level in self.file_loglevel
+
+    # msg is formatted with args only when the record is emitted
+
+    def debug(self, msg, *args):
+        if self.debug_enabled:
+            return self.log.debug(msg, *args)
 
-    def info(self, msg):
-        return self.log.info(msg)
+    def info(self, msg, *args):
+        return self.log.info(msg, *args)
 
-    def warning(self, msg):
-        return self.log.warning(msg)
+    def warning(self, msg, *args):
+        return self.log.warning(msg, *args)
 
-    def error(self, msg):
-        return self.log.error(msg)
+    def error(self, msg, *args):
+        return self.log.error(msg, *args)
 
 if debug:
     logger = logger_t(stream_loglevel=(logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR))
@@ -1803,6 +1979,1384 @@ class Utils(object):
                 return 0
         return 1
 
+    @staticmethod
+    def has_fixups():
+        """ False when the relocation table was stripped or fixups were not loaded """
+        return ida_fixup.get_first_fixup_ea() != idc.BADADDR
+
+    @staticmethod
+    def fixup_pairs(start_ea, end_ea, ptrSize):
+        """ Addresses in [start_ea, end_ea) holding a fixup that is followed by another one ptrSize later """
+        result = []
+        prev = idc.BADADDR
+        ea = ida_fixup.get_next_fixup_ea(start_ea - 1)
+        while ea != idc.BADADDR and ea < end_ea:
+            if ea - prev == ptrSize:
+                result.append(prev)
+            prev = ea
+            ea = ida_fixup.get_next_fixup_ea(ea)
+        return result
+
+    @staticmethod
+    def decode_getter(ea, ptrSize, depth=0):
+        """
+        Decode the one instruction getter at ea (GetThisMessageMap, _GetBaseClass...).
+
+        Return:
+            (X, None) for "return &X", (None, import_ea) when it loads or jumps
+            through an import whose name tells what it returns, (None, None) otherwise
+        """
+        buf = idc.get_bytes(ea, 8)
+        if buf is None or len(buf) < 6 or depth > 2:
+            return None, None
+        buf = bytes(buf)
+        if ptrSize == 8:
+            disp = struct.unpack_from("<i", buf, 3)[0] if len(buf) >= 8 else 0
+            if buf[:3] == b"\x48\x8D\x05" and buf[7:8] == b"\xC3":      # lea rax, [rip+X]; ret
+                return (ea + 7 + disp) & 0xFFFFFFFFFFFFFFFF, None
+            if buf[:3] == b"\x48\x8B\x05" and buf[7:8] == b"\xC3":      # mov rax, [rip+__imp_X]; ret
+                return None, (ea + 7 + disp) & 0xFFFFFFFFFFFFFFFF
+            if buf[:2] == b"\xFF\x25":                                  # jmp [rip+__imp_X]
+                return None, (ea + 6 + struct.unpack_from("<i", buf, 2)[0]) & 0xFFFFFFFFFFFFFFFF
+            mask = 0xFFFFFFFFFFFFFFFF
+        else:
+            if buf[:1] == b"\xB8" and buf[5:6] == b"\xC3":              # mov eax, offset X; retn
+                return struct.unpack_from("<I", buf, 1)[0], None
+            if buf[:1] == b"\xA1" and buf[5:6] == b"\xC3":              # mov eax, __imp_X; retn
+                return None, struct.unpack_from("<I", buf, 1)[0]
+            if buf[:2] == b"\xFF\x25":                                  # jmp __imp_X
+                return None, struct.unpack_from("<I", buf, 2)[0]
+            mask = 0xFFFFFFFF
+        if buf[:1] == b"\xE9":                                          # jmp X::GetThisXxx
+            target = (ea + 5 + struct.unpack_from("<i", buf, 1)[0]) & mask
+            result = Utils.decode_getter(target, ptrSize, depth + 1)
+            return result if result != (None, None) else (None, target)
+        return None, None
+
+class ScanStats(object):
+    """ Wall time and call count of each phase of a scan, in first-seen order """
+    def __init__(self, title="scan"):
+        self.title = title
+        self.phases = {}
+        self.started = time.time()
+        self.clock = time.perf_counter
+
+    def add(self, phase, t0, calls=1):
+        """ Account the time elapsed since t0 = self.clock() to phase """
+        self.add_time(phase, self.clock() - t0, calls)
+
+    def add_time(self, phase, seconds, calls=1):
+        rec = self.phases.get(phase)
+        if rec is None:
+            rec = self.phases[phase] = [0.0, 0]
+        rec[0] += seconds
+        rec[1] += calls
+
+    def count(self, phase, calls=1):
+        self.add_time(phase, 0.0, calls)
+
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "total": time.time() - self.started,
+            "phases": [{"phase": k, "seconds": v[0], "calls": v[1]} for k, v in self.phases.items()],
+        }
+
+    def report(self):
+        lines = ["===== %s timing =====" % self.title,
+                 "%-28s %10s %10s" % ("phase", "calls", "time(s)")]
+        for phase, (seconds, calls) in self.phases.items():
+            lines.append("%-28s %10d %10.3f" % (phase, calls, seconds))
+        lines.append("%-28s %10s %10.3f" % ("total", "", time.time() - self.started))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class ResolveCache(object):
+    """
+    Lookups made while naming the class of each AFX_MSGMAP, shared by the maps
+    of one scan: many of them go through the same getters and vtables.
+    """
+    def __init__(self):
+        self.xrefs = {}             # ea -> tuple of xref sources
+        self.getters = {}           # (getter ref, data segment) -> (ref_addr_lst, vtable_item, addr_set)
+        self.class_names = {}       # vtable item -> class name
+
+    def xrefs_to(self, ea):
+        frms = self.xrefs.get(ea)
+        if frms is None:
+            frms = self.xrefs[ea] = tuple(xref.frm for xref in idautils.XrefsTo(ea))
+        return frms
+
+
+class JSONLinesExporter(object):
+    """
+    Writes every map a scan makes as one JSON line, so the result never has to
+    be held in memory. out is a path or a text file. Records wait in a spool
+    file until commit(), once the write batch of their maps is applied.
+    """
+    def __init__(self, out):
+        self._owned = not hasattr(out, "write")
+        self.out = open(out, "w") if self._owned else out
+        self.spool = tempfile.TemporaryFile("w+")
+        self.count = 0
+
+    def write(self, record):
+        self.spool.write("%d\t%s\n" % (record["addr"], json.dumps(record)))
+
+    def commit(self, failed=()):
+        """ Copy the spooled records to out, but those of the maps in failed """
+        self.spool.seek(0)
+        for line in self.spool:
+            addr, line = line.split("\t", 1)
+            if int(addr) not in failed:
+                self.out.write(line)
+                self.count += 1
+        self.spool.seek(0)
+        self.spool.truncate()
+
+    def close(self):
+        """ Records not committed yet are dropped """
+        self.spool.close()
+        if self._owned:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+class IDBWriteBatch(object):
+    """
+    IDB writes planned by Make_MSG_ENTRY, applied in one pass with auto-analysis
+    suspended; analysis and the views are then brought up to date once.
+
+    Structs go first, then the queued handler functions (each EA once, however
+    many maps share it), then comments and names, which may need the functions.
+    Writes planned inside map_writes(addr) belong to that map: when one of its
+    entry structs cannot be created, the map's writes planned from that struct
+    on are skipped, as a single Make_MSG_ENTRY used to stop at the failed entry.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        self.struct_ops = []        # (map, seq, ea, size, name)
+        self.func_queue = set()
+        self.func_owners = {}       # ea -> {map: seq of its first add_func}, None for no map
+        self.name_ops = []          # (map, seq, stats phase, function, args), in planned order
+        self.func_names = {}        # ea -> first name planned by rename_func
+        self.owner = None           # map of the writes being planned, see map_writes()
+        self.seq = 0                # planned writes so far
+        self.failed = {}            # map -> ea of its entry struct that failed, set by apply()
+
+    @contextlib.contextmanager
+    def map_writes(self, addr):
+        """ Plan the writes of the block for the map at addr """
+        outer, self.owner = self.owner, addr
+        try:
+            yield self
+        finally:
+            self.owner = outer
+
+    def _next(self):
+        self.seq += 1
+        return self.seq
+
+    def create_struct(self, ea, size, name):
+        self.struct_ops.append((self.owner, self._next(), ea, size, name))
+
+    def set_name(self, ea, name, flags=idc.SN_CHECK):
+        self.name_ops.append((self.owner, self._next(), "rename", idc.set_name, (ea, name, flags)))
+
+    def rename_func(self, ea, name):
+        self.func_names.setdefault(ea, name)
+        self.name_ops.append((self.owner, self._next(), "rename", self._rename_func, (ea, name)))
+
+    def func_name(self, ea):
+        """ Name of the function at ea once the batch is applied """
+        # any dummy name (loc_ of a queued handler, sub_...) is replaced by the planned one
+        if ea in self.func_names and not idaapi.has_user_name(idaapi.get_flags(ea)):
+            return self.func_names[ea]
+        return idc.get_name(ea) or ""
+
+    def add_func(self, ea):
+        self.func_queue.add(ea)
+        self.func_owners.setdefault(ea, {}).setdefault(self.owner, self._next())
+
+    def has_func(self, ea):
+        return ea in self.func_queue or idaapi.get_func(ea) is not None
+
+    def set_func_cmt(self, ea, cmt):
+        self.name_ops.append((self.owner, self._next(), "comments", self._set_func_cmt, (ea, cmt)))
+
+    @staticmethod
+    def _rename_func(ea, name):
+        if idaapi.get_func_name(ea) == "sub_%lX" % (ea):
+            idc.set_name(ea, name)
+
+    @staticmethod
+    def _set_func_cmt(ea, cmt):
+        pfn = idaapi.get_func(ea)
+        if pfn is not None:
+            idaapi.set_func_cmt(pfn, cmt, 0)
+
+    @staticmethod
+    def _skipped(cutoffs, owner, seq):
+        """ Whether the write seq of owner comes at or after its failed struct """
+        return owner in cutoffs and seq >= cutoffs[owner]
+
+    def _create_structs(self, cutoffs):
+        """ Fill cutoffs and self.failed with the maps with an entry struct that could not be created """
+        for owner, seq, ea, size, name in self.struct_ops:
+            if owner in cutoffs:
+                continue
+            if size != -1:
+                idc.del_items(ea, idc.DELIT_SIMPLE, size)
+            if idc.create_struct(ea, size, name) == 0 and size != -1:
+                print("Create %s failed at %X" % (name, ea))
+                if owner is not None:
+                    cutoffs[owner] = seq
+                    self.failed[owner] = ea
+
+    def _create_funcs(self, cutoffs):
+        """ Return the number of functions created """
+        created = 0
+        for ea in sorted(self.func_queue):
+            # only wanted by entries at or after a failed struct
+            if cutoffs and all(self._skipped(cutoffs, owner, seq) for owner, seq in self.func_owners[ea].items()):
+                continue
+            if idaapi.get_func(ea) is None:
+                idc.del_items(ea, idc.DELIT_SIMPLE)
+                if idaapi.add_func(ea):
+                    created += 1
+        return created
+
+    def apply(self):
+        """ Return self.failed, the maps whose entry struct failed, see _create_structs() """
+        stats = self.stats
+        cutoffs = {}                # map -> seq of its failed struct
+        self.failed = {}
+        t0 = stats.clock()
+        old_auto = ida_auto.enable_auto(False)
+        try:
+            t1 = stats.clock()
+            self._create_structs(cutoffs)
+            stats.add("create structs", t1, len(self.struct_ops))
+
+            t1 = stats.clock()
+            created = self._create_funcs(cutoffs)
+            stats.add("add_func", t1, created)
+            if self.func_queue:
+                print("Created %d of %d queued handler functions in %.3f s" % (created, len(self.func_queue), stats.clock() - t1))
+
+            for owner, seq, phase, func, args in self.name_ops:
+                if self._skipped(cutoffs, owner, seq):
+                    continue
+                t1 = stats.clock()
+                func(*args)
+                stats.add(phase, t1)
+        finally:
+            ida_auto.enable_auto(old_auto)
+        stats.add("apply writes", t0)
+        self.struct_ops = []
+        self.func_queue = set()
+        self.func_owners = {}
+        self.name_ops = []
+        self.func_names = {}
+
+        t0 = stats.clock()
+        ida_auto.auto_wait()
+        idaapi.refresh_idaview_anyway()
+        stats.add("auto analysis", t0)
+        return self.failed
+
+
+# What Make_MSG_ENTRY decoded, collected in AFXStructs.msgmaps
+MsgMapEntry = collections.namedtuple("MsgMapEntry", "nMessage nCode nID nLastID nSig pfn")
+MsgMap = collections.namedtuple("MsgMap", "addr name pBaseMap lpEntries entries")
+# What Find_Message_Entry answers: the handler, its AfxSig and the map it comes from
+MessageHandler = collections.namedtuple("MessageHandler", "pfn nSig sig_name sig_type map_addr class_name entry")
+# What Search_CRuntimeClass found, collected in AFXStructs.runtime_classes
+RuntimeClass = collections.namedtuple("RuntimeClass", "addr name nObjectSize wSchema pfnCreateObject pBaseClass pNextClass")
+# Any other map table Search_MSGMAP found, collected in AFXStructs.afx_maps; entries hold the raw entry fields
+AfxMap = collections.namedtuple("AfxMap", "addr name kind pBaseMap lpEntries entries")
+# one AFX_MSGMAP_ENTRY reaching a handler, see HandlerIndex
+HandlerEntry = collections.namedtuple("HandlerEntry", "map_addr entry_addr nMessage nCode nID nLastID")
+
+
+class AfxMapType(object):
+    """
+    Layout of an MFC map table besides AFX_MSGMAP, see AFX_MAP_TYPES.
+
+    The header starts with pfnGetBaseMap and lpEntries, any further header
+    field is a pointer into the image. Formats are struct formats where "P"
+    is a pointer sized field. is_entry and is_end get the decoded entry and
+    the AFXStructs; handlers lists (field index, name prefix) of the entry
+    fields that point to functions, guid is the index of a GUID pointer field.
+    """
+    def __init__(self, kind, map_struct, entry_struct, header, fields, entry, is_entry, is_end, getter, handlers=(), guid=None):
+        self.kind = kind
+        self.map_struct = map_struct
+        self.entry_struct = entry_struct
+        self.header = header
+        self.fields = tuple(fields.split())
+        self.entry = entry
+        self.is_entry = is_entry
+        self.is_end = is_end
+        # GetThis<getter> / _GetBase<getter> in the name of a symbolized base map getter
+        self.getter = getter
+        self.handlers = handlers
+        self.guid = guid
+        self._layouts = {}
+
+    def layout(self, ptrSize):
+        """ (header, entry) struct.Struct for ptrSize """
+        result = self._layouts.get(ptrSize)
+        if result is None:
+            ptr = "Q" if ptrSize == 8 else "I"
+            result = self._layouts[ptrSize] = (struct.Struct("<" + self.header.replace("P", ptr)),
+                                                struct.Struct("<" + self.entry.replace("P", ptr)))
+        return result
+
+
+def _in_image(a, ea):
+    return a.min_ea < ea < a.max_ea
+
+
+def _is_disp_entry(e, a):
+    # lpszName, lDispID, lpszParams (NULL for DISP_DEFVALUE), vt, pfn, pfnSet, nPropOffset, flags
+    return _in_image(a, e[0]) and (e[2] == 0 or _in_image(a, e[2])) and e[3] <= 0xFFFF and \
+        (e[4] == 0 or _in_image(a, e[4])) and (e[5] == 0 or _in_image(a, e[5])) and e[7] <= 1
+
+
+def _is_disp_end(e, a):
+    # { VTS_NONE, DISPID_UNKNOWN, VTS_NONE, VT_VOID, NULL, NULL, (size_t)-1, afxDispCustom }
+    return e[3] == 24 and e[4] == 0 and e[5] == 0 and e[6] == a.ptrMax
+
+
+# Map tables found together with the AFX_MSGMAPs, in the order they are tried;
+# INTERFACE and CONNECTION entries look the same, a named base map getter decides
+AFX_MAP_TYPES = (
+    AfxMapType("OLECMD", S_OLECMDMAP, S_OLECMDMAP_ENTRY, "PP", "pguid cmdID nID", "PII",
+               # pguid is NULL for the standard command group
+               lambda e, a: (e[0] == 0 or _in_image(a, e[0])) and 0 < e[1] <= 0xFFFF and e[2] <= 0xFFFF,
+               lambda e, a: not any(e),
+               "OleCommandMap", guid=0),
+    AfxMapType("INTERFACE", S_INTERFACEMAP, S_INTERFACEMAP_ENTRY, "PP", "piid nOffset", "PP",
+               # piid is NULL for INTERFACE_AGGREGATE
+               lambda e, a: (e[0] == 0 or _in_image(a, e[0])) and e[1] < 0x100000,
+               lambda e, a: e[0] == 0 and e[1] == a.ptrMax,
+               "InterfaceMap", guid=0),
+    AfxMapType("CONNECTION", S_CONNECTIONMAP, S_CONNECTIONMAP_ENTRY, "PP", "piid nOffset", "PP",
+               lambda e, a: _in_image(a, e[0]) and e[1] < 0x100000,
+               lambda e, a: e[0] == 0 and e[1] == a.ptrMax,
+               "ConnectionMap", guid=0),
+    AfxMapType("DISP", S_DISPMAP, S_DISPMAP_ENTRY, "PPPP",
+               "lpszName lDispID lpszParams vt pfn pfnSet nPropOffset flags", "PPPPPPPP",
+               _is_disp_entry, _is_disp_end,
+               "DispatchMap", ((4, "Disp"), (5, "DispSet"))),
+    AfxMapType("EVENTSINK", S_EVENTSINKMAP, S_EVENTSINKMAP_ENTRY, "PPP",
+               "lpszName lDispID lpszParams vt pfn pfnSet nPropOffset flags nCtrlIDFirst nCtrlIDLast", "PPPPPPPPII",
+               lambda e, a: _is_disp_entry(e, a) and (e[8] <= 0xFFFF or e[8] == 0xFFFFFFFF) and e[9] <= 0xFFFF,
+               _is_disp_end,
+               "EventSinkMap", ((4, "Event"),)),
+)
+
+
+class MsgRegistry(object):
+    """
+    Window message names indexed by message ID.
+
+    IDs with several names (WM_SETTINGCHANGE/WM_WININICHANGE, control messages
+    sharing a WM_USER offset...) keep all of them in table order. IDs missing
+    from the table are named by their WM_USER, WM_APP or registered message range.
+    """
+    def __init__(self, table):
+        self.names = {}
+        for msg_id, msg_name in table:
+            self.names.setdefault(msg_id, []).append(msg_name)
+        for msg_id in self.names:
+            self.names[msg_id] = tuple(self.names[msg_id])
+        self.range_names = {}
+
+    def __contains__(self, mid):
+        return mid in self.names
+
+    def items(self):
+        """ (msg_id, names) sorted by message ID """
+        return sorted(self.names.items())
+
+    def get(self, mid):
+        names = self.names.get(mid)
+        if names is None:
+            names = self.range_names.get(mid)
+            if names is None:
+                names = self.range_names[mid] = (self.range_name(mid),)
+        return names
+
+    @staticmethod
+    def range_name(mid):
+        if WM_USER <= mid < WM_APP:
+            return "WM_USER_PLUS_0x%X" % (mid - WM_USER)
+        if WM_APP <= mid < 0xC000:
+            return "WM_APP_PLUS_0x%X" % (mid - WM_APP)
+        if 0xC000 <= mid <= 0xFFFF:
+            # RegisterWindowMessage range, ON_REGISTERED_MESSAGE entries
+            return "WM_REGISTERED_0x%X" % mid
+        return "WM_UNKNOWN_0x%X" % mid
+
+msg_registry = MsgRegistry(MSG_TABLES)
+
+
+class IIDTable(object):
+    """
+    Known-IID table written by afx_iids.py, memory mapped: the magic and the
+    record count, the sorted GUIDs, the offsets of their names and the NUL
+    terminated names. A lookup bisects the GUID block and decodes one name.
+    """
+    MAGIC = b"AFXIID1\x00"
+    HEADER = struct.Struct("<8sI")
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # mmap raises ValueError for an empty file
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.HEADER.unpack_from(self._map, 0)
+        self._guids = self.HEADER.size
+        self._offsets = self._guids + 16 * self.count
+        self._names = self._offsets + 4 * self.count
+        if magic != self.MAGIC or len(self._map) < self._names:
+            self._map.close()
+            raise ValueError("not an IID table")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # the GUID block as a sequence for bisect
+        off = self._guids + 16 * i
+        return self._map[off:off + 16]
+
+    def name(self, i):
+        start = self._names + struct.unpack_from("<I", self._map, self._offsets + 4 * i)[0]
+        end = self._map.find(b"\x00", start)
+        return self._map[start:end if end >= 0 else len(self._map)].decode("latin-1")
+
+    def get(self, guid):
+        """ Name of the GUID given by its 16 bytes, "" when it is not in the table """
+        i = bisect.bisect_left(self, guid)
+        if i < self.count and self[i] == guid:
+            return self.name(i)
+        return ""
+
+    def items(self):
+        """ (guid bytes, name) of every record, in GUID order """
+        for i in range(self.count):
+            yield self[i], self.name(i)
+
+    def close(self):
+        self._map.close()
+
+
+class IIDIndex(object):
+    """
+    Names of known GUIDs keyed by their 16 bytes as laid out in memory.
+
+    Nothing is read before the first lookup, which puts the table in a dict
+    and maps the IIDTable files in paths that exist. A later file wins over
+    an earlier one and over the table.
+    """
+    def __init__(self, table, paths=()):
+        self.table = table
+        self.paths = list(paths)
+        self._names = None
+        self._tables = []
+
+    def __len__(self):
+        """ GUIDs in the table and the files, one known to several counts for each """
+        return len(self._load()) + sum(len(t) for t in self._tables)
+
+    def _load(self):
+        if self._names is None:
+            self._names = {uuid.UUID(guid).bytes_le: name for guid, name in self.table}
+            for path in self.paths:
+                if not os.path.isfile(path):
+                    continue
+                try:
+                    self._tables.append(IIDTable(path))
+                except (IOError, OSError, ValueError, struct.error) as e:
+                    logger.warning("Cannot load IID table %s: %s", path, e)
+        return self._names
+
+    def get(self, guid):
+        """ Name of the GUID given by its 16 bytes, "" when unknown """
+        names = self._load()
+        guid = bytes(guid)
+        for table in reversed(self._tables):
+            name = table.get(guid)
+            if name:
+                return name
+        return names.get(guid, "")
+
+    @staticmethod
+    def read_table(path):
+        """ [(guid bytes, name), ...] of the IIDTable at path, in GUID order """
+        table = IIDTable(path)
+        try:
+            return list(table.items())
+        finally:
+            table.close()
+
+# a larger table can sit next to the plugin
+iid_index = IIDIndex(KNOWN_IIDS, [os.path.join(os.path.dirname(os.path.abspath(__file__)), "AFX_MSGMAP_iids.bin")])
+
+
+class FuncIndex(object):
+    """
+    Start EAs of all functions and import thunks, built once per scan so
+    pointer checks are a set lookup instead of an idaapi.get_func call.
+    """
+    def __init__(self):
+        self.starts = set(idautils.Functions())
+        self.starts.update(self.import_thunks())
+        self._sorted = None
+
+    @staticmethod
+    def import_thunks():
+        """ jmp [__imp_xxx] stubs that IDA did not turn into functions """
+        thunks = []
+        iat = []
+
+        def imp_cb(ea, name, ordinal):
+            iat.append(ea)
+            return True
+
+        for i in range(idaapi.get_import_module_qty()):
+            idaapi.enum_import_names(i, imp_cb)
+
+        for ea in iat:
+            for xref in idautils.XrefsTo(ea, 0):
+                if idc.print_insn_mnem(xref.frm) == "jmp":
+                    thunks.append(xref.frm)
+        return thunks
+
+    def __contains__(self, ea):
+        return ea in self.starts
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, ea):
+        """ Register a function created during the scan """
+        if ea not in self.starts:
+            self.starts.add(ea)
+            self._sorted = None
+
+    def sorted_array(self):
+        """ Sorted NumPy array of the start EAs, None without NumPy """
+        if np is None:
+            return None
+        if self._sorted is None:
+            self._sorted = np.array(sorted(self.starts), dtype=np.uint64)
+        return self._sorted
+
+
+class RTTIIndex(object):
+    """
+    MSVC RTTI of the whole database, found in one pass over the data segments:
+    TypeDescriptors by their ".?AV"/".?AU" names, the CompleteObjectLocators
+    pointing to them, their ClassHierarchyDescriptors and the vtables whose
+    slot -1 points to a locator.
+
+    vtables maps a vtable EA to its class name, bases a class name to the
+    names of all its base classes (nearest first, as in the hierarchy array).
+    """
+    # TypeDescriptor.name, the class part is between ".?AV" and "@@"
+    _type_name = re.compile(b"\\.\\?A[VU]([\\x21-\\x7e]{1,1024}?)@@\\x00")
+
+    def __init__(self, ptrSize):
+        self.ptrSize = ptrSize
+        self.image_base = idaapi.get_imagebase()
+        self.type_names = {}        # TypeDescriptor ea -> class name
+        self.locators = {}          # CompleteObjectLocator ea -> class name
+        self.vtables = {}           # vtable ea -> class name
+        self.vtable_ends = {}       # vtable ea -> end of its function pointer slots
+        self.bases = {}             # class name -> tuple of base class names
+        self._vtable_starts = []
+        self._snapshots = []
+        self._code = []
+
+    @staticmethod
+    def class_name(raw):
+        """ CFoo@NS -> NS::CFoo; templates and other specials are kept as they are """
+        if "?" in raw:
+            return raw
+        return "::".join(reversed(raw.split("@")))
+
+    def build(self):
+        for i in range(ida_segment.get_segm_qty()):
+            s = ida_segment.getnseg(i)
+            if ida_segment.get_segm_class(s) == "CODE":
+                self._code.append((s.start_ea, s.end_ea))
+            else:
+                self._snapshots.append(SegmentSnapshot(s.start_ea, s.end_ea, self.ptrSize))
+
+        # TypeDescriptor: pVFTable, spare, name
+        for snapshot in self._snapshots:
+            for m in self._type_name.finditer(snapshot.buf):
+                td = snapshot.start_ea + m.start() - 2 * self.ptrSize
+                self.type_names[td] = self.class_name(m.group(1).decode("latin-1"))
+
+        # COL: signature, offset, cdOffset, pTypeDescriptor, pClassDescriptor(, pSelf on x64)
+        # x64 keeps image relative offsets in the RTTI structures
+        rel = self.image_base if self.ptrSize == 8 else 0
+        td_refs = set(td - rel for td in self.type_names)
+        for ea in self._find_values(td_refs, 4):
+            col = ea - 12
+            sig = self._dword(col)
+            if self.ptrSize == 8:
+                if sig != 1 or self._dword(col + 20) != col - rel:
+                    continue
+            elif sig != 0:
+                continue
+            td = self._dword(col + 12) + rel
+            chd = self._dword(col + 16) + rel
+            # the hierarchy must start with the class itself: BaseClassArray[0]->pTypeDescriptor
+            if self._dword(chd) != 0 or not 0 < self._dword(chd + 8) < 1024 or \
+                    self._dword(self._dword(self._dword(chd + 12) + rel) + rel) + rel != td:
+                continue
+            name = self.type_names[td]
+            self.locators[col] = name
+            if name not in self.bases:
+                self.bases[name] = self._hierarchy(chd, rel)
+
+        # vtable[-1] is the locator
+        for ea in self._find_values(set(self.locators), self.ptrSize):
+            vtable = ea + self.ptrSize
+            self.vtables[vtable] = self.locators[self._ptr(ea)]
+        self._vtable_starts = sorted(self.vtables)
+        for i, vtable in enumerate(self._vtable_starts):
+            # function pointers, up to the locator of the next vtable
+            limit = self._vtable_starts[i + 1] - self.ptrSize if i + 1 < len(self._vtable_starts) else idc.BADADDR
+            end = vtable
+            while end < limit and self._is_code(self._ptr(end)):
+                end += self.ptrSize
+            self.vtable_ends[vtable] = end
+        self._snapshots = []
+        return self
+
+    def _hierarchy(self, chd, rel):
+        """ Base class names from the ClassHierarchyDescriptor at chd, without the class itself """
+        count = self._dword(chd + 8)
+        array = self._dword(chd + 12) + rel
+        names = []
+        # BaseClassArray[0] is the class itself
+        for i in range(1, count):
+            bcd = self._dword(array + 4 * i) + rel
+            name = self.type_names.get(self._dword(bcd) + rel)
+            if name is not None:
+                names.append(name)
+        return tuple(names)
+
+    def _snapshot(self, ea):
+        for snapshot in self._snapshots:
+            if snapshot.start_ea <= ea < snapshot.end_ea:
+                return snapshot
+        return None
+
+    def _dword(self, ea):
+        snapshot = self._snapshot(ea)
+        return snapshot.dword(ea) if snapshot is not None else idc.get_wide_dword(ea)
+
+    def _ptr(self, ea):
+        snapshot = self._snapshot(ea)
+        return snapshot.ptr(ea) if snapshot is not None else AFXStructs.get_DWORD_PTR(ea)
+
+    def _is_code(self, ea):
+        return any(start <= ea < end for start, end in self._code)
+
+    def _find_values(self, values, size):
+        """ EAs of the size-aligned items in the data segments holding one of values """
+        result = []
+        if not values:
+            return result
+        fmt = "<I" if size == 4 else "<Q"
+        for snapshot in self._snapshots:
+            buf = snapshot.buf[:len(snapshot.buf) // size * size]
+            if np is not None:
+                arr = np.frombuffer(buf, dtype=fmt)
+                hits = np.nonzero(np.isin(arr, np.fromiter(values, dtype=fmt, count=len(values))))[0]
+                result.extend(snapshot.start_ea + int(i) * size for i in hits)
+            else:
+                for i, (value,) in enumerate(struct.iter_unpack(fmt, buf)):
+                    if value in values:
+                        result.append(snapshot.start_ea + i * size)
+        return result
+
+    def class_of_vtable(self, ea):
+        return self.vtables.get(ea, "")
+
+    def class_of_slot(self, ea):
+        """ Class name of the vtable whose function pointer slots contain ea, "" if none """
+        i = bisect.bisect_right(self._vtable_starts, ea) - 1
+        if i >= 0:
+            vtable = self._vtable_starts[i]
+            if ea < self.vtable_ends[vtable]:
+                return self.vtables[vtable]
+        return ""
+
+
+class RuntimeClassGraph(object):
+    """
+    CRuntimeClass objects of the database and their inheritance.
+
+    Parents come from m_pBaseClass, or by decoding the m_pfnGetBaseClass
+    getter in MFC DLL builds; a getter that loads an imported class gives an
+    external parent known by name only. Parent lookups are memoized; a class
+    whose chain loops, or runs into a loop, is remembered in self.cycles.
+    """
+    _imported_class = re.compile(r"^(?:__imp_)?\?(?:class(\w+)@|GetThisClass@(\w+)@@)")
+
+    def __init__(self, ptrSize, is_func_start):
+        self.ptrSize = ptrSize
+        self.is_func_start = is_func_start
+        self.nodes = {}             # addr -> RuntimeClass
+        self.by_name = {}           # class name -> addr
+        self.cycles = set()         # addrs whose ancestor chain loops
+        self._parent = {}           # addr -> parent addr or None
+        self._external = {}         # addr -> name of a parent outside the binary
+        self._ancestors = {}        # addr -> tuple of ancestor names
+
+    def __contains__(self, addr):
+        return addr in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, rc):
+        self.nodes[rc.addr] = rc
+        self.by_name.setdefault(rc.name, rc.addr)
+        # a new node can complete chains cached before
+        self._ancestors = {}
+
+    def remove(self, addr):
+        rc = self.nodes.pop(addr)
+        if self.by_name.get(rc.name) == addr:
+            del self.by_name[rc.name]
+        self._parent.pop(addr, None)
+        self._external.pop(addr, None)
+        self._ancestors = {}
+
+    def parent(self, addr):
+        """ Address of the parent CRuntimeClass, None for a root or an external parent """
+        if addr in self._parent:
+            return self._parent[addr]
+        base = self.nodes[addr].pBaseClass
+        parent = None
+        if base in self.nodes:
+            parent = base
+        elif base and self.is_func_start(base):
+            # m_pfnGetBaseClass
+            parent, external = self._getter_class(base)
+            if external:
+                self._external[addr] = external
+        elif base:
+            parent = base
+        self._parent[addr] = parent
+        return parent
+
+    def parent_name(self, addr):
+        parent = self.parent(addr)
+        if parent in self.nodes:
+            return self.nodes[parent].name
+        return self._external.get(addr, "")
+
+    def _getter_class(self, ea):
+        """ (class addr, "") returned by the getter at ea, or (None, imported class name) """
+        target, import_ea = Utils.decode_getter(ea, self.ptrSize)
+        if import_ea is not None:
+            return None, self._imported_name(import_ea)
+        return target, ""
+
+    def _imported_name(self, ea):
+        """ CWnd from ?classCWnd@CWnd@@... or ?GetThisClass@CWnd@@..., "" otherwise """
+        m = self._imported_class.match(idc.get_name(ea, ida_name.GN_VISIBLE) or "")
+        if m is None:
+            return ""
+        return m.group(1) or m.group(2)
+
+    # _ancestors value of a class whose chain runs into a loop
+    _LOOPS = "loops"
+
+    def get_ancestors(self, cls):
+        """ Names of the ancestors of cls (addr or class name), nearest first; () for a class in self.cycles """
+        addr = self.by_name.get(cls) if not isinstance(cls, int) else cls
+        if addr not in self.nodes:
+            return ()
+        result = self._ancestors.get(addr)
+        if result is not None:
+            return () if result is self._LOOPS else result
+
+        # walk up to a root, an external parent, a cached class or a loop;
+        # every class on the path gets its result
+        path = [addr]
+        seen = {addr}
+        tail = None
+        while True:
+            cur = path[-1]
+            parent = self.parent(cur)
+            if parent not in self.nodes:
+                external = self._external.get(cur)
+                tail = (external,) if external else ()
+                break
+            if parent in seen:
+                logger.warning("CRuntimeClass hierarchy loops at 0x%x", parent)
+                break
+            cached = self._ancestors.get(parent)
+            if cached is self._LOOPS:
+                break
+            if cached is not None:
+                tail = (self.nodes[parent].name,) + cached
+                break
+            path.append(parent)
+            seen.add(parent)
+
+        if tail is None:
+            # the loop members and every class leading into the loop
+            for a in path:
+                self._ancestors[a] = self._LOOPS
+                self.cycles.add(a)
+            return ()
+        for a in reversed(path):
+            self._ancestors[a] = tail
+            tail = (self.nodes[a].name,) + tail
+        return self._ancestors[addr]
+
+    def drop_cycles(self):
+        """ Remove the classes whose chain loops and the classes derived from them, return their addrs """
+        for addr in list(self.nodes):
+            self.get_ancestors(addr)
+        dropped = set(a for a in self.cycles if a in self.nodes)
+        while True:
+            orphans = [a for a in self.nodes if a not in dropped and self.parent(a) in dropped]
+            if not orphans:
+                break
+            dropped.update(orphans)
+        for addr in dropped:
+            self.remove(addr)
+        return dropped
+
+    def next_classes(self, addr):
+        """ Addresses along the m_pNextClass list from addr, stopping at a loop """
+        result = []
+        seen = {addr}
+        cur = self.nodes[addr].pNextClass if addr in self.nodes else 0
+        while cur and cur not in seen:
+            result.append(cur)
+            seen.add(cur)
+            cur = self.nodes[cur].pNextClass if cur in self.nodes else 0
+        return result
+
+
+class DispatchTable(object):
+    """
+    Entries of a message map and its base maps in MFC lookup order.
+
+    find() gives the entry AfxFindMessageEntry would pick walking the maps:
+    the first whose nMessage and nCode match and whose nID..nLastID holds the
+    ID. Every ID of an entry spanning up to RANGE_EXPAND IDs gets a dict key,
+    wider ranges are checked in order against the exact hit.
+    """
+    RANGE_EXPAND = 256
+
+    def __init__(self, entries):
+        self.entries = entries      # [(map addr, MsgMapEntry), ...]
+        self.exact = {}             # (nMessage, nCode, nID) -> position of the first match
+        self.ranges = []            # positions of the wide range entries
+        for pos, (_, e) in enumerate(entries):
+            if e.nLastID < e.nID:
+                continue
+            if e.nLastID - e.nID < self.RANGE_EXPAND:
+                for nID in range(e.nID, e.nLastID + 1):
+                    self.exact.setdefault((e.nMessage, e.nCode, nID), pos)
+            else:
+                self.ranges.append(pos)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, nMessage, nCode=0, nID=0):
+        """ (map addr, MsgMapEntry) handling the message, None when no map has it """
+        pos = self.exact.get((nMessage, nCode, nID))
+        for rpos in self.ranges:
+            if pos is not None and rpos > pos:
+                break
+            e = self.entries[rpos][1]
+            if e.nMessage == nMessage and e.nCode == nCode and e.nID <= nID <= e.nLastID:
+                pos = rpos
+                break
+        return self.entries[pos] if pos is not None else None
+
+
+class IDRangeIndex(object):
+    """
+    Centered interval tree over the nID..nLastID spans of message map entries.
+
+    Each node keeps the spans holding its center sorted by first and by last
+    ID, so stab() and overlapping() cost O(log n + k) for k results. Items are
+    (nID, nLastID, map addr, MsgMapEntry); results come in map and entry order.
+    """
+    def __init__(self, items):
+        self.items = [item for item in items if item[0] <= item[1]]
+        self._root = self._build(list(range(len(self.items))))
+
+    def __len__(self):
+        return len(self.items)
+
+    def _build(self, indexes):
+        if not indexes:
+            return None
+        items = self.items
+        # median endpoint, either side then gets at most half of the spans
+        points = sorted([items[i][0] for i in indexes] + [items[i][1] for i in indexes])
+        center = points[len(points) // 2]
+        here, left, right = [], [], []
+        for i in indexes:
+            if items[i][1] < center:
+                left.append(i)
+            elif items[i][0] > center:
+                right.append(i)
+            else:
+                here.append(i)
+        by_first = sorted(here, key=lambda i: items[i][0])
+        by_last = sorted(here, key=lambda i: -items[i][1])
+        return (center,
+                [items[i][0] for i in by_first], by_first,
+                [-items[i][1] for i in by_last], by_last,
+                self._build(left), self._build(right))
+
+    def _result(self, found, nMessage):
+        found.sort()
+        return [self.items[i] for i in found if nMessage is None or self.items[i][3].nMessage == nMessage]
+
+    def stab(self, nID, nMessage=None):
+        """ Entries whose span holds nID, only those for nMessage when given """
+        found = []
+        node = self._root
+        while node is not None:
+            center, firsts, by_first, neg_lasts, by_last, left, right = node
+            if nID < center:
+                found.extend(by_first[:bisect.bisect_right(firsts, nID)])
+                node = left
+            elif nID > center:
+                found.extend(by_last[:bisect.bisect_right(neg_lasts, -nID)])
+                node = right
+            else:
+                found.extend(by_first)
+                break
+        return self._result(found, nMessage)
+
+    def overlapping(self, nID, nLastID, nMessage=None):
+        """ Entries whose span shares an ID with nID..nLastID, only those for nMessage when given """
+        found = []
+        todo = [self._root]
+        while todo:
+            node = todo.pop()
+            if node is None:
+                continue
+            center, firsts, by_first, neg_lasts, by_last, left, right = node
+            if nLastID < center:
+                found.extend(by_first[:bisect.bisect_right(firsts, nLastID)])
+                todo.append(left)
+            elif nID > center:
+                found.extend(by_last[:bisect.bisect_right(neg_lasts, -nID)])
+                todo.append(right)
+            else:
+                found.extend(by_first)
+                todo.append(left)
+                todo.append(right)
+        return self._result(found, nMessage)
+
+
+class MessageMapGraph(object):
+    """
+    AFX_MSGMAPs linked to their base maps, with a DispatchTable per map.
+
+    pBaseMap is the base AFX_MSGMAP in old static builds and its
+    GetThisMessageMap getter otherwise; a getter into the MFC DLL gives an
+    external base known by class name only. Base lookups and tables are
+    memoized, chains that loop are cut and remembered in self.cycles.
+    """
+    _imported_map = re.compile(r"^(?:__imp_|j_)?\?(?:GetThisMessageMap|messageMap)@(\w+)@@")
+
+    def __init__(self, msgmaps, ptrSize):
+        self.ptrSize = ptrSize
+        self.maps = collections.OrderedDict((m.addr, m) for m in msgmaps)
+        self.by_class = {}
+        for m in self.maps.values():
+            self.by_class.setdefault(self.class_name(m.addr), m.addr)
+        self.cycles = set()
+        self._base = {}             # map addr -> base map addr or None
+        self._external = {}         # map addr -> class name of a base outside the binary
+        self._tables = {}           # map addr -> DispatchTable
+
+    def __len__(self):
+        return len(self.maps)
+
+    def __contains__(self, addr):
+        return addr in self.maps
+
+    def class_name(self, addr):
+        """ Class of the map at addr as its name tells, CMainFrame for CMainFrame_MSGMAP """
+        name = self.maps[addr].name or ""
+        return name[:-len("_MSGMAP")] if name.endswith("_MSGMAP") else name
+
+    def lookup(self, cls):
+        """ Map address of cls, a map address or a class name; None when unknown """
+        if isinstance(cls, int):
+            return cls if cls in self.maps else None
+        return self.by_class.get(cls)
+
+    def base(self, addr):
+        """ Address of the base AFX_MSGMAP, None for a root or an external base """
+        if addr in self._base:
+            return self._base[addr]
+        pBaseMap = self.maps[addr].pBaseMap
+        base = None
+        if pBaseMap in self.maps:
+            base = pBaseMap
+        elif pBaseMap:
+            target, import_ea = Utils.decode_getter(pBaseMap, self.ptrSize)
+            if import_ea is not None:
+                m = self._imported_map.match(idc.get_name(import_ea, ida_name.GN_VISIBLE) or "")
+                if m is not None:
+                    self._external[addr] = m.group(1)
+            base = target
+        self._base[addr] = base
+        return base
+
+    def base_name(self, addr):
+        base = self.base(addr)
+        if base in self.maps:
+            return self.class_name(base)
+        return self._external.get(addr, "")
+
+    def chain(self, addr):
+        """ Map addresses from addr up to its root, in MFC lookup order """
+        result = [addr]
+        seen = {addr}
+        base = self.base(addr)
+        while base in self.maps:
+            if base in seen:
+                logger.warning("AFX_MSGMAP chain loops at 0x%x", base)
+                self.cycles.add(addr)
+                break
+            result.append(base)
+            seen.add(base)
+            base = self.base(base)
+        return result
+
+    def build(self):
+        """ Resolve every base map and build every DispatchTable, queries then read nothing from the IDB """
+        for addr in self.maps:
+            self.dispatch_table(addr)
+        return self
+
+    def dispatch_table(self, cls):
+        """ DispatchTable of the map of cls (see lookup), None when unknown """
+        addr = self.lookup(cls)
+        if addr is None:
+            return None
+        table = self._tables.get(addr)
+        if table is None:
+            table = self._tables[addr] = DispatchTable([(a, e) for a in self.chain(addr) for e in self.maps[a].entries])
+        return table
+
+
+class HandlerIndex(object):
+    """
+    Message map entries reaching each handler function, kept in a netnode so
+    the answer survives the session without rescanning.
+
+    Each handler EA owns one blob of packed HandlerEntry records, keyed by the
+    entry address so making a map again replaces its records. Blobs are read
+    on first lookup and written back by flush().
+    """
+    NETNODE = "$ AFX_MSGMAP handlers"
+    TAG = "H"
+    _record = struct.Struct("<QQIIII")
+
+    def __init__(self):
+        self.handlers = {}          # pfn -> OrderedDict entry addr -> HandlerEntry
+        self.dirty = set()
+        self._node = None
+
+    def node(self):
+        if self._node is None:
+            self._node = idaapi.netnode(self.NETNODE, 0, True)
+        return self._node
+
+    def _records(self, pfn):
+        records = self.handlers.get(pfn)
+        if records is None:
+            records = self.handlers[pfn] = collections.OrderedDict()
+            blob = self.node().getblob(pfn, self.TAG) or b""
+            size = self._record.size
+            for off in range(0, len(blob) - size + 1, size):
+                rec = HandlerEntry(*self._record.unpack_from(blob, off))
+                records[rec.entry_addr] = rec
+        return records
+
+    def add(self, pfn, map_addr, entry_addr, nMessage, nCode, nID, nLastID):
+        # nCode is signed in memory (CN_UPDATE_COMMAND_UI is -1)
+        self._records(pfn)[entry_addr] = HandlerEntry(map_addr, entry_addr, nMessage, nCode & 0xFFFFFFFF, nID, nLastID)
+        self.dirty.add(pfn)
+
+    def discard_maps(self, failed):
+        """ Drop the records not flushed yet of the entries from failed[map_addr] on """
+        for pfn in self.dirty:
+            records = self.handlers[pfn]
+            for entry_addr in [k for k, rec in records.items()
+                               if rec.map_addr in failed and rec.entry_addr >= failed[rec.map_addr]]:
+                del records[entry_addr]
+
+    def get(self, pfn):
+        """ HandlerEntry list of the entries reaching pfn, in the order they were made """
+        return list(self._records(pfn).values())
+
+    def flush(self):
+        """ Write the handlers changed since the last flush, return their count """
+        if not self.dirty:
+            return 0
+        node = self.node()
+        for pfn in sorted(self.dirty):
+            node.setblob(b"".join(self._record.pack(*rec) for rec in self.handlers[pfn].values()), pfn, self.TAG)
+        count = len(self.dirty)
+        self.dirty.clear()
+        return count
+
+class SegmentSnapshot(object):
+    """
+    Bytes of a segment pulled with one bulk read, decoded with precompiled structs.
+
+    Reads outside the snapshot (or in a segment IDA cannot read) fall back to
+    the regular idc calls, so results are the same as reading from the IDB.
+    """
+    def __init__(self, start_ea, end_ea, ptrSize):
+        self.start_ea = start_ea
+        self.end_ea = end_ea
+        self.ptrSize = ptrSize
+
+        buf = idc.get_bytes(start_ea, end_ea - start_ea) if end_ea > start_ea else None
+        self.buf = memoryview(buf if buf is not None else b"")
+
+        ptr = "Q" if ptrSize == 8 else "I"
+        self._dword = struct.Struct("<I")
+        self._ptr = struct.Struct("<" + ptr)
+        # AFX_MSGMAP: pfnGetBaseMap/pBaseMap, lpEntries
+        self._msgmap = struct.Struct("<" + ptr * 2)
+        # AFX_MSGMAP_ENTRY: nMessage, nCode, nID, nLastID, nSig, pfn
+        self._msg_entry = struct.Struct("<IIII" + ptr * 2)
+        # CRuntimeClass: m_lpszClassName, m_nObjectSize, m_wSchema, m_pfnCreateObject,
+        # m_pBaseClass/m_pfnGetBaseClass, m_pNextClass
+        self._runtime_class = struct.Struct("<" + ptr + "II" + ptr * 3)
+
+    def dword(self, ea):
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - 4:
+            return self._dword.unpack_from(self.buf, off)[0]
+        return idc.get_wide_dword(ea)
+
+    def ptr(self, ea):
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - self.ptrSize:
+            return self._ptr.unpack_from(self.buf, off)[0]
+        return AFXStructs.get_DWORD_PTR(ea)
+
+    def msgmap(self, ea):
+        """ Return (pBaseMap, lpEntries) of the AFX_MSGMAP at ea """
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - self._msgmap.size:
+            return self._msgmap.unpack_from(self.buf, off)
+        return AFXStructs.get_DWORD_PTR(ea, 0), AFXStructs.get_DWORD_PTR(ea, 1)
+
+    def msg_entry(self, ea):
+        """ Return (nMessage, nCode, nID, nLastID, nSig, pfn) of the AFX_MSGMAP_ENTRY at ea """
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - self._msg_entry.size:
+            return self._msg_entry.unpack_from(self.buf, off)
+        return (idc.get_wide_dword(ea + 0),
+                idc.get_wide_dword(ea + 4),
+                idc.get_wide_dword(ea + 8),
+                idc.get_wide_dword(ea + 12),
+                AFXStructs.get_DWORD_PTR(ea + 16),
+                AFXStructs.get_pfn(ea))
+
+    def runtime_class(self, ea):
+        """ Return (m_lpszClassName, m_nObjectSize, m_wSchema, m_pfnCreateObject, m_pBaseClass, m_pNextClass) at ea """
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - self._runtime_class.size:
+            return self._runtime_class.unpack_from(self.buf, off)
+        ps = self.ptrSize
+        return (AFXStructs.get_DWORD_PTR(ea),
+                idc.get_wide_dword(ea + ps),
+                idc.get_wide_dword(ea + ps + 4),
+                AFXStructs.get_DWORD_PTR(ea + ps + 8),
+                AFXStructs.get_DWORD_PTR(ea + 2 * ps + 8),
+                AFXStructs.get_DWORD_PTR(ea + 3 * ps + 8))
+
+    def unpack(self, ea, st):
+        """ Fields of st (a struct.Struct) at ea, None if not readable """
+        off = ea - self.start_ea
+        if 0 <= off <= len(self.buf) - st.size:
+            return st.unpack_from(self.buf, off)
+        buf = idc.get_bytes(ea, st.size)
+        if buf is None or len(buf) < st.size:
+            return None
+        return st.unpack(bytes(buf))
+
+    def get_bytes(self, ea, size):
+        """ size bytes at ea, fewer at the end of the database, None if not readable """
+        off = ea - self.start_ea
+        if 0 <= off < len(self.buf):
+            return self.buf[off:off + size]
+        return idc.get_bytes(ea, size)
+
+    # GetThisMessageMap bodies: mov eax, offset X; retn  /  lea rax, [rip+X]; ret
+    _getter32 = re.compile(b"(?=\\xB8(.{4})\\xC3)", re.DOTALL)
+    _getter64 = re.compile(b"(?=\\x48\\x8D\\x05(.{4})\\xC3)", re.DOTALL)
+
+    def getter_targets(self):
+        """ Return [(getter_ea, X), ...] for every "return &X" getter in the snapshot """
+        result = []
+        if self.ptrSize == 8:
+            for m in self._getter64.finditer(self.buf):
+                ea = self.start_ea + m.start()
+                disp = struct.unpack("<i", m.group(1))[0]
+                result.append((ea, (ea + 7 + disp) & 0xFFFFFFFFFFFFFFFF))
+        else:
+            for m in self._getter32.finditer(self.buf):
+                result.append((self.start_ea + m.start(), struct.unpack("<I", m.group(1))[0]))
+        return result
+
+    def msgmap_candidates(self, min_ea, max_ea, max_sig, func_starts=None, other_maps=False):
+        """
+        Run the first stage tests of Check_MSGMAP for every pointer aligned
+        address of the segment at once. func_starts is the sorted array of
+        FuncIndex, when given pBaseMap must be one of them or an aligned slot of
+        the segment (a static base map). other_maps also keeps the headers whose
+        first entry could start an AFX_MAP_TYPES table.
+
+        Return:
+            list of addresses worth a full Check_MSGMAP, or None when NumPy is
+            not available or the segment could not be read
+        """
+        ps = self.ptrSize
+        n = len(self.buf) // ps
+        if np is None or n < 2:
+            return None
+
+        u64 = np.uint64
+        ptrs = np.frombuffer(self.buf, dtype="<u8" if ps == 8 else "<u4", count=n).astype(u64)
+        raw = np.frombuffer(self.buf, dtype=np.uint8)
+
+        # slot k is AFX_MSGMAP at start_ea + k * ptrSize, lpEntries is ptrs[k + 1]
+        lpEntries = ptrs[1:]
+        keep = (lpEntries > u64(self.start_ea)) & (lpEntries < u64(self.end_ea))
+        if func_starts is not None and len(func_starts):
+            pBaseMap = ptrs[:-1]
+            pos = np.minimum(np.searchsorted(func_starts, pBaseMap), len(func_starts) - 1)
+            # a static base map is a slot of the segment whose own lpEntries is in range too
+            base_slot = (pBaseMap - u64(self.start_ea)) // u64(ps)
+            static_base = (pBaseMap >= u64(self.start_ea)) & (base_slot < u64(n - 1)) & \
+                          ((pBaseMap - u64(self.start_ea)) % u64(ps) == u64(0))
+            static_base[static_base] = keep[base_slot[static_base].astype(np.intp)]
+            keep &= (func_starts[pos] == pBaseMap) | static_base
+
+        # decode the first AFX_MSGMAP_ENTRY where it is inside the buffer,
+        # other in range slots are left to the scalar check
+        off = np.where(keep, lpEntries - u64(self.start_ea), u64(0))
+        sel = keep & (off + u64(self._msg_entry.size) <= u64(len(raw)))
+        offs = off[sel].astype(np.intp)
+
+        def dword_at(delta):
+            o = offs + delta
+            return raw[o].astype(u64) | (raw[o + 1].astype(u64) << u64(8)) | \
+                   (raw[o + 2].astype(u64) << u64(16)) | (raw[o + 3].astype(u64) << u64(24))
+
+        nSig = dword_at(16)
+        if ps == 8:
+            nSig = nSig | (dword_at(20) << u64(32))
+        ok = (dword_at(0) <= u64(0xFFFF)) & \
+             (dword_at(8) <= u64(0xFFFF)) & \
+             (dword_at(12) <= u64(0xFFFF)) & \
+             ((nSig <= u64(max_sig)) | ((nSig > u64(min_ea)) & (nSig < u64(max_ea))))
+        if other_maps:
+            # those entries start with a pointer (pguid, piid, lpszName) or NULL
+            first = dword_at(0)
+            if ps == 8:
+                first = first | (dword_at(4) << u64(32))
+            ok |= (first == u64(0)) | ((first > u64(min_ea)) & (first < u64(max_ea)))
+        keep[sel] = ok
+
+        candidates = (np.nonzero(keep)[0] * ps + self.start_ea).tolist()
+        # the last slot reads past the snapshot, leave it to the scalar path
+        candidates.extend(range(self.start_ea + (n - 1) * ps, self.end_ea, ps))
+        return candidates
+
+    def runtime_class_candidates(self, min_ea, max_ea, func_starts=None):
+        """
+        Run the field tests of Check_CRuntimeClass for every pointer aligned
+        address of the segment at once, the class name is left to the caller.
+
+        Return:
+            list of addresses worth a full Check_CRuntimeClass, or None when
+            NumPy is not available or the segment could not be read
+        """
+        ps = self.ptrSize
+        n = len(self.buf) // ps
+        # slots whose CRuntimeClass lies inside the buffer
+        slots = n - (4 * ps + 8) // ps + 1
+        if np is None or slots < 1:
+            return None
+
+        u64 = np.uint64
+        ptrs = np.frombuffer(self.buf, dtype="<u8" if ps == 8 else "<u4", count=n).astype(u64)
+        dwords = np.frombuffer(self.buf, dtype="<u4", count=len(self.buf) // 4).astype(u64)
+
+        def ptr_field(offset):
+            return ptrs[offset // ps:offset // ps + slots]
+
+        def dword_field(offset):
+            return dwords[offset // 4::ps // 4][:slots]
+
+        def in_image(v):
+            return (v > u64(min_ea)) & (v < u64(max_ea))
+
+        def is_func(v):
+            if func_starts is None or not len(func_starts):
+                return in_image(v)
+            pos = np.minimum(np.searchsorted(func_starts, v), len(func_starts) - 1)
+            return func_starts[pos] == v
+
+        nObjectSize = dword_field(ps)
+        wSchema = dword_field(ps + 4)
+        pfnCreateObject = ptr_field(ps + 8)
+        pBaseClass = ptr_field(2 * ps + 8)
+        pNextClass = ptr_field(3 * ps + 8)
+        keep = in_image(ptr_field(0)) & \
+               (nObjectSize > u64(0)) & (nObjectSize < u64(0x1000000)) & \
+               ((wSchema == u64(0xFFFF)) | ((wSchema & u64(0x7FFFFFFF)) <= u64(0xFFFF))) & \
+               ((pfnCreateObject == u64(0)) | is_func(pfnCreateObject)) & \
+               ((pBaseClass == u64(0)) | in_image(pBaseClass)) & \
+               ((pNextClass == u64(0)) | in_image(pNextClass))
+
+        candidates = (np.nonzero(keep)[0] * ps + self.start_ea).tolist()
+        # the last slots read past the snapshot, leave them to the scalar path
+        candidates.extend(range(self.start_ea + slots * ps, self.end_ea, ps))
+        return candidates
+
+
 class AFXMSGMAPSearchResultChooser(idaapi.Choose):
     def __init__(self, title, items, flags=0, width=None, height=None, embedded=False):
         idaapi.Choose.__init__(self,
@@ -1810,7 +3364,8 @@ class AFXMSGMAPSearchResultChooser(idaapi.Choose):
                                [["Index", idaapi.Choose.CHCOL_PLAIN|6],
                                 ["Address", idaapi.Choose.CHCOL_HEX|20],
                                 ["Name", idaapi.Choose.CHCOL_HEX|40],
-                                ["Entry Num", idaapi.Choose.CHCOL_HEX|10],],
+                                ["Entry Num", idaapi.Choose.CHCOL_HEX|10],
+                                ["Type", idaapi.Choose.CHCOL_PLAIN|20],],
                                flags=flags,
                                width=width,
                                height=height,
@@ -1828,7 +3383,7 @@ class AFXMSGMAPSearchResultChooser(idaapi.Choose):
 
     def OnGetLine(self, n):
         res = self.items[n]
-        res = [str(res[0]), idc.atoa(res[1]), res[2], str(res[3])]
+        res = [str(res[0]), idc.atoa(res[1]), res[2], str(res[3])] + [str(x) for x in res[4:]]
         return res
 
     def OnGetSize(self):
@@ -1838,6 +3393,41 @@ class AFXMSGMAPSearchResultChooser(idaapi.Choose):
         return self.Show() >= 0
 
 
+class AFXCRuntimeClassSearchResultChooser(AFXMSGMAPSearchResultChooser):
+    def __init__(self, title, items, flags=0, width=None, height=None, embedded=False):
+        idaapi.Choose.__init__(self,
+                               title,
+                               [["Index", idaapi.Choose.CHCOL_PLAIN|6],
+                                ["Address", idaapi.Choose.CHCOL_HEX|20],
+                                ["Name", idaapi.Choose.CHCOL_PLAIN|30],
+                                ["Base class", idaapi.Choose.CHCOL_PLAIN|30],],
+                               flags=flags,
+                               width=width,
+                               height=height,
+                               embedded=embedded)
+        self.items = items
+        self.selcount = 0
+        self.n = len(items)
+
+
+class AFXHandlerEntriesChooser(AFXMSGMAPSearchResultChooser):
+    def __init__(self, title, items, flags=0, width=None, height=None, embedded=False):
+        idaapi.Choose.__init__(self,
+                               title,
+                               [["Index", idaapi.Choose.CHCOL_PLAIN|6],
+                                ["Entry", idaapi.Choose.CHCOL_HEX|20],
+                                ["Map", idaapi.Choose.CHCOL_PLAIN|30],
+                                ["Message", idaapi.Choose.CHCOL_PLAIN|30],
+                                ["Code", idaapi.Choose.CHCOL_DEC|10],
+                                ["IDs", idaapi.Choose.CHCOL_PLAIN|16],],
+                               flags=flags,
+                               width=width,
+                               height=height,
+                               embedded=embedded)
+        self.items = items
+        self.selcount = 0
+        self.n = len(items)
+
 class AFXStructs(object):
     def __init__(self):
         self.min_ea = idc.get_inf_attr(idc.INF_MIN_EA)
@@ -1849,6 +3439,49 @@ class AFXStructs(object):
 
         # self.MSGStructSize = 32 if IS64 else 32       # 这写错了吧
         self.MSGStructSize = 16 + 2*self.ptrSize
+        # CRuntimeClass, CRuntimeClass_v7 adds m_pClassInit
+        self.CRTCSize = 8 + 4*self.ptrSize
+        self.CRTCSize_v7 = self.CRTCSize + self.ptrSize
+        # (size_t)-1, ends several map tables
+        self.ptrMax = (1 << (8 * self.ptrSize)) - 1
+
+        # empty snapshot, every read goes through idc
+        self.no_snapshot = SegmentSnapshot(0, 0, self.ptrSize)
+        # take candidates from relocation fixups when the binary has them
+        self.use_fixups = True
+        # prefilter candidates with NumPy when it is importable inside IDA
+        self.use_numpy = np is not None
+        # function start index, only alive during a scan
+        self.func_index = None
+        # timings of the last scan
+        self.stats = ScanStats()
+        # MsgMap of every AFX_MSGMAP made since the last Search_MSGMAP
+        self.msgmaps = []
+        # Search_MSGMAP also finds the AFX_MAP_TYPES tables, collected in afx_maps
+        self.search_other_maps = True
+        self.afx_maps = []
+        # JSONLinesExporter fed by Make_MSG_ENTRY and Make_AFX_MAP, see Search_MSGMAP(export=...);
+        # without keep_maps msgmaps, afx_maps and the result rows stay empty, an export turns it off
+        self.exporter = None
+        self.keep_maps = True
+        # GUIDs looked up in iid_index by Make_AFX_MAP
+        self.named_guids = set()
+        # IDBWriteBatch collecting the writes of the running Make/Search, see write_batch()
+        self.batch = None
+        # ResolveCache for the class naming, only alive during a scan
+        self.resolve_cache = None
+        # RTTIIndex, built on first use by get_rtti()
+        self.rtti = None
+        # MessageMapGraph over msgmaps, built on first use by get_msgmap_graph()
+        self.msgmap_graph = None
+        # IDRangeIndex over msgmaps, built on first use by get_id_index()
+        self.id_index = None
+        # RuntimeClass of every CRuntimeClass found by the last Search_CRuntimeClass
+        self.runtime_classes = []
+        # HandlerIndex filled by Make_MSG_ENTRY, saved to the IDB when a write batch ends
+        self.handler_index = HandlerIndex()
+        # RuntimeClassGraph of the last Search_CRuntimeClass or Make_CRuntimeClass_Tree
+        self.class_graph = None
 
     @staticmethod
     def mt_rva():
@@ -2035,9 +3668,9 @@ class AFXStructs(object):
 
     def add_WM_MESSAGES_enum(self):
         eid = Utils.force_add_enum(S_WM_MESSAGES, idaapi.hex_flag())
-        for msg in MSG_TABLES:
-            msg_id, msg_name = msg
-            idc.add_enum_member(eid, msg_name, msg_id, idc.BADADDR)
+        for msg_id, msg_names in msg_registry.items():
+            for msg_name in msg_names:
+                idc.add_enum_member(eid, msg_name, msg_id, idc.BADADDR)
 
     def add_AFX_enums(self):
         eid = Utils.force_add_enum(S_CN_ENUM, idc.FF_0NUMH | idaapi.FF_SIGN)
@@ -2058,13 +3691,12 @@ class AFXStructs(object):
 
     @staticmethod
     def GetMsgName(mid):
-        ret = []
-        for msg_id, msg_name in MSG_TABLES:
-            if msg_id == mid:
-                ret.append(msg_name)
-        if not ret:
-            ret.append("WM_UNKNOWN_0x%X" % mid)
-        return ret
+        return msg_registry.get(mid)
+
+    @staticmethod
+    def GetSigName(nSig):
+        """ (name, type) of AfxSig nSig, empty for ON_REGISTERED_MESSAGE which keeps a pointer there """
+        return AfxSig[nSig] if nSig < len(AfxSig) else ("", "")
 
     @staticmethod
     def get_DWORD_PTR(addr, offset=0):
@@ -2081,98 +3713,126 @@ class AFXStructs(object):
         else:
             idc.create_data(addr, idc.FF_0OFF | idc.FF_REF | idc.FF_DWORD, 4, idc.BADADDR)
 
-    def Check_MSGMAP(self, addr, seg_start_ea, seg_end_ea):
-        pBaseMap = self.get_DWORD_PTR(addr, 0)
-        if not idaapi.get_func(pBaseMap):
-            logger.debug("BaseMap addr %x not in range" %pBaseMap)
-            return 0
+    def is_func_start(self, ea):
+        if self.func_index is not None:
+            return ea in self.func_index
+        pfn = idaapi.get_func(ea)
+        return pfn is not None and pfn.start_ea == ea
 
-        lpEntries = self.get_DWORD_PTR(addr, 1)
+    def _is_static_base_map(self, addr, pBaseMap, seg_start_ea, seg_end_ea, snapshot):
+        """
+        Whether pBaseMap points at an AFX_MSGMAP in the segment, as in the builds
+        before MFC 7 without _AFXDLL where pBaseMap is &baseClass::messageMap
+        """
+        if pBaseMap == addr or not seg_start_ea <= pBaseMap < seg_end_ea or (pBaseMap - seg_start_ea) % self.ptrSize:
+            return False
+        base_base, base_entries = snapshot.msgmap(pBaseMap)
+        if not seg_start_ea < base_entries < seg_end_ea:
+            return False
+        # CCmdTarget::messageMap ends the chain with NULL
+        if base_base and not self.is_func_start(base_base) and not seg_start_ea <= base_base < seg_end_ea:
+            return False
+        return self.Check_MSG_ENTRY(base_entries, snapshot) != 0
+
+    def Check_MSGMAP(self, addr, seg_start_ea, seg_end_ea, snapshot=None):
+        # called for every candidate address, debug messages are only built when enabled
+        dbg = logger.debug_enabled
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        pBaseMap, lpEntries = snapshot.msgmap(addr)
+
+        # range check first, it is cheap and rejects almost every address
         if not seg_start_ea < lpEntries < seg_end_ea:
-            logger.debug("lpEntries addr %x not in range" %lpEntries)
+            if dbg:
+                logger.debug("lpEntries addr %x not in range", lpEntries)
+            return 0
+
+        if not self.is_func_start(pBaseMap) and not self._is_static_base_map(addr, pBaseMap, seg_start_ea, seg_end_ea, snapshot):
+            if dbg:
+                logger.debug("BaseMap addr %x not in range", pBaseMap)
             return 0
 
-        if self.Check_MSG_ENTRY(lpEntries) == 0:
-            logger.debug("MSG_ENTRY not correct")
+        if self.Check_MSG_ENTRY(lpEntries, snapshot) == 0:
+            if dbg:
+                logger.debug("MSG_ENTRY not correct")
             return 0
 
-        if idc.get_wide_dword(lpEntries + 0) == 0 and \
-            (idc.get_wide_dword(lpEntries + 4) != 0 or
-             idc.get_wide_dword(lpEntries + 8) != 0 or
-             idc.get_wide_dword(lpEntries + 12) != 0 or
-             self.get_DWORD_PTR(lpEntries + 16) != 0 or
-             self.get_pfn(lpEntries) != 0):
-            logger.debug("struct AFX_MSGMAP_ENTRY not fix at %x" %lpEntries)
+        entry = snapshot.msg_entry(lpEntries)
+        if entry[0] == 0 and any(entry[1:]):
+            if dbg:
+                logger.debug("struct AFX_MSGMAP_ENTRY not fix at %x", lpEntries)
             return 0
 
         if idaapi.get_name(addr) == "":
             if idaapi.get_name(pBaseMap) == "":
-                logger.debug("pBaseMap No name: %x" %pBaseMap)
+                if dbg:
+                    logger.debug("pBaseMap No name: %x", pBaseMap)
                 return 0
-            logger.debug("Screen addr No name: %x" %addr)
+            if dbg:
+                logger.debug("Screen addr No name: %x", addr)
             return -1
 
-        if idaapi.get_name(pBaseMap)[0:18] == "?GetThisMessageMap":
-            logger.debug("Found Name ?GetThisMessageMap at %x" %pBaseMap)
+        base_name = idaapi.get_name(pBaseMap)
+        if base_name[0:18] == "?GetThisMessageMap" or base_name[0:12] == "?messageMap@":
+            if dbg:
+                logger.debug("Found Name %s at %x", base_name, pBaseMap)
             return 1
 
         while lpEntries < self.max_ea:
-            if  idc.get_wide_dword(lpEntries + 0) == 0 and \
-                idc.get_wide_dword(lpEntries + 4) == 0 and \
-                idc.get_wide_dword(lpEntries + 8) == 0 and \
-                idc.get_wide_dword(lpEntries + 12) == 0 and \
-                self.get_DWORD_PTR(lpEntries + 16) == 0 and \
-                self.get_pfn(lpEntries) == 0:
+            entry = snapshot.msg_entry(lpEntries)
+            if not any(entry):
                 return 1
 
-            if self.Check_MSG_ENTRY(lpEntries) == 0:
-                logger.debug("Check MSG_ENTRY failed")
+            if self.Check_MSG_ENTRY(lpEntries, snapshot) == 0:
+                if dbg:
+                    logger.debug("Check MSG_ENTRY failed")
                 return 0
 
-            msgfun_addr = self.get_pfn(lpEntries)
+            msgfun_addr = entry[5]
             if not self.min_ea < msgfun_addr < self.max_ea:
-                logger.debug("msgfun_addr %x not in range" %msgfun_addr)
+                if dbg:
+                    logger.debug("msgfun_addr %x not in range", msgfun_addr)
                 return 0
 
             lpEntries = lpEntries + self.MSGStructSize
-        logger.debug("Cannot find end of MSG_ENTRY")
+        if dbg:
+            logger.debug("Cannot find end of MSG_ENTRY")
         return 0
 
-    def Check_MSG_ENTRY(self, entry):
+    def Check_MSG_ENTRY(self, entry, snapshot=None):
+        dbg = logger.debug_enabled
+        self.stats.count("Check_MSG_ENTRY")
         if entry == idc.BADADDR:
-            logger.debug("entry address %x incorrect" %entry)
+            if dbg:
+                logger.debug("entry address %x incorrect", entry)
             return 0
-        else:
-            logger.debug("MSG_ENTRY at %x" %entry)
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        nMessage, _, nID, nLastID, nSig, _ = snapshot.msg_entry(entry)
+        if dbg:
+            logger.debug("MSG_ENTRY at %x: nMessage %d, nID %d, nLastID %d, nSig %d",
+                         entry, nMessage, nID, nLastID, nSig)
         # Check nMessage
-        nMessage = idc.get_wide_dword(entry)
         if nMessage > 0xFFFF:
-            logger.debug("nMessage %d out of range at address %x" %(nMessage, entry))
+            if dbg:
+                logger.debug("nMessage %d out of range at address %x", nMessage, entry)
             return 0
-        else:
-            logger.debug("nMessage %d at %x" %(nMessage, entry))
         # Check nID
-        nID = idc.get_wide_dword(entry + 8)
         if nID > 0xFFFF:
-            logger.debug("nID %d out of range at address %x" %(nID, entry+8))
+            if dbg:
+                logger.debug("nID %d out of range at address %x", nID, entry+8)
             return 0
-        else:
-            logger.debug("nID %d at %x" %(nID, entry+8))
         # Check nLastID
-        nLastID = idc.get_wide_dword(entry + 12)
         if nLastID > 0xFFFF:
-            logger.debug("nLastID %d out of range at address %x" %(nLastID, entry+12))
+            if dbg:
+                logger.debug("nLastID %d out of range at address %x", nLastID, entry+12)
             return 0
-        else:
-            logger.debug("nLastID %d at %x" %(nLastID, entry+12))
         # Check nSig
-        nSig = self.get_DWORD_PTR(entry + 16)
         if nSig > len(AfxSig) + 20:  # + 20 for future MFC new AfxSig
             if not self.min_ea < nSig < self.max_ea:  # point message
-                logger.debug("nSig %d out of range at address %x" %(nSig, entry+16))
+                if dbg:
+                    logger.debug("nSig %d out of range at address %x", nSig, entry+16)
                 return 0
-        else:
-            logger.debug("nSig %d at %x" %(nSig, entry+16))
 
         return 1
 
@@ -2187,164 +3847,612 @@ class AFXStructs(object):
                     break
         return name_lst
 
-    def Make_MSG_ENTRY(self, addr):
-        msgmapSize = 0
-        pBaseMap = self.get_DWORD_PTR(addr, 0)
-        lpEntries = self.get_DWORD_PTR(addr, 1)
-
-        idc.create_struct(addr, -1, S_MSGMAP)
-        if idc.get_name(addr) in ("off_%lX" % addr, ""):
-            idc.set_name(addr, "msgEntries_%lX" % (addr))
-
-        pEntry = lpEntries
-        while idc.get_wide_dword(pEntry) != 0:
-            idc.del_items(pEntry, idc.DELIT_SIMPLE, self.MSGStructSize)
-            if idc.create_struct(pEntry, self.MSGStructSize, S_MSGMAP_ENTRY) == 0:
-                print("Create %s failed at %X" % (S_MSGMAP_ENTRY, pEntry))
-                return 0
+    @contextlib.contextmanager
+    def write_batch(self):
+        """ Collect the IDB writes of the block in self.batch, a nested block joins the outer one """
+        if self.batch is not None:
+            yield self.batch
+            return
+        self.batch = IDBWriteBatch(self.stats)
+        try:
+            yield self.batch
+        finally:
+            batch, self.batch = self.batch, None
+            failed = batch.apply()
+            if failed:
+                # as if their Make had stopped at the failed struct, the entries made before it stay in the IDB
+                self.msgmaps = [m for m in self.msgmaps if m.addr not in failed]
+                self.afx_maps = [m for m in self.afx_maps if m.addr not in failed]
+                self.msgmap_graph = None
+                self.id_index = None
+                self.handler_index.discard_maps(failed)
+            if self.exporter is not None:
+                self.exporter.commit(failed)
+            t0 = self.stats.clock()
+            count = self.handler_index.flush()
+            if count:
+                self.stats.add("handler index", t0, count)
+
+    def get_rtti(self):
+        """ RTTIIndex of the database, built once on first use """
+        if self.rtti is None:
+            t0 = self.stats.clock()
+            self.rtti = RTTIIndex(self.ptrSize).build()
+            self.stats.add("rtti index", t0, len(self.rtti.vtables))
+        return self.rtti
+
+    def get_msgmap_graph(self):
+        """ MessageMapGraph of the maps in self.msgmaps, built on first use after they change """
+        if self.msgmap_graph is None:
+            t0 = self.stats.clock()
+            self.msgmap_graph = MessageMapGraph(self.msgmaps, self.ptrSize)
+            self.stats.add("message map graph", t0, len(self.msgmap_graph))
+        return self.msgmap_graph
+
+    def get_id_index(self):
+        """ IDRangeIndex of the entries in self.msgmaps with a control or command ID """
+        if self.id_index is None:
+            t0 = self.stats.clock()
+            self.id_index = IDRangeIndex([(e.nID, e.nLastID, m.addr, e)
+                                          for m in self.msgmaps for e in m.entries if e.nID or e.nLastID])
+            self.stats.add("ID range index", t0, len(self.id_index))
+        return self.id_index
+
+    def Build_Dispatch_Index(self):
+        """ Precompute the DispatchTable of every map found so far for Find_Message_Entry """
+        graph = self.get_msgmap_graph()
+        t0 = self.stats.clock()
+        graph.build()
+        self.stats.add("dispatch index", t0, len(graph))
+        return graph
+
+    def Find_Message_Entry(self, cls, nMessage, nCode=0, nID=0):
+        """
+        Like MFC's AfxFindMessageEntry walking the maps of cls and its bases.
+        cls is a class name or the address of its AFX_MSGMAP, nCode -1 is CN_UPDATE_COMMAND_UI.
 
-            msgNames = self.GetMsgName(idc.get_wide_dword(pEntry + 0))
-            for msgName in msgNames:
-                str_funcmt = "MSG function: " + msgName + "\n"
-            str_funcmt += "    nMessage: " + ("0x%X" % idc.get_wide_dword(pEntry + 0)) + "\n"
-            str_funcmt += "       nCode: " + str(idc.get_wide_dword(pEntry + 4)) + "\n"
-            str_funcmt += "         nID: " + str(idc.get_wide_dword(pEntry + 8)) + " - " + str(idc.get_wide_dword(pEntry + 12))
-
-            func_startEa = self.get_pfn(pEntry)
-            pfn = idaapi.get_func(func_startEa)
-            if pfn is None:
-                idc.del_items(func_startEa, idc.DELIT_SIMPLE)
-                idaapi.add_func(func_startEa)
-                pfn = idaapi.get_func(func_startEa)
-
-            idaapi.set_func_cmt(pfn, str_funcmt, 0)
-            oldname = idaapi.get_func_name(func_startEa)
-            if oldname == "sub_%lX" % (func_startEa):
-                newname = ""
-                if idc.get_wide_dword(pEntry + 8) == idc.get_wide_dword(pEntry + 12):
-                    if idc.get_wide_dword(pEntry + 8) != 0:
-                        newname = "On_%s_%X_%u" % (msgName, func_startEa, idc.get_wide_dword(pEntry + 8))
+        Return:
+            MessageHandler, None when cls is unknown or nothing handles the message
+        """
+        graph = self.get_msgmap_graph()
+        table = graph.dispatch_table(cls)
+        if table is None:
+            return None
+        hit = table.find(nMessage, nCode & 0xFFFFFFFF, nID)
+        if hit is None:
+            return None
+        map_addr, entry = hit
+        sig_name, sig_type = self.GetSigName(entry.nSig)
+        return MessageHandler(entry.pfn, entry.nSig, sig_name, sig_type, map_addr, graph.class_name(map_addr), entry)
+
+    def Show_Handler_Entries(self, ea=None):
+        """
+        List the message map entries reaching the function at ea (default: screen ea)
+        from the handler index, nothing is rescanned.
+
+        Return:
+            HandlerEntry list
+        """
+        if ea is None:
+            ea = idc.get_screen_ea()
+        func = idaapi.get_func(ea)
+        pfn = func.start_ea if func is not None else ea
+        records = self.handler_index.get(pfn)
+        if not records:
+            print("No AFX_MSGMAP entry reaches 0x%X, make or search the maps first\n" % pfn)
+            return records
+
+        values = []
+        for i, rec in enumerate(records):
+            msg_name = self.GetMsgName(rec.nMessage)[0]
+            map_name = idc.get_name(rec.map_addr, ida_name.GN_VISIBLE) or "%X" % rec.map_addr
+            ids = "%u" % rec.nID if rec.nID == rec.nLastID else "%u - %u" % (rec.nID, rec.nLastID)
+            code = rec.nCode - 0x100000000 if rec.nCode & 0x80000000 else rec.nCode
+            print("0x%X: %s %s nCode %d IDs %s (entry 0x%X)" % (pfn, map_name, msg_name, code, ids, rec.entry_addr))
+            values.append([i, rec.entry_addr, map_name, msg_name, code, ids])
+        if values:
+            c = AFXHandlerEntriesChooser("AFX_MSGMAP entries of %X" % pfn, values)
+            c.show()
+        return records
+
+    def Make_MSG_ENTRY(self, addr, snapshot=None):
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        msgmapSize = 0
+        pBaseMap, lpEntries = snapshot.msgmap(addr)
+
+        with self.write_batch() as batch, batch.map_writes(addr):
+            batch.create_struct(addr, -1, S_MSGMAP)
+            map_name = idc.get_name(addr)
+            if map_name in ("off_%lX" % addr, ""):
+                map_name = "msgEntries_%lX" % (addr)
+                batch.set_name(addr, map_name)
+
+            entries = []
+            exported = [] if self.exporter is not None else None
+            pEntry = lpEntries
+            while True:
+                entry = snapshot.msg_entry(pEntry)
+                nMessage, nCode, nID, nLastID, _, func_startEa = entry
+                if nMessage == 0:
+                    break
+                entries.append(MsgMapEntry(*entry))
+
+                batch.create_struct(pEntry, self.MSGStructSize, S_MSGMAP_ENTRY)
+
+                msgNames = self.GetMsgName(nMessage)
+                for msgName in msgNames:
+                    str_funcmt = "MSG function: " + msgName + "\n"
+                str_funcmt += "    nMessage: " + ("0x%X" % nMessage) + "\n"
+                str_funcmt += "       nCode: " + str(nCode) + "\n"
+                str_funcmt += "         nID: " + str(nID) + " - " + str(nLastID)
+
+                if not batch.has_func(func_startEa):
+                    batch.add_func(func_startEa)
+                    if self.func_index is not None:
+                        self.func_index.add(func_startEa)
+
+                batch.set_func_cmt(func_startEa, str_funcmt)
+                if nID == nLastID:
+                    if nID != 0:
+                        newname = "On_%s_%X_%u" % (msgName, func_startEa, nID)
                     else:
                         newname = "On_%s_%X" % (msgName, func_startEa)
                 else:
-                    newname = "On_%s_%X_%u_to_%u" % (msgName, func_startEa, idc.get_wide_dword(pEntry + 8), idc.get_wide_dword(pEntry + 12))
-
-                idc.set_name(func_startEa, newname)
+                    newname = "On_%s_%X_%u_to_%u" % (msgName, func_startEa, nID, nLastID)
+                # only replaces the dummy sub_XXX name
+                batch.rename_func(func_startEa, newname)
+                self.handler_index.add(func_startEa, addr, pEntry, nMessage, nCode, nID, nLastID)
+                if exported is not None:
+                    sig_name, sig_type = self.GetSigName(entry[4])
+                    exported.append({
+                        "addr": pEntry,
+                        "message": msgNames[0],
+                        "nMessage": nMessage,
+                        "nCode": nCode,
+                        "nID": nID,
+                        "nLastID": nLastID,
+                        "nSig": entry[4],
+                        "sig": sig_name,
+                        "sig_type": sig_type,
+                        "pfn": func_startEa,
+                        "handler": batch.func_name(func_startEa),
+                    })
+
+                pEntry = pEntry + self.MSGStructSize
+
+            # AFX_MSG_END
+            batch.create_struct(pEntry, self.MSGStructSize, S_MSGMAP_ENTRY)
+            msgmapSize = pEntry - lpEntries + self.MSGStructSize
+
+            # corresponding to class
+            t0 = self.stats.clock()
+            class_name, ref_addr_lst = self._resolve_MSGMAP_class(addr)
+            self.stats.add("class name", t0)
+
+            if len(class_name):
+                # change the MSGMAP name
+                new_name = "%s_MSGMAP"%class_name
+                batch.set_name(addr, new_name, idc.SN_CHECK)
+                logger.info("Rename addr 0x%x to %s", addr, new_name)
+                map_name = new_name
+
+                # change the GetMessage func name
+                getmessage_func = ref_addr_lst[0]
+                cur_name = idc.get_name(getmessage_func, ida_name.GN_VISIBLE)
+                if cur_name and cur_name.startswith("sub_"):
+                    func_name = "GetMessage_%s" %class_name
+                    batch.set_name(getmessage_func, func_name, idc.SN_CHECK)
+                    logger.info("Rename %s at addr 0x%x to %s", cur_name, getmessage_func, func_name)
+
+                if len(ref_addr_lst) > 1:
+                    getmessage_wrapper_func = ref_addr_lst[1]
+                    cur_name = idc.get_name(getmessage_wrapper_func, ida_name.GN_VISIBLE)
+                    if cur_name and cur_name.startswith("sub_"):
+                        func_name = "j_GetMessage_%s" %class_name
+                        batch.set_name(getmessage_wrapper_func, func_name, idc.SN_CHECK)
+                        logger.info("Rename %s at addr 0x%x to %s", cur_name, getmessage_wrapper_func, func_name)
+
+        if exported is not None:
+            self.exporter.write({"type": "MSGMAP", "addr": addr, "name": map_name, "class": class_name,
+                                 "base_map": pBaseMap, "entries": exported})
+        # inside a Search_MSGMAP batch the name is read again once it is applied
+        if self.keep_maps:
+            self.msgmaps.append(MsgMap(addr, idc.get_name(addr, ida_name.GN_VISIBLE), pBaseMap, lpEntries, tuple(entries)))
+        self.msgmap_graph = None
+        self.id_index = None
+        return msgmapSize
 
-            pEntry = pEntry + self.MSGStructSize
+    def _resolve_MSGMAP_class(self, addr):
+        """
+        Follow AFX_MSGMAP <- GetMessageMap <- vtable slot and take the class
+        name from the named item in front of the slot.
 
-        # AFX_MSG_END
-        idc.del_items(pEntry, idc.DELIT_SIMPLE, self.MSGStructSize)
-        idc.create_struct(pEntry, self.MSGStructSize, S_MSGMAP_ENTRY)
-        msgmapSize = pEntry - lpEntries + self.MSGStructSize
-        
-        # corresponding to class
-        xref_1 = [i for i in idautils.XrefsTo(addr)]
+        Return:
+            (class_name, ref_addr_lst), class_name is "" when not found
+        """
+        # a Search_MSGMAP run shares one cache, a single Make uses a fresh one
+        cache = self.resolve_cache if self.resolve_cache is not None else ResolveCache()
+        class_name = ""
+        ref_addr_lst = []
+        xref_1 = cache.xrefs_to(addr)
         if len(xref_1) == 1:
             data_seg_start = idc.get_segm_start(addr)
             data_seg_end = idc.get_segm_end(addr)
-            new_addr = xref_1[0].frm
-            addr_set = set()                # to prevent loop reference
-            flag = False                    # mark if we have found a address in vtable
-            vtable_item = None
-            ref_addr_lst = [new_addr]
-            loop_num = 0
-            max_loop_num = 5                # deref 5 layer at most
-            while True:
-                new_xref = [i for i in idautils.XrefsTo(new_addr)]
-                if len(new_xref) == 1:
-                    new_addr = new_xref[0].frm
-                    ref_addr_lst.append(new_addr)
-                    if data_seg_start <= new_addr and new_addr < data_seg_end:
-                        # if refaddr in data segment
-                        flag = True
-                        vtable_item = new_addr
-                    else:
-                        # if refaddr in code segment
-                        if new_addr in addr_set:
-                            break                   # find loop ref
-                        else:
-                            addr_set.add(new_addr)
-                        loop_num += 1
-                        if loop_num >= max_loop_num:
-                            break
-                else:
-                    # more the one xref, ignore it
-                    break
+            ref_addr_lst, vtable_item, addr_set = self._follow_MSGMAP_getter(cache, xref_1[0], data_seg_start, data_seg_end)
+            if vtable_item is not None:
+                # RTTI names the vtable without relying on names in the IDB
+                class_name = self.get_rtti().class_of_slot(vtable_item)
+                if not class_name:
+                    class_name = self._vtable_class_name(cache, vtable_item)
+            else:
+                logger.debug("xref %s not found", ["%x"%i for i in addr_set])
+        else:
+            logger.debug("xref_1 %x not found", addr)
+
+        return class_name, ref_addr_lst
+
+    def _follow_MSGMAP_getter(self, cache, new_addr, data_seg_start, data_seg_end):
+        """
+        Follow the single xrefs up from the GetMessageMap reference at new_addr
+        until one comes from the data segment (the vtable slot).
 
-            if flag:
-                class_name = ""
-                cur_addr = vtable_item
-                max_item_num = 100
-                item_num = 0
-                while True:
-                    cur_addr = idc.prev_head(cur_addr)
-                    if idc.get_func_attr(cur_addr, idc.FUNCATTR_FLAGS) != -1:       # prev address is a function
-                        class_name = idc.get_name(cur_addr, ida_name.GN_VISIBLE)
-                        if len(class_name):     # if is a named address
-                            break               # get the class name
+        Return:
+            (ref_addr_lst, vtable_item, addr_set), vtable_item is None when not found
+        """
+        key = (new_addr, data_seg_start, data_seg_end)
+        result = cache.getters.get(key)
+        if result is not None:
+            self.stats.count("class name cache hits")
+            return result
+
+        addr_set = set()                # to prevent loop reference
+        vtable_item = None              # set once we have found a address in vtable
+        ref_addr_lst = [new_addr]
+        loop_num = 0
+        max_loop_num = 5                # deref 5 layer at most
+        while True:
+            new_xref = cache.xrefs_to(new_addr)
+            if len(new_xref) == 1:
+                new_addr = new_xref[0]
+                ref_addr_lst.append(new_addr)
+                if data_seg_start <= new_addr and new_addr < data_seg_end:
+                    # if refaddr in data segment
+                    vtable_item = new_addr
+                else:
+                    # if refaddr in code segment
+                    if new_addr in addr_set:
+                        break                   # find loop ref
                     else:
-                        break                   # if is not a function
-                    
-                    item_num += 1
-                    if item_num >= max_item_num:
+                        addr_set.add(new_addr)
+                    loop_num += 1
+                    if loop_num >= max_loop_num:
                         break
+            else:
+                # more the one xref, ignore it
+                break
+
+        result = cache.getters[key] = (tuple(ref_addr_lst), vtable_item, addr_set)
+        return result
+
+    def _vtable_class_name(self, cache, vtable_item):
+        """ Class name from the named item in front of vtable_item, "" when not found """
+        class_name = cache.class_names.get(vtable_item)
+        if class_name is not None:
+            return class_name
+
+        class_name = ""
+        visited = [vtable_item]
+        cur_addr = vtable_item
+        max_item_num = 100
+        item_num = 0
+        while True:
+            cur_addr = idc.prev_head(cur_addr)
+            class_name = cache.class_names.get(cur_addr)
+            if class_name is not None:
+                # walked into the slots of a vtable resolved before
+                break
+            class_name = ""
+            visited.append(cur_addr)
+            if idc.get_func_attr(cur_addr, idc.FUNCATTR_FLAGS) != -1:       # prev address is a function
+                class_name = idc.get_name(cur_addr, ida_name.GN_VISIBLE)
+                if len(class_name):     # if is a named address
+                    class_name = self._demangle_class_name(class_name)
+                    break               # get the class name
+            else:
+                break                   # if is not a function
 
-                if len(class_name):
-                    # change the MSGMAP name
-                    breakpoint()
-                    class_demangle_name = idc.demangle_name(class_name, 0)
-                    getname_flag = False
-                    try:
-                        tmp_name_lst = class_demangle_name.split(" ")
-                        if len(tmp_name_lst) > 1:
-                            tmp_name_lst = tmp_name_lst[1].split(":")
-                            if len(tmp_name_lst):
-                                class_name = tmp_name_lst[0]
-                                getname_flag = True
-                    except:
-                        pass
-                    if not getname_flag:
-                        name_lst = self._get_class_name(class_name)
-                        class_name = max(name_lst, key=len)
-                    new_name = "%s_MSGMAP"%class_name
-                    idc.set_name(addr, new_name, idc.SN_CHECK)
-                    logger.info("Rename addr 0x%x to %s" %(addr, new_name))
-                    
-                    # change the GetMessage func name
-                    getmessage_func = ref_addr_lst[0]
-                    cur_name = idc.get_name(getmessage_func, ida_name.GN_VISIBLE)
-                    if cur_name and cur_name.startswith("sub_"):
-                        func_name = "GetMessage_%s" %class_name
-                        idc.set_name(getmessage_func, func_name, idc.SN_CHECK)
-                        logger.info("Rename %s at addr 0x%x to %s" %(cur_name, getmessage_func, func_name))
-
-                    if len(ref_addr_lst) > 1:
-                        getmessage_wrapper_func = ref_addr_lst[1]
-                        cur_name = idc.get_name(getmessage_wrapper_func, ida_name.GN_VISIBLE)
-                        if cur_name and cur_name.startswith("sub_"):
-                            func_name = "j_GetMessage_%s" %class_name
-                            idc.set_name(getmessage_wrapper_func, func_name, idc.SN_CHECK)
-                            logger.info("Rename %s at addr 0x%x to %s" %(cur_name, getmessage_wrapper_func, func_name))
+            item_num += 1
+            if item_num >= max_item_num:
+                break
+
+        for ea in visited:
+            cache.class_names[ea] = class_name
+        return class_name
+
+    def _demangle_class_name(self, class_name):
+        class_demangle_name = idc.demangle_name(class_name, 0)
+        getname_flag = False
+        try:
+            tmp_name_lst = class_demangle_name.split(" ")
+            if len(tmp_name_lst) > 1:
+                tmp_name_lst = tmp_name_lst[1].split(":")
+                if len(tmp_name_lst):
+                    class_name = tmp_name_lst[0]
+                    getname_flag = True
+        except:
+            pass
+        if not getname_flag:
+            name_lst = self._get_class_name(class_name)
+            class_name = max(name_lst, key=len)
+        return class_name
+
+    def Check_AFX_MAP(self, addr, seg_start_ea, seg_end_ea, snapshot=None):
+        """
+        Return (maptype, entries) of the AFX_MAP_TYPES table at addr, None when there is none.
+        A table without entries only counts when the base map getter is named after its kind.
+        """
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        self.stats.count("Check_AFX_MAP")
+        pBaseMap, lpEntries = snapshot.msgmap(addr)
+        if not seg_start_ea < lpEntries < seg_end_ea or not self.is_func_start(pBaseMap):
+            return None
+
+        matches = []
+        for maptype in AFX_MAP_TYPES:
+            header = snapshot.unpack(addr, maptype.layout(self.ptrSize)[0])
+            if header is None or not all(self.min_ea < p < self.max_ea for p in header[2:]):
+                continue
+            entries = self._AFX_MAP_entries(maptype, lpEntries, seg_end_ea, snapshot)
+            if entries is None:
+                continue
+            named = maptype.getter in (idc.get_name(pBaseMap, ida_name.GN_VISIBLE) or "")
+            if entries or named:
+                matches.append((named, maptype, entries))
+        if not matches:
+            return None
+        _, maptype, entries = ([m for m in matches if m[0]] or matches)[0]
+        return maptype, entries
+
+    def _AFX_MAP_entries(self, maptype, lpEntries, seg_end_ea, snapshot):
+        """ Entries of the maptype table at lpEntries without the terminator, None when it is not one """
+        entry_st = maptype.layout(self.ptrSize)[1]
+        entries = []
+        ea = lpEntries
+        while ea + entry_st.size <= seg_end_ea and len(entries) < 0x4000:
+            entry = snapshot.unpack(ea, entry_st)
+            if entry is None:
+                return None
+            if maptype.is_end(entry, self):
+                return entries
+            if not maptype.is_entry(entry, self):
+                return None
+            entries.append(entry)
+            ea += entry_st.size
+        return None
+
+    # lpszName of an AFX_DISPMAP_ENTRY, ANSI or UTF-16
+    _disp_name = re.compile(r"[A-Za-z_][A-Za-z0-9_]{0,127}$")
+
+    def _disp_entry_label(self, entry, snapshot):
+        """ lpszName of a dispatch or event sink entry, the DISPID when it has none """
+        buf = snapshot.get_bytes(entry[0], 256)
+        name = ""
+        if buf is not None:
+            buf = bytes(buf)
+            if len(buf) > 1 and buf[1:2] == b"\x00":
+                name = buf.decode("utf-16-le", "replace").split("\x00")[0]
             else:
-                logger.debug("xref %s not found" %(["%x"%i for i in addr_set]))
-        else:
-            logger.debug("xref_1 %x not found" %addr)
-        
-        return msgmapSize
+                name = buf.split(b"\x00")[0].decode("latin-1")
+        if self._disp_name.match(name):
+            return name
+        return "%X" % (entry[1] & 0xFFFFFFFF)
+
+    def _name_guid(self, ea, snapshot, batch):
+        """ Name the GUID at ea after iid_index when it has a dummy name """
+        if ea in self.named_guids:
+            return
+        self.named_guids.add(ea)
+        buf = snapshot.get_bytes(ea, 16)
+        name = iid_index.get(buf) if buf is not None and len(buf) == 16 else ""
+        if name and idc.get_name(ea) in ("unk_%lX" % ea, "stru_%lX" % ea, "xmmword_%lX" % ea, ""):
+            batch.set_name(ea, name, idc.SN_CHECK | idc.SN_NOWARN)
+
+    def _AFX_MAP_entry_record(self, maptype, ea, entry, snapshot, batch):
+        """ Export record of a maptype entry: its fields, the handler names and the GUID name """
+        record = {"addr": ea}
+        record.update(zip(maptype.fields, entry))
+        for index, _ in maptype.handlers:
+            if entry[index]:
+                record[maptype.fields[index] + "_name"] = batch.func_name(entry[index])
+        if maptype.guid is not None and entry[maptype.guid]:
+            buf = snapshot.get_bytes(entry[maptype.guid], 16)
+            record[maptype.fields[maptype.guid] + "_name"] = iid_index.get(buf) if buf is not None and len(buf) == 16 else ""
+        return record
+
+    def Make_AFX_MAP(self, addr, maptype, snapshot=None, entries=None):
+        """ Make the maptype table at addr, return the size of its entries with the terminator """
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        pBaseMap, lpEntries = snapshot.msgmap(addr)
+        entry_size = maptype.layout(self.ptrSize)[1].size
+        if entries is None:
+            entries = self._AFX_MAP_entries(maptype, lpEntries, self.max_ea, snapshot) or []
+
+        with self.write_batch() as batch, batch.map_writes(addr):
+            batch.create_struct(addr, -1, maptype.map_struct)
+            map_name = idc.get_name(addr)
+            if map_name in ("off_%lX" % addr, "unk_%lX" % addr, ""):
+                map_name = "%sEntries_%lX" % (maptype.kind.lower(), addr)
+                batch.set_name(addr, map_name)
+
+            pEntry = lpEntries
+            for entry in entries:
+                batch.create_struct(pEntry, entry_size, maptype.entry_struct)
+                for index, prefix in maptype.handlers:
+                    func_startEa = entry[index]
+                    if not func_startEa:
+                        continue
+                    if not batch.has_func(func_startEa):
+                        batch.add_func(func_startEa)
+                        if self.func_index is not None:
+                            self.func_index.add(func_startEa)
+                    batch.rename_func(func_startEa, "%s_%s_%X" % (prefix, self._disp_entry_label(entry, snapshot), func_startEa))
+                if maptype.guid is not None and entry[maptype.guid]:
+                    self._name_guid(entry[maptype.guid], snapshot, batch)
+                pEntry += entry_size
+            # END_xxx_MAP
+            batch.create_struct(pEntry, entry_size, maptype.entry_struct)
+
+            t0 = self.stats.clock()
+            class_name, _ = self._resolve_MSGMAP_class(addr)
+            self.stats.add("class name", t0)
+            if class_name:
+                new_name = "%s_%sMAP" % (class_name, maptype.kind)
+                batch.set_name(addr, new_name, idc.SN_CHECK)
+                logger.info("Rename addr 0x%x to %s", addr, new_name)
+                map_name = new_name
+
+            if self.exporter is not None:
+                exported = [self._AFX_MAP_entry_record(maptype, lpEntries + i * entry_size, entry, snapshot, batch)
+                            for i, entry in enumerate(entries)]
+                self.exporter.write({"type": maptype.kind, "addr": addr, "name": map_name, "class": class_name,
+                                     "base_map": pBaseMap, "entries": exported})
+
+        if self.keep_maps:
+            self.afx_maps.append(AfxMap(addr, idc.get_name(addr, ida_name.GN_VISIBLE), maptype.kind,
+                                        pBaseMap, lpEntries, tuple(entries)))
+        return (len(entries) + 1) * entry_size
+
+    def Find_MSGMAP_getters(self, segments):
+        """
+        Addresses returned by the one instruction getters (GetThisMessageMap)
+        in the code segments, a single pattern pass that needs no names.
+
+        segments: [(seg_start, seg_end, snapshot), ...] of the scanned segments
+        Return: sorted target addresses inside those segments
+        """
+        targets = set()
+        for seg_start, seg_end, snapshot in segments:
+            s = ida_segment.getseg(seg_start)
+            if ida_segment.get_segm_name(s).lower() != ".text":
+                continue
+            for _, target in snapshot.getter_targets():
+                targets.add(target)
+        return sorted(t for t in targets if any(start <= t < end for start, end, _ in segments))
+
+    def _check_MSGMAP_candidates(self, candidates, seg_start, seg_end, snapshot, found, values):
+        """
+        Check and make the AFX_MSGMAPs among candidates, ascending addresses in one segment,
+        and the AFX_MAP_TYPES tables when search_other_maps is set.
+        found maps the address of every map made so far to (bytes to skip from it, map kind).
+
+        Return: number of maps made that had no name yet
+        """
+        stats = self.stats
+        # Make_MSG_ENTRY and Make_AFX_MAP time is taken out of the candidate check time below
+        t_loop = stats.clock()
+        t_make = 0.0
+        checks = 0
+        parseCount = 0
+
+        next_addr = seg_start
+        for addr in candidates:
+            if addr < next_addr:
+                # inside the AFX_MSGMAP_ENTRY table found before
+                continue
+            span = found[addr][0] if addr in found else self.ptrSize
+            if addr not in found:
+                checks += 1
+                ret = self.Check_MSGMAP(addr, seg_start, seg_end, snapshot)
+                if ret > 0:
+                    strfind = "Find AFX_MSGMAP at 0x%X" % (addr)
+                    idaapi.replace_wait_box(strfind)
+                    print(strfind)
+
+                    if idc.get_name(addr, ida_name.GN_VISIBLE) == "off_%lX" % (addr):
+                        parseCount += 1
+
+                    t0 = stats.clock()
+                    MSGMAPSize = self.Make_MSG_ENTRY(addr, snapshot)
+                    t0 = stats.clock() - t0
+                    stats.add_time("Make_MSG_ENTRY", t0)
+                    t_make += t0
+                    span = MSGMAPSize + self.ptrSize
+                    found[addr] = (span, "MSGMAP")
+
+                    if self.keep_maps:
+                        value = [
+                            len(values),
+                            addr,
+                            idc.get_name(addr, ida_name.GN_VISIBLE),
+                            (MSGMAPSize - self.MSGStructSize) / self.MSGStructSize,
+                            S_MSGMAP
+                        ]
+                        values.append(value)
+                elif ret == 0 and self.search_other_maps:
+                    match = self.Check_AFX_MAP(addr, seg_start, seg_end, snapshot)
+                    if match is not None:
+                        maptype, entries = match
+                        strfind = "Find %s at 0x%X" % (maptype.map_struct, addr)
+                        idaapi.replace_wait_box(strfind)
+                        print(strfind)
 
-    # Search All AFX_MSGMAP
-    def Search_MSGMAP(self):
+                        t0 = stats.clock()
+                        size = self.Make_AFX_MAP(addr, maptype, snapshot, entries)
+                        t0 = stats.clock() - t0
+                        stats.add_time("Make_AFX_MAP", t0)
+                        t_make += t0
+                        # skip the entries only when they follow the header
+                        header_size = maptype.layout(self.ptrSize)[0].size
+                        if snapshot.ptr(addr + self.ptrSize) == addr + header_size:
+                            span = header_size + size
+                        else:
+                            span = header_size
+                        found[addr] = (span, maptype.kind)
+                        if self.keep_maps:
+                            values.append([len(values), addr, idc.get_name(addr, ida_name.GN_VISIBLE),
+                                           len(entries), maptype.map_struct])
+
+            next_addr = addr + span
+
+        stats.add_time("Check_MSGMAP", stats.clock() - t_loop - t_make, checks)
+        return parseCount
+
+    # Search All AFX_MSGMAP, and the other AFX_MAP_TYPES tables in the same pass
+    # stats_json: optional path, the phase timings are also written there as JSON
+    # anchors_only: only check the targets of GetThisMessageMap style getters, skip the sweep
+    # export: optional path or text file, every map and its decoded entries are written there
+    # as JSON Lines once the writes are applied (see JSONLinesExporter), without the maps whose
+    # entry struct failed; msgmaps, afx_maps and the result rows are not kept meanwhile
+    def Search_MSGMAP(self, stats_json=None, anchors_only=False, export=None):
+        self.stats = stats = ScanStats("Search_MSGMAP")
+        self.msgmaps = []
+        self.afx_maps = []
+        self.named_guids = set()
+        keep_maps = self.keep_maps
+        if export is not None:
+            # the export is the result, nothing piles up in memory
+            self.exporter = JSONLinesExporter(export)
+            self.keep_maps = False
         try:
             idaapi.show_wait_box("Search for AFX_MSGMAP...")
 
-            totalCount = 0
             parseCount = 0
             values = list()
+            found = {}
+
+            t0 = stats.clock()
+            self.func_index = FuncIndex()
+            stats.add("function index", t0, len(self.func_index))
+            self.resolve_cache = ResolveCache()
 
             # Scan AFX_MSGMAP in all .text and .rdata segment
+            segments = []
             snum = ida_segment.get_segm_qty()
             for i in range(snum):
+                t0 = stats.clock()
                 seg_start = 0
                 seg_end = 0
 
@@ -2355,50 +4463,271 @@ class AFXStructs(object):
                     seg_start = s.start_ea
                     seg_end = s.end_ea
                 else:
+                    stats.add("segments", t0)
                     continue
 
                 if seg_start == 0 or seg_end == 0 or seg_start == idc.BADADDR or seg_end == idc.BADADDR:
+                    stats.add("segments", t0)
                     continue
 
-                addr = seg_start
-                while addr < seg_end:
-                    ret = self.Check_MSGMAP(addr, seg_start, seg_end)
-                    MSGMAPSize = 0
-                    if ret > 0:
-                        totalCount += 1
-                        strfind = "Find AFX_MSGMAP at 0x%X" % (addr)
-                        idaapi.replace_wait_box(strfind)
-                        print(strfind)
-
-                        if idc.get_name(addr, ida_name.GN_VISIBLE) == "off_%lX" % (addr):
-                            parseCount += 1
-
-                        MSGMAPSize = self.Make_MSG_ENTRY(addr)
-
-                        value = [
-                            totalCount-1,
-                            addr,
-                            idc.get_name(addr, ida_name.GN_VISIBLE),
-                            (MSGMAPSize - self.MSGStructSize) / self.MSGStructSize
-                        ]
-                        values.append(value)
+                # one bulk read per segment instead of a few idc calls per address
+                segments.append((seg_start, seg_end, SegmentSnapshot(seg_start, seg_end, self.ptrSize)))
+                stats.add("segments", t0)
+
+            # every write of the run goes to the IDB in one pass at the end
+            with self.write_batch() as batch:
+                # maps returned by getters first, they need no names and come in seconds
+                t0 = stats.clock()
+                anchors = self.Find_MSGMAP_getters(segments)
+                stats.add("getter anchors", t0, len(anchors))
+                for seg_start, seg_end, snapshot in segments:
+                    candidates = anchors[bisect.bisect_left(anchors, seg_start):bisect.bisect_left(anchors, seg_end)]
+                    parseCount += self._check_MSGMAP_candidates(candidates, seg_start, seg_end, snapshot, found, values)
+
+                # in a relocatable image both pointers of an AFX_MSGMAP have a fixup,
+                # only such pairs need a check; otherwise sweep every slot
+                use_fixups = self.use_fixups and Utils.has_fixups()
+
+                for seg_start, seg_end, snapshot in segments:
+                    if anchors_only:
+                        break
 
-                    addr += MSGMAPSize + self.ptrSize
+                    candidates = None
+                    if use_fixups:
+                        t0 = stats.clock()
+                        candidates = Utils.fixup_pairs(seg_start, seg_end, self.ptrSize)
+                        stats.add("fixup pairs", t0, len(candidates))
+                    if candidates is None and self.use_numpy:
+                        t0 = stats.clock()
+                        candidates = snapshot.msgmap_candidates(self.min_ea, self.max_ea, len(AfxSig) + 20,
+                                                                self.func_index.sorted_array(),
+                                                                self.search_other_maps)
+                        stats.add("prefilter", t0, (seg_end - seg_start) // self.ptrSize)
+                    if candidates is None:
+                        candidates = range(seg_start, seg_end, self.ptrSize)
+
+                    parseCount += self._check_MSGMAP_candidates(candidates, seg_start, seg_end, snapshot, found, values)
         finally:
+            self.func_index = None
+            self.resolve_cache = None
+            if export is not None:
+                stats.count("exported maps", self.exporter.count)
+                self.exporter.close()
+                self.exporter = None
+                self.keep_maps = keep_maps
             idaapi.hide_wait_box()
 
+        # maps whose entry struct failed, write_batch() took them out of msgmaps and afx_maps
+        if batch.failed:
+            values = [v for v in values if v[1] not in batch.failed]
+            for i, value in enumerate(values):
+                value[0] = i
+            for addr in batch.failed:
+                found.pop(addr, None)
+        # names as applied by the write batch
+        for value in values:
+            value[2] = idc.get_name(value[1], ida_name.GN_VISIBLE)
+        self.msgmaps = [m._replace(name=idc.get_name(m.addr, ida_name.GN_VISIBLE)) for m in self.msgmaps]
+        self.msgmap_graph = None
+        self.id_index = None
+        self.afx_maps = [m._replace(name=idc.get_name(m.addr, ida_name.GN_VISIBLE)) for m in self.afx_maps]
+
+        # the rows are not kept while exporting
+        counts = collections.Counter(kind for _, kind in found.values())
+        totalCount = counts.pop("MSGMAP", 0)
+        others = ", ".join("%s %lu" % (kind, counts[kind]) for kind in sorted(counts))
         if values:
             c = AFXMSGMAPSearchResultChooser("Search AFX_MSGMAPs results", values)
             c.show()
-        print("===== Search complete, total %lu, new resolution %lu=====\n" % (totalCount, parseCount))
+        print("===== Search complete, total %lu AFX_MSGMAP, other maps %lu (%s), new resolution %lu=====\n"
+              % (totalCount, sum(counts.values()), others or "none", parseCount))
+        print(stats.report())
+        if stats_json:
+            stats.write_json(stats_json)
+        return values
 
-    def Search_CRuntimeClass(self):
-        # TODO: viet cho xong
-        pass
+    # m_lpszClassName of a CRuntimeClass, an identifier (or a template name)
+    _runtime_class_name = re.compile(b"([A-Za-z_][A-Za-z0-9_:<>, *]{0,254})\\x00")
 
-    def Make_CRuntimeClass(self):
-        # TODO: viet cho xong
-        pass
+    def Check_CRuntimeClass(self, addr, snapshot=None):
+        """
+        Return the class name when addr looks like a CRuntimeClass, "" otherwise.
+        m_pBaseClass is only range checked, Search_CRuntimeClass links the classes.
+        """
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        name_ea, nObjectSize, wSchema, pfnCreateObject, pBaseClass, pNextClass = snapshot.runtime_class(addr)
+        if not self.min_ea < name_ea < self.max_ea:
+            return ""
+        if not 0 < nObjectSize < 0x1000000:
+            return ""
+        if wSchema != 0xFFFF and wSchema & 0x7FFFFFFF > 0xFFFF:
+            return ""
+        if pfnCreateObject and not self.is_func_start(pfnCreateObject):
+            return ""
+        if pNextClass and not self.min_ea < pNextClass < self.max_ea:
+            return ""
+        if pBaseClass and not self.min_ea < pBaseClass < self.max_ea:
+            return ""
+
+        buf = snapshot.get_bytes(name_ea, 256)
+        m = self._runtime_class_name.match(bytes(buf)) if buf is not None else None
+        if m is None:
+            return ""
+        name = m.group(1).decode("latin-1")
+        # only CObject is a root
+        if (pBaseClass == 0) != (name == "CObject"):
+            return ""
+        return name
+
+    def Make_CRuntimeClass(self, addr=None, snapshot=None, name=None, v7=True):
+        """ Make the CRuntimeClass (CRuntimeClass_v7 when v7) at addr, the screen ea by default """
+        if addr is None:
+            addr = idc.get_screen_ea()
+        if snapshot is None:
+            snapshot = self.no_snapshot
+        if name is None:
+            name = self.Check_CRuntimeClass(addr, snapshot)
+            if not name:
+                print("This is not a CRuntimeClass\n")
+                return 0
+        _, _, _, pfnCreateObject, pBaseClass, _ = snapshot.runtime_class(addr)
+
+        with self.write_batch() as batch:
+            if v7:
+                batch.create_struct(addr, self.CRTCSize_v7, S_CRuntimeClass_v7)
+            else:
+                batch.create_struct(addr, self.CRTCSize, S_CRuntimeClass)
+            if idc.get_name(addr) in ("off_%lX" % addr, "unk_%lX" % addr, ""):
+                batch.set_name(addr, S_CRTC_Name % (name, name))
+            if pfnCreateObject:
+                batch.rename_func(pfnCreateObject, S_CRTC_CreateObject % name)
+            if pBaseClass and self.is_func_start(pBaseClass):
+                # m_pfnGetBaseClass: CClassName::_GetBaseClass
+                batch.rename_func(pBaseClass, S_CRTC_GetBaseClass % name)
+        return self.CRTCSize_v7 if v7 else self.CRTCSize
+
+    def Apply_CRuntimeClassGraph(self, graph, snapshots=None):
+        """ Make every CRuntimeClass of graph in one write batch, snapshots maps addr -> SegmentSnapshot """
+        snapshots = snapshots or {}
+        with self.write_batch():
+            for addr in sorted(graph.nodes):
+                # m_pClassInit (MFC >= 7) would overlap a class right behind this one
+                v7 = addr + self.CRTCSize not in graph
+                t0 = self.stats.clock()
+                self.Make_CRuntimeClass(addr, snapshots.get(addr), graph.nodes[addr].name, v7)
+                self.stats.add("Make_CRuntimeClass", t0)
+
+    def Make_CRuntimeClass_Tree(self, addr=None):
+        """ Make the CRuntimeClass at addr and, recursively, its parents and m_pNextClass list """
+        if addr is None:
+            addr = idc.get_screen_ea()
+        graph = RuntimeClassGraph(self.ptrSize, self.is_func_start)
+        todo = [addr]
+        while todo:
+            ea = todo.pop()
+            if ea in graph:
+                continue
+            name = self.Check_CRuntimeClass(ea)
+            if not name:
+                continue
+            graph.add(RuntimeClass(ea, name, *self.no_snapshot.runtime_class(ea)[1:]))
+            parent = graph.parent(ea)
+            if parent is not None:
+                todo.append(parent)
+            if graph.nodes[ea].pNextClass:
+                todo.append(graph.nodes[ea].pNextClass)
+        graph.drop_cycles()
+        if addr not in graph:
+            print("This is not a CRuntimeClass\n")
+            return 0
+        self.Apply_CRuntimeClassGraph(graph)
+        self.class_graph = graph
+        print("Made %d CRuntimeClass, %s : %s\n" % (len(graph), graph.nodes[addr].name,
+                                                    " : ".join(graph.get_ancestors(addr)) or "-"))
+        return len(graph)
+
+    # Search all CRuntimeClass
+    # stats_json: optional path, the phase timings are also written there as JSON
+    def Search_CRuntimeClass(self, stats_json=None):
+        self.stats = stats = ScanStats("Search_CRuntimeClass")
+        self.runtime_classes = []
+        self.class_graph = graph = RuntimeClassGraph(self.ptrSize, self.is_func_start)
+        values = list()
+        try:
+            idaapi.show_wait_box("Search for CRuntimeClass...")
+
+            t0 = stats.clock()
+            self.func_index = FuncIndex()
+            stats.add("function index", t0, len(self.func_index))
+
+            # CRuntimeClass objects are const data, scan every non code segment
+            found = {}              # addr -> (name, fields, snapshot)
+            for i in range(ida_segment.get_segm_qty()):
+                s = ida_segment.getnseg(i)
+                if ida_segment.get_segm_class(s) == "CODE":
+                    continue
+                t0 = stats.clock()
+                snapshot = SegmentSnapshot(s.start_ea, s.end_ea, self.ptrSize)
+                stats.add("segments", t0)
+
+                candidates = None
+                if self.use_numpy:
+                    t0 = stats.clock()
+                    candidates = snapshot.runtime_class_candidates(self.min_ea, self.max_ea, self.func_index.sorted_array())
+                    stats.add("prefilter", t0, (s.end_ea - s.start_ea) // self.ptrSize)
+                if candidates is None:
+                    candidates = range(s.start_ea, s.end_ea, self.ptrSize)
+
+                t0 = stats.clock()
+                checks = 0
+                for addr in candidates:
+                    checks += 1
+                    name = self.Check_CRuntimeClass(addr, snapshot)
+                    if name:
+                        found[addr] = (name, snapshot.runtime_class(addr), snapshot)
+                stats.add("Check_CRuntimeClass", t0, checks)
+
+            # m_pBaseClass must be another CRuntimeClass, m_pfnGetBaseClass a function;
+            # dropping a class can orphan the ones derived from it, repeat until stable
+            t0 = stats.clock()
+            while True:
+                dropped = [addr for addr, (name, fields, _) in found.items()
+                           if fields[4] and fields[4] not in found and not self.is_func_start(fields[4])]
+                if not dropped:
+                    break
+                for addr in dropped:
+                    del found[addr]
+            stats.add("link classes", t0, len(found))
+
+            # resolve every parent, a class whose chain loops never reaches CObject
+            t0 = stats.clock()
+            for addr in sorted(found):
+                name, fields, _ = found[addr]
+                graph.add(RuntimeClass(addr, name, *fields[1:]))
+            graph.drop_cycles()
+            stats.add("class graph", t0, len(graph))
+
+            self.Apply_CRuntimeClassGraph(graph, {addr: found[addr][2] for addr in graph.nodes})
+            self.runtime_classes = [graph.nodes[addr] for addr in sorted(graph.nodes)]
+        finally:
+            self.func_index = None
+            idaapi.hide_wait_box()
+
+        for c in self.runtime_classes:
+            base = graph.parent_name(c.addr)
+            if not base and c.pBaseClass:
+                base = idc.get_name(c.pBaseClass, ida_name.GN_VISIBLE)
+            values.append([len(values), c.addr, c.name, base or ""])
+
+        if values:
+            c = AFXCRuntimeClassSearchResultChooser("Search CRuntimeClass results", values)
+            c.show()
+        print("===== Search complete, total %lu CRuntimeClass =====\n" % len(values))
+        print(stats.report())
+        if stats_json:
+            stats.write_json(stats_json)
+        return values
 
 class MenuContextHandler(idaapi.action_handler_t):
     @classmethod
@@ -2442,12 +4771,24 @@ class Make_MSGMAP_MCH(MenuContextHandler):
         self.plugin.make_msgmap()
         return 1
 
+# Context menu for the map entries reaching the current handler
+class Show_Handler_Entries_MCH(MenuContextHandler):
+    def activate(self, ctx):
+        self.plugin.show_handler_entries()
+        return 1
+
 # Context menu for Search MSGMAP
 class Search_MSGMAP_MCH(MenuContextHandler):
     def activate(self, ctx):
         self.plugin.search_msgmap()
         return 1
 
+# Context menu for Search MSGMAP from getter anchors only
+class Search_MSGMAP_Anchors_MCH(MenuContextHandler):
+    def activate(self, ctx):
+        self.plugin.search_msgmap_anchors()
+        return 1
+
 # Context menu for make CRuntimeClass
 class Make_CRuntimeClass_MCH(MenuContextHandler):
     def activate(self, ctx):
@@ -2466,7 +4807,9 @@ class Hooks(idaapi.UI_Hooks):
     def finish_populating_widget_popup(self, widget, popup):
         if idaapi.get_widget_type(widget) == idaapi.BWN_DISASM:
             idaapi.attach_action_to_popup(widget, popup, Make_MSGMAP_MCH.get_name(), POPUP_PATH)
+            idaapi.attach_action_to_popup(widget, popup, Show_Handler_Entries_MCH.get_name(), POPUP_PATH)
             idaapi.attach_action_to_popup(widget, popup, Search_MSGMAP_MCH.get_name(), POPUP_PATH)
+            idaapi.attach_action_to_popup(widget, popup, Search_MSGMAP_Anchors_MCH.get_name(), POPUP_PATH)
             idaapi.attach_action_to_popup(widget, popup, Make_CRuntimeClass_MCH.get_name(), POPUP_PATH)
             idaapi.attach_action_to_popup(widget, popup, Search_CRuntimeClass_MCH.get_name(), POPUP_PATH)
 
@@ -2498,12 +4841,16 @@ class MFCHelperPlugin_t(idaapi.plugin_t):
 
         # register popup menu handlers
         Make_MSGMAP_MCH.register(self, "Make as AFX_MSGMAP")
+        Show_Handler_Entries_MCH.register(self, "Show AFX_MSGMAP entries of this handler")
         Search_MSGMAP_MCH.register(self, "Search AFX_MSGMAPs")
+        Search_MSGMAP_Anchors_MCH.register(self, "Search AFX_MSGMAPs (getters only)")
         Make_CRuntimeClass_MCH.register(self, "Make as CRuntimeClass")
         Search_CRuntimeClass_MCH.register(self, "Search CRuntimeClasses")
 
         idaapi.attach_action_to_menu(MENU_PATH, Make_MSGMAP_MCH.get_name(), idaapi.SETMENU_APP)
+        idaapi.attach_action_to_menu(MENU_PATH, Show_Handler_Entries_MCH.get_name(), idaapi.SETMENU_APP)
         idaapi.attach_action_to_menu(MENU_PATH, Search_MSGMAP_MCH.get_name(), idaapi.SETMENU_APP)
+        idaapi.attach_action_to_menu(MENU_PATH, Search_MSGMAP_Anchors_MCH.get_name(), idaapi.SETMENU_APP)
         idaapi.attach_action_to_menu(MENU_PATH, Make_CRuntimeClass_MCH.get_name(), idaapi.SETMENU_APP)
         idaapi.attach_action_to_menu(MENU_PATH, Search_CRuntimeClass_MCH.get_name(), idaapi.SETMENU_APP)
 
@@ -2533,12 +4880,16 @@ class MFCHelperPlugin_t(idaapi.plugin_t):
 
         idaapi.detach_action_from_menu(MENU_PATH, Search_CRuntimeClass_MCH.get_name())
         idaapi.detach_action_from_menu(MENU_PATH, Make_CRuntimeClass_MCH.get_name())
+        idaapi.detach_action_from_menu(MENU_PATH, Search_MSGMAP_Anchors_MCH.get_name())
         idaapi.detach_action_from_menu(MENU_PATH, Search_MSGMAP_MCH.get_name())
+        idaapi.detach_action_from_menu(MENU_PATH, Show_Handler_Entries_MCH.get_name())
         idaapi.detach_action_from_menu(MENU_PATH, Make_MSGMAP_MCH.get_name())
 
         Search_CRuntimeClass_MCH.unregister()
         Make_CRuntimeClass_MCH.unregister()
+        Search_MSGMAP_Anchors_MCH.unregister()
         Search_MSGMAP_MCH.unregister()
+        Show_Handler_Entries_MCH.unregister()
         Make_MSGMAP_MCH.unregister()
 
         print("[%s] plugin terminated." % self.wanted_name)
@@ -2553,17 +4904,25 @@ class MFCHelperPlugin_t(idaapi.plugin_t):
         else:
             print("This is not a AFX_MSGMAP\n")
 
+    # map entries reaching the handler at current screen ea, from the index saved in the IDB
+    def show_handler_entries(self):
+        self.afxStructs.Show_Handler_Entries()
+
     # search all AFX_MSGMAP in a user selected section
     def search_msgmap(self):
         self.afxStructs.Search_MSGMAP()
 
+    # only the AFX_MSGMAPs returned by GetThisMessageMap style getters, fast on stripped binaries
+    def search_msgmap_anchors(self):
+        self.afxStructs.Search_MSGMAP(anchors_only=True)
+
     # make CRuntimeClass and recusive to all parent and next CRuntimeClass
     def make_CRuntimeClass(self):
-        self.afxStructs.Make_CRuntimeClass()
+        self.afxStructs.Make_CRuntimeClass_Tree()
 
     def search_CRuntimeClass(self):
         self.afxStructs.Search_CRuntimeClass()
 
 
 def PLUGIN_ENTRY():
-    return MFCHelperPlugin_t()
\ No newline at end of file
+    return MFCHelperPlugin_t()
\ No newline at end of file
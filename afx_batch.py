@@ -0,0 +1,265 @@
+# Batch AFX_MSGMAP discovery over many binaries with the headless backend
+#
+# Every binary is scanned in a worker process and one JSON Lines record is
+# written per binary, in completion order:
+#
+#     {"path": ..., "status": "ok", "arch": "x86", "image_base": ...,
+#      "msgmaps": [{"addr": ..., "name": ..., "entries": [...]}, ...],
+#      "maps": [{"addr": ..., "name": ..., "type": "DISP", "entries": [...]}, ...],
+#      "runtime_classes": [{"addr": ..., "name": ..., "pBaseClass": ..., "base_name": ...}, ...],
+#      "stats": [{"title": "Search_MSGMAP", ...}, {"title": "Search_CRuntimeClass", ...}],
+#      "seconds": ...}
+#
+# Entries carry the handler names, "handler" in msgmaps and "<field>_name" in
+# maps. With -s the records are also stored in a SQLite database, see afx_store.py.
+#
+# status is "error" (exception, see "error"), "timeout" or "crashed" (the
+# worker process died) otherwise. A crashed pool is rebuilt, the binaries that
+# were in flight are rescanned one by one so only the culprit is reported.
+#
+# Usage:
+#     python afx_batch.py [-j jobs] [-t timeout] [-o out.jsonl] [-s out.db] [-l list.txt] [-r] [-a] <file or dir> ...
+
+# pylint: disable=C0301,C0103,C0111
+
+from __future__ import print_function
+
+import os
+import io
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import traceback
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import afx_headless
+import afx_store
+
+
+class ScanTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise ScanTimeout()
+
+
+def is_pe_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(2) == b"MZ"
+    except (IOError, OSError):
+        return False
+
+
+def iter_inputs(paths, recursive=False):
+    """ Files named in paths; directories contribute the MZ files in them """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                if is_pe_file(full):
+                    yield full
+            if not recursive:
+                break
+
+
+def read_list(path):
+    """ One path per line, blank lines and # comments are skipped """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def msgmap_record(module, m):
+    return {
+        "addr": m.addr,
+        "name": m.name,
+        "base_map": m.pBaseMap,
+        "entries": [{
+            "message": module.AFXStructs.GetMsgName(e.nMessage)[0],
+            "nMessage": e.nMessage,
+            "nCode": e.nCode,
+            "nID": e.nID,
+            "nLastID": e.nLastID,
+            "nSig": e.nSig,
+            "pfn": e.pfn,
+            "handler": module.idc.get_name(e.pfn),
+        } for e in m.entries],
+    }
+
+
+def afx_map_record(module, m):
+    maptype = [t for t in module.AFX_MAP_TYPES if t.kind == m.kind][0]
+    entries = []
+    for e in m.entries:
+        entry = dict(zip(maptype.fields, e))
+        for index, _ in maptype.handlers:
+            if e[index]:
+                entry[maptype.fields[index] + "_name"] = module.idc.get_name(e[index])
+        entries.append(entry)
+    return {
+        "addr": m.addr,
+        "name": m.name,
+        "type": m.kind,
+        "base_map": m.pBaseMap,
+        "entries": entries,
+    }
+
+
+def _init_worker(verbose):
+    if not verbose:
+        # logger_t leaves an already configured root logger alone
+        log = logging.getLogger()
+        log.addHandler(logging.StreamHandler(sys.stderr))
+        log.setLevel(logging.WARNING)
+
+
+def scan_one(path, timeout=0, anchors_only=False):
+    """ Scan one binary, runs in a worker; always returns a record """
+    record = collections.OrderedDict(path=path)
+    started = time.time()
+    alarm = timeout and hasattr(signal, "SIGALRM")
+    if alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    afx = None
+    try:
+        # Search_MSGMAP prints progress and its report, keep stdout for records
+        with contextlib.redirect_stdout(io.StringIO()):
+            afx = afx_headless.open_binary(path)
+            module = sys.modules[type(afx).__module__]
+            afx.Search_MSGMAP(anchors_only=anchors_only)
+            msgmaps = [msgmap_record(module, m) for m in afx.msgmaps]
+            maps = [afx_map_record(module, m) for m in afx.afx_maps]
+            stats = [afx.stats.to_dict()]
+            afx.Search_CRuntimeClass()
+            # pBaseClass may be a getter, the graph has the resolved base
+            classes = [dict(c._asdict(), base_name=afx.class_graph.parent_name(c.addr)) for c in afx.runtime_classes]
+            stats.append(afx.stats.to_dict())
+        record["status"] = "ok"
+        record["arch"] = "x64" if afx.db.is64 else "x86"
+        record["image_base"] = afx.db.image_base
+        record["msgmaps"] = msgmaps
+        record["maps"] = maps
+        record["runtime_classes"] = classes
+        record["stats"] = stats
+    except ScanTimeout:
+        record["status"] = "timeout"
+        record["error"] = "no result after %g s" % timeout
+    except Exception as e:          # pylint: disable=broad-except
+        record["status"] = "error"
+        record["error"] = "%s: %s" % (type(e).__name__, e)
+        record["traceback"] = traceback.format_exc()
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if afx is not None:
+            afx.db.pe.close()
+    record["seconds"] = time.time() - started
+    return record
+
+
+def crashed_record(path):
+    return collections.OrderedDict(path=path, status="crashed", error="worker process died")
+
+
+def run_isolated(path, timeout, verbose, anchors_only=False):
+    """ Rescan path alone in a fresh single worker pool """
+    with ProcessPoolExecutor(1, initializer=_init_worker, initargs=(verbose,)) as pool:
+        try:
+            return pool.submit(scan_one, path, timeout, anchors_only).result()
+        except BrokenProcessPool:
+            return crashed_record(path)
+
+
+def run_batch(paths, jobs=None, timeout=0, verbose=False, anchors_only=False):
+    """ Yield the record of every path as it completes """
+    jobs = jobs or os.cpu_count() or 1
+    pending = collections.deque(paths)
+    while pending:
+        suspects = []
+        pool = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(verbose,))
+        running = {}
+        try:
+            while pending or running:
+                # keep a few queued per worker so none idles between results
+                while pending and len(running) < 2 * jobs:
+                    path = pending.popleft()
+                    running[pool.submit(scan_one, path, timeout, anchors_only)] = path
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for fut in done:
+                    path = running.pop(fut)
+                    try:
+                        yield fut.result()
+                    except BrokenProcessPool:
+                        suspects.append(path)
+                        broken = True
+                if broken:
+                    # every binary still in flight died with the pool
+                    for fut, path in running.items():
+                        if fut.done() and fut.exception() is None:
+                            yield fut.result()
+                        else:
+                            suspects.append(path)
+                    running.clear()
+                    break
+        finally:
+            pool.shutdown(wait=not suspects)
+        for path in suspects:
+            yield run_isolated(path, timeout, verbose, anchors_only)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search AFX_MSGMAPs in many PE files, one JSON line per file")
+    parser.add_argument("inputs", nargs="*", help="PE files or directories")
+    parser.add_argument("-l", "--list", action="append", default=[], help="file with one input path per line")
+    parser.add_argument("-r", "--recursive", action="store_true", help="descend into subdirectories")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-t", "--timeout", type=float, default=600, help="seconds per binary, 0 for none (default: 600)")
+    parser.add_argument("-o", "--output", default="-", help="JSON Lines output (default: stdout)")
+    parser.add_argument("-s", "--sqlite", default=None, help="also store the records in this SQLite database")
+    parser.add_argument("-a", "--anchors-only", action="store_true", help="only check the targets of GetThisMessageMap getters")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the scanner log on stderr")
+    args = parser.parse_args(argv)
+
+    inputs = list(args.inputs)
+    for lst in args.list:
+        inputs += read_list(lst)
+    paths = list(iter_inputs(inputs, args.recursive))
+    if not paths:
+        parser.error("no input files")
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    store = afx_store.ResultStore(args.sqlite) if args.sqlite else None
+    counts = collections.Counter()
+    started = time.time()
+    try:
+        for record in run_batch(paths, args.jobs, args.timeout, args.verbose, args.anchors_only):
+            counts[record["status"]] += 1
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if store is not None:
+                store.add(record)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if store is not None:
+            store.close()
+    print("%d binaries in %.1f s: %s" % (len(paths), time.time() - started,
+                                         ", ".join("%s %d" % kv for kv in sorted(counts.items()))), file=sys.stderr)
+    return 0 if counts["ok"] == len(paths) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,971 @@
+# Headless stand-ins for the IDA modules used by AFX_MSGMAP.py
+#
+# Serves segments, bytes, names, functions and xrefs from a PE file so the
+# AFX_MSGMAP scanner runs (and can be benchmarked) without IDA. Write side
+# calls (create_struct, set_name, add_func...) are recorded in HeadlessDB.ops.
+#
+# Usage:
+#     import afx_headless
+#     afx = afx_headless.open_binary("app.exe")     # AFXStructs bound to the PE
+#     afx.Search_MSGMAP()
+#
+#     python afx_headless.py app.exe
+#     python afx_headless.py app.exe maps.jsonl     # also write the maps as JSON Lines
+
+# pylint: disable=C0301,C0103,C0111
+
+from __future__ import print_function
+
+import os
+import re
+import mmap
+import sys
+import json
+import types
+import struct
+import bisect
+import importlib
+import collections
+
+# IMAGE_SCN_*
+SCN_CNT_CODE = 0x00000020
+SCN_MEM_EXECUTE = 0x20000000
+
+# IMAGE_FILE_DLL
+FILE_DLL = 0x2000
+
+# IMAGE_DIRECTORY_ENTRY_*
+DIR_EXPORT = 0
+DIR_IMPORT = 1
+DIR_EXCEPTION = 3
+DIR_BASERELOC = 5
+
+# IMAGE_REL_BASED_*
+REL_BASED_HIGHLOW = 3
+REL_BASED_DIR64 = 10
+
+
+class PEError(Exception):
+    pass
+
+
+class Section(object):
+    __slots__ = ("name", "va", "vsize", "raw_ptr", "raw_size", "characteristics",
+                 "file_off", "file_size", "mem_size")
+
+    def __init__(self, name, va, vsize, raw_ptr, raw_size, characteristics):
+        self.name = name
+        self.va = va
+        self.vsize = vsize
+        self.raw_ptr = raw_ptr
+        self.raw_size = raw_size
+        self.characteristics = characteristics
+        # filled by PEImage.layout(): file backing and extent once mapped
+        self.file_off = raw_ptr
+        self.file_size = raw_size
+        self.mem_size = max(vsize, raw_size)
+
+    @property
+    def executable(self):
+        return (self.characteristics & (SCN_CNT_CODE | SCN_MEM_EXECUTE)) != 0
+
+
+def align_up(value, alignment):
+    if alignment <= 1:
+        return value
+    return (value + alignment - 1) // alignment * alignment
+
+
+class PEImage(object):
+    """
+    Minimal PE/PE32+ parser: headers, sections, imports, exports, relocations, .pdata
+
+    The file is mapped read only with mmap and read() hands out memoryview
+    slices of the mapping, so pages are only touched when decoded and several
+    processes scanning the same binary share the page cache.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty file
+            self._file.close()
+            raise PEError("%s: not a MZ file" % path)
+        self.data = memoryview(self._map)
+        try:
+            self.parse_headers()
+        except (PEError, struct.error):
+            self.close()
+            raise
+
+    def close(self):
+        """ Unmap the file, a no-op while memoryviews of it are still alive """
+        try:
+            self.data.release()
+            self._map.close()
+        except BufferError:
+            # views handed out by read() keep the mapping; it is unmapped
+            # when the last of them is collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def parse_headers(self):
+        d = self.data
+        if len(d) < 0x40 or d[:2] != b"MZ":
+            raise PEError("%s: not a MZ file" % self.path)
+        e_lfanew = struct.unpack_from("<I", d, 0x3C)[0]
+        if d[e_lfanew:e_lfanew + 4] != b"PE\0\0":
+            raise PEError("%s: no PE signature" % self.path)
+
+        fh = e_lfanew + 4
+        self.machine, nsec, _, _, _, opt_size, self.characteristics = struct.unpack_from("<HHIIIHH", d, fh)
+        opt = fh + 20
+        magic = struct.unpack_from("<H", d, opt)[0]
+        if magic not in (0x10B, 0x20B):
+            raise PEError("%s: unknown optional header magic 0x%X" % (self.path, magic))
+        self.is64 = magic == 0x20B
+        self.ptr_size = 8 if self.is64 else 4
+
+        self.entry_rva = struct.unpack_from("<I", d, opt + 16)[0]
+        self.image_base = struct.unpack_from("<Q", d, opt + 24)[0] if self.is64 else struct.unpack_from("<I", d, opt + 28)[0]
+        self.section_alignment, self.file_alignment = struct.unpack_from("<II", d, opt + 32)
+        self.size_of_image, self.size_of_headers = struct.unpack_from("<II", d, opt + 56)
+
+        dirs = opt + (108 if self.is64 else 92)
+        ndirs = min(struct.unpack_from("<I", d, dirs)[0], 16)
+        self.dirs = [struct.unpack_from("<II", d, dirs + 4 + 8 * i) for i in range(ndirs)]
+        self.dirs += [(0, 0)] * (16 - ndirs)
+
+        self.sections = []
+        sh = opt + opt_size
+        for i in range(nsec):
+            name, vsize, va, raw_size, raw_ptr = struct.unpack_from("<8sIIII", d, sh + 40 * i)
+            characteristics = struct.unpack_from("<I", d, sh + 40 * i + 36)[0]
+            name = bytes(name).rstrip(b"\0").decode("latin-1")
+            self.sections.append(Section(name, va, vsize, raw_ptr, raw_size, characteristics))
+        self.sections.sort(key=lambda s: s.va)
+        self.layout()
+
+    def layout(self):
+        """ Place the sections the way the Windows loader maps them """
+        sa = self.section_alignment or 0x1000
+        fa = self.file_alignment or 0x200
+        # low alignment images (SectionAlignment < page size) are mapped flat
+        flat = sa < 0x1000
+        self.headers_size = min(self.size_of_headers, len(self.data))
+        for s in self.sections:
+            if flat:
+                s.file_off = s.va
+                s.file_size = max(s.vsize, s.raw_size)
+            else:
+                # the loader rounds PointerToRawData down to 512 and reads at
+                # most the file aligned SizeOfRawData, capped by the virtual size
+                s.file_off = s.raw_ptr & ~0x1FF
+                s.file_size = align_up(s.raw_size + s.raw_ptr - s.file_off, fa)
+                if s.vsize:
+                    s.file_size = min(s.file_size, align_up(s.vsize, sa))
+            s.file_size = max(0, min(s.file_size, len(self.data) - s.file_off))
+            s.mem_size = max(s.vsize, s.file_size)
+        self._starts = [s.va for s in self.sections]
+
+    @property
+    def is_dll(self):
+        return (self.characteristics & FILE_DLL) != 0
+
+    def section_at(self, rva):
+        i = bisect.bisect_right(self._starts, rva) - 1
+        if i >= 0:
+            s = self.sections[i]
+            if rva < s.va + align_up(s.mem_size, self.section_alignment):
+                return s
+        return None
+
+    def rva_to_offset(self, rva):
+        """ File offset of rva, None if rva has no file backing """
+        if rva < self.headers_size:
+            return rva
+        s = self.section_at(rva)
+        if s is None or rva - s.va >= s.file_size:
+            return None
+        return s.file_off + rva - s.va
+
+    def offset_to_rva(self, offset):
+        """ RVA a file offset is mapped at, None if it is not mapped """
+        if offset < self.headers_size:
+            return offset
+        for s in self.sections:
+            if s.file_off <= offset < s.file_off + s.file_size:
+                return s.va + offset - s.file_off
+        return None
+
+    def section_view(self, s):
+        """ memoryview of the file backed part of section s """
+        return self.data[s.file_off:s.file_off + s.file_size]
+
+    def read(self, rva, size):
+        """
+        size bytes at rva, parts without file backing read as zero
+
+        A range that is entirely file backed comes back as a memoryview of the
+        mapping without copying; anything else is assembled into bytes.
+        """
+        off = self.rva_to_offset(rva)
+        if off is not None:
+            s = self.section_at(rva) if rva >= self.headers_size else None
+            end = s.file_off + s.file_size if s is not None else self.headers_size
+            if off + size <= end:
+                return self.data[off:off + size]
+
+        out = bytearray(size)
+        pos = 0
+        while pos < size:
+            cur = rva + pos
+            s = self.section_at(cur)
+            if s is None:
+                if cur < self.headers_size:
+                    n = min(size - pos, self.headers_size - cur)
+                    out[pos:pos + n] = self.data[cur:cur + n]
+                    pos += n
+                    continue
+                # gap up to the next section reads as zero
+                i = bisect.bisect_right(self._starts, cur)
+                if i >= len(self.sections):
+                    break
+                pos = self.sections[i].va - rva
+                continue
+            delta = cur - s.va
+            n = min(size - pos, max(0, s.file_size - delta))
+            if n:
+                out[pos:pos + n] = self.data[s.file_off + delta:s.file_off + delta + n]
+                pos += n
+            else:
+                pos = s.va + align_up(s.mem_size, self.section_alignment) - rva
+        return bytes(out)
+
+    def u16(self, rva):
+        return struct.unpack("<H", self.read(rva, 2))[0]
+
+    def u32(self, rva):
+        return struct.unpack("<I", self.read(rva, 4))[0]
+
+    def ptr(self, rva):
+        return struct.unpack("<Q" if self.is64 else "<I", self.read(rva, self.ptr_size))[0]
+
+    def cstring(self, rva, maxlen=512):
+        buf = bytes(self.read(rva, maxlen))
+        end = buf.find(b"\0")
+        return buf[:end if end >= 0 else maxlen].decode("latin-1")
+
+    def imports(self):
+        """ [(dll, [(iat_rva, name or None, ordinal or None), ...]), ...] """
+        rva, size = self.dirs[DIR_IMPORT]
+        result = []
+        if not rva:
+            return result
+        ordinal_flag = 1 << (63 if self.is64 else 31)
+        desc = rva
+        while True:
+            oft, _, _, name_rva, ft = struct.unpack("<IIIII", self.read(desc, 20))
+            if not (oft or name_rva or ft):
+                break
+            dll = self.cstring(name_rva)
+            entries = []
+            thunk = oft or ft
+            iat = ft
+            while True:
+                val = self.ptr(thunk)
+                if val == 0:
+                    break
+                if val & ordinal_flag:
+                    entries.append((iat, None, val & 0xFFFF))
+                else:
+                    entries.append((iat, self.cstring((val & 0x7FFFFFFF) + 2), None))
+                thunk += self.ptr_size
+                iat += self.ptr_size
+            result.append((dll, entries))
+            desc += 20
+        return result
+
+    def exports(self):
+        """ [(rva, name or None, ordinal), ...] """
+        rva, size = self.dirs[DIR_EXPORT]
+        if not rva:
+            return []
+        _, _, _, _, _, base, nfuncs, nnames, funcs, names, ords = struct.unpack("<IIHHIIIIIII", self.read(rva, 40))
+        func_rvas = struct.unpack("<%dI" % nfuncs, self.read(funcs, 4 * nfuncs)) if nfuncs else ()
+        name_of = {}
+        for i in range(nnames):
+            idx = self.u16(ords + 2 * i)
+            name_of[idx] = self.cstring(self.u32(names + 4 * i))
+        result = []
+        for i, frva in enumerate(func_rvas):
+            # skip forwarders, they point into the export directory
+            if frva and not rva <= frva < rva + size:
+                result.append((frva, name_of.get(i), base + i))
+        return result
+
+    def relocations(self):
+        """ RVAs of the HIGHLOW/DIR64 base relocations """
+        rva, size = self.dirs[DIR_BASERELOC]
+        result = []
+        if not rva:
+            return result
+        blob = self.read(rva, size)
+        pos = 0
+        while pos + 8 <= len(blob):
+            page, block = struct.unpack_from("<II", blob, pos)
+            if block < 8:
+                break
+            count = (block - 8) // 2
+            for w in struct.unpack_from("<%dH" % count, blob, pos + 8):
+                if w >> 12 in (REL_BASED_HIGHLOW, REL_BASED_DIR64):
+                    result.append(page + (w & 0xFFF))
+            pos += block
+        return result
+
+    def runtime_functions(self):
+        """ BeginAddress RVAs of the x64 .pdata RUNTIME_FUNCTION table """
+        rva, size = self.dirs[DIR_EXCEPTION]
+        if not rva or not self.is64:
+            return []
+        blob = self.read(rva, size - size % 12)
+        return [b for b, _, _ in struct.iter_unpack("<III", blob)]
+
+
+class Segment(object):
+    __slots__ = ("start_ea", "end_ea", "name", "executable")
+
+    def __init__(self, start_ea, end_ea, name, executable):
+        self.start_ea = start_ea
+        self.end_ea = end_ea
+        self.name = name
+        self.executable = executable
+
+
+class Func(object):
+    __slots__ = ("start_ea", "end_ea", "flags")
+
+    def __init__(self, start_ea):
+        self.start_ea = start_ea
+        # no function bodies headless, only starts are known
+        self.end_ea = start_ea + 1
+        self.flags = 0
+
+
+Xref = collections.namedtuple("Xref", "frm to type iscode")
+
+# xref types, values of ida_xref
+fl_CN = 17
+fl_JN = 19
+dr_O = 1
+
+
+class EmptyImage(object):
+    """ A PE image without sections or directories, see load_module() """
+    path = "<empty>"
+    is64 = False
+    ptr_size = 4
+    image_base = 0x400000
+    is_dll = False
+    entry_rva = 0
+    sections = ()
+
+    def read(self, rva, size):
+        return b"\x00" * size
+
+    def imports(self):
+        return []
+
+    def exports(self):
+        return []
+
+    def runtime_functions(self):
+        return []
+
+    def relocations(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class HeadlessDB(object):
+    """
+    What AFX_MSGMAP.py reads from an IDB, computed from a PE image.
+
+    Functions are the entry point, exports, .pdata entries, import thunks and
+    code targets of data pointers; only function starts are known. Xrefs come
+    from base relocations (or a pointer scan when .reloc is stripped) and, on
+    x64, from RIP relative lea/mov.
+    """
+    def __init__(self, pe):
+        self.pe = pe
+        self.is64 = pe.is64
+        self.ptr_size = pe.ptr_size
+        self.image_base = pe.image_base
+        self.BADADDR = 0xFFFFFFFFFFFFFFFF if self.is64 else 0xFFFFFFFF
+
+        self.segments = []
+        self._seg_sections = []
+        for s in pe.sections:
+            # the unrounded extent: a section whose tail up to the next page
+            # is file backed maps as one view, see get_bytes
+            start = self.image_base + s.va
+            self.segments.append(Segment(start, start + s.mem_size, s.name, s.executable))
+            self._seg_sections.append(s)
+        self._seg_starts = [s.start_ea for s in self.segments]
+        self.min_ea = self.segments[0].start_ea if self.segments else self.image_base
+        self.max_ea = self.segments[-1].end_ea if self.segments else self.image_base
+
+        self.names = {}
+        self.comments = {}
+        self.funcs = set()
+        self.ops = []               # recorded write side calls: (name, args)
+        self.netnodes = {}          # netnode name -> {(tag, index): blob}
+        self._xrefs = None
+        self._fixups = None
+        self.pointer_slots = set()  # data items holding a pointer, named off_XXX
+
+        self.imports = []           # (iat_ea, name, ordinal) per module
+        for dll, entries in pe.imports():
+            mod = []
+            for iat, name, ordinal in entries:
+                ea = self.image_base + iat
+                mod.append((ea, name, ordinal))
+                self.names[ea] = name if name else "%s_%d" % (dll.split(".")[0], ordinal)
+            self.imports.append((dll, mod))
+
+        self.funcs.add(self.image_base + pe.entry_rva)
+        for rva, name, ordinal in pe.exports():
+            ea = self.image_base + rva
+            seg = self.getseg(ea)
+            if seg is not None and seg.executable:
+                self.funcs.add(ea)
+            if name:
+                self.names[ea] = name
+        self.funcs.update(self.image_base + rva for rva in pe.runtime_functions())
+        self._find_import_thunks()
+        self._build_xrefs()
+
+    # -- memory --------------------------------------------------------------
+
+    def getseg(self, ea):
+        i = bisect.bisect_right(self._seg_starts, ea) - 1
+        if i >= 0 and ea < self.segments[i].end_ea:
+            return self.segments[i]
+        return None
+
+    def is_loaded(self, ea):
+        return self.getseg(ea) is not None
+
+    def get_bytes(self, ea, size):
+        """ memoryview of the mapped file when the range is file backed """
+        if size <= 0 or not self.is_loaded(ea):
+            return None
+        return self.pe.read(ea - self.image_base, size)
+
+    def _unpack(self, fmt, ea, size):
+        if not self.is_loaded(ea):
+            return (1 << (8 * size)) - 1
+        return struct.unpack(fmt, self.pe.read(ea - self.image_base, size))[0]
+
+    def get_wide_byte(self, ea):
+        return self._unpack("<B", ea, 1)
+
+    def get_wide_word(self, ea):
+        return self._unpack("<H", ea, 2)
+
+    def get_wide_dword(self, ea):
+        return self._unpack("<I", ea, 4)
+
+    def get_qword(self, ea):
+        return self._unpack("<Q", ea, 8)
+
+    def get_ptr(self, ea):
+        return self.get_qword(ea) if self.is64 else self.get_wide_dword(ea)
+
+    def fixups(self):
+        """ Sorted eas of the HIGHLOW/DIR64 base relocations, what IDA keeps as fixups """
+        if self._fixups is None:
+            self._fixups = sorted(self.image_base + rva for rva in self.pe.relocations())
+        return self._fixups
+
+    def get_next_fixup_ea(self, ea):
+        fixups = self.fixups()
+        i = bisect.bisect_right(fixups, ea)
+        return fixups[i] if i < len(fixups) else self.BADADDR
+
+    def section_bytes(self, seg):
+        """ File backed bytes of seg, a memoryview; the zero filled rest is left out """
+        i = bisect.bisect_right(self._seg_starts, seg.start_ea) - 1
+        return self.pe.section_view(self._seg_sections[i])
+
+    # -- analysis ------------------------------------------------------------
+
+    def _find_import_thunks(self):
+        """ jmp [__imp_xxx] stubs become functions named j_xxx """
+        iat = {}
+        for dll, entries in self.imports:
+            for ea, name, ordinal in entries:
+                iat[ea] = ea
+        if not iat:
+            return
+        for seg in self.segments:
+            if not seg.executable:
+                continue
+            buf = self.section_bytes(seg)
+            for m in re.finditer(b"\xFF\x25", buf):
+                off = m.start()
+                if off + 6 > len(buf):
+                    break
+                disp = struct.unpack_from("<i" if self.is64 else "<I", buf, off + 2)[0]
+                ea = seg.start_ea + off
+                target = ea + 6 + disp if self.is64 else disp
+                if target in iat:
+                    self.funcs.add(ea)
+                    self.names.setdefault(ea, "j_" + self.names[target])
+
+    def pointer_refs(self):
+        """ (slot_ea, target_ea) of every absolute pointer in the image """
+        relocs = self.pe.relocations()
+        refs = []
+        if relocs:
+            for rva in relocs:
+                slot = self.image_base + rva
+                target = self.get_ptr(slot)
+                if self.min_ea <= target < self.max_ea:
+                    refs.append((slot, target))
+            return refs
+
+        # .reloc stripped: take every in-image value, aligned in data, at any offset in code
+        ps = self.ptr_size
+        fmt = "<Q" if self.is64 else "<I"
+        # match on the high bytes: byte 2 as a class per value of the bytes above it
+        byte2 = collections.defaultdict(set)
+        for h in range(self.min_ea >> 16, ((self.max_ea - 1) >> 16) + 1):
+            byte2[h >> 8].add(h & 0xFF)
+        alts = []
+        for upper, lows in sorted(byte2.items()):
+            cls = b"".join(re.escape(bytes([b])) for b in sorted(lows))
+            alts.append(b"[" + cls + b"]" + re.escape(struct.pack("<Q", upper)[:ps - 3]))
+        pattern = re.compile(b"(?=..(?:" + b"|".join(alts) + b"))", re.S)
+        for seg in self.segments:
+            buf = self.section_bytes(seg)
+            for m in pattern.finditer(buf):
+                off = m.start()
+                if off + ps > len(buf) or (not seg.executable and off % ps):
+                    continue
+                target = struct.unpack_from(fmt, buf, off)[0]
+                if self.min_ea <= target < self.max_ea:
+                    refs.append((seg.start_ea + off, target))
+        return refs
+
+    def _insn_head(self, slot):
+        """ Guess the start of the instruction holding the absolute address at slot """
+        b1 = self.get_wide_byte(slot - 1)
+        if 0xB8 <= b1 <= 0xBF or b1 in (0x68, 0xA1, 0xA3):
+            return slot - 1                     # mov r32, imm32 / push imm32 / mov eax, moffs
+        b2 = self.get_wide_byte(slot - 2)
+        if b2 in (0x8B, 0x89, 0x8D, 0xFF, 0xC7) and (b1 & 0xC7) == 0x05:
+            return slot - 2                     # op r32, [disp32] / call, jmp [disp32]
+        return slot
+
+    def _build_xrefs(self):
+        xrefs = collections.defaultdict(list)
+        for slot, target in self.pointer_refs():
+            seg = self.getseg(slot)
+            if seg is None:
+                continue
+            if seg.executable:
+                frm = self._insn_head(slot)
+                xrefs[target].append(Xref(frm, target, dr_O, False))
+            else:
+                self.pointer_slots.add(slot)
+                xrefs[target].append(Xref(slot, target, dr_O, False))
+                tseg = self.getseg(target)
+                if tseg is not None and tseg.executable:
+                    # code pointed to from data: vtables, message maps, callbacks
+                    self.funcs.add(target)
+
+        if self.is64:
+            # lea/mov r64, [rip+disp32]
+            pattern = re.compile(b"[\x48\x4C][\x8B\x8D][\x05\x0D\x15\x1D\x25\x2D\x35\x3D]", re.S)
+            for seg in self.segments:
+                if not seg.executable:
+                    continue
+                buf = self.section_bytes(seg)
+                for m in pattern.finditer(buf):
+                    off = m.start()
+                    if off + 7 > len(buf):
+                        break
+                    ea = seg.start_ea + off
+                    target = ea + 7 + struct.unpack_from("<i", buf, off + 3)[0]
+                    tseg = self.getseg(target)
+                    if tseg is not None and not tseg.executable:
+                        xrefs[target].append(Xref(ea, target, dr_O, False))
+        self._xrefs = xrefs
+
+    def xrefs_to(self, ea):
+        return self._xrefs.get(ea, [])
+
+    # -- names ---------------------------------------------------------------
+
+    def get_name(self, ea, flags=0):
+        name = self.names.get(ea)
+        if name:
+            return name
+        if ea in self.funcs:
+            return "sub_%X" % ea
+        if ea in self._xrefs:
+            seg = self.getseg(ea)
+            if seg is None:
+                return ""
+            if seg.executable:
+                return "loc_%X" % ea
+            return ("off_%X" if ea in self.pointer_slots else "unk_%X") % ea
+        return ""
+
+    def get_flags(self, ea):
+        # FF_NAME for the names given, FF_LABL for the dummy ones
+        if self.names.get(ea):
+            return 0x4000
+        return 0x8000 if self.get_name(ea) else 0
+
+    def set_name(self, ea, name, flags=0):
+        self.ops.append(("set_name", (ea, name)))
+        if name:
+            self.names[ea] = name
+        else:
+            self.names.pop(ea, None)
+        return True
+
+    def get_func(self, ea):
+        return Func(ea) if ea in self.funcs else None
+
+    def get_func_name(self, ea):
+        return self.get_name(ea) if ea in self.funcs else ""
+
+    def add_func(self, ea, end=None):
+        self.ops.append(("add_func", (ea,)))
+        seg = self.getseg(ea)
+        if seg is None or not seg.executable:
+            return False
+        self.funcs.add(ea)
+        return True
+
+    def set_func_cmt(self, pfn, cmt, repeatable):
+        if pfn is None:
+            return False
+        self.ops.append(("set_func_cmt", (pfn.start_ea, cmt)))
+        self.comments[pfn.start_ea] = cmt
+        return True
+
+    def prev_head(self, ea, minea=0):
+        """ Data items are taken as pointer sized """
+        seg = self.getseg(ea - 1)
+        if seg is None:
+            return self.BADADDR
+        prev = (ea - 1) - (ea - 1 - seg.start_ea) % self.ptr_size
+        return prev if prev >= minea else self.BADADDR
+
+    def print_insn_mnem(self, ea):
+        b = self.get_wide_byte(ea)
+        if self.is64 and b & 0xF0 == 0x40:
+            ea += 1
+            b = self.get_wide_byte(ea)
+        if b in (0xE9, 0xEB):
+            return "jmp"
+        if b == 0xE8:
+            return "call"
+        if b in (0xC3, 0xC2):
+            return "retn"
+        if b == 0xFF:
+            reg = (self.get_wide_byte(ea + 1) >> 3) & 7
+            return {2: "call", 4: "jmp"}.get(reg, "")
+        return ""
+
+    def find_binary(self, ea, flags, pattern):
+        """ Only quoted strings and plain hex byte patterns """
+        pattern = pattern.strip()
+        if pattern.startswith('"') and pattern.endswith('"'):
+            needle = pattern[1:-1].encode("latin-1")
+        else:
+            needle = bytes(int(x, 16) for x in pattern.split())
+        for seg in self.segments:
+            if seg.end_ea <= ea:
+                continue
+            m = re.compile(re.escape(needle)).search(self.section_bytes(seg), max(0, ea - seg.start_ea))
+            if m is not None:
+                return seg.start_ea + m.start()
+        return self.BADADDR
+
+
+# -- module stand-ins ----------------------------------------------------------
+
+class _Choose(object):
+    CHCOL_PLAIN = 0x00000000
+    CHCOL_PATH = 0x00010000
+    CHCOL_HEX = 0x00020000
+    CHCOL_DEC = 0x00030000
+
+    def __init__(self, title, cols, flags=0, width=None, height=None, embedded=False):
+        self.title = title
+        self.cols = cols
+
+    def Show(self, modal=False):
+        return -1
+
+
+class _Stub(object):
+    """ Base for the UI classes subclassed at import time """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def hook(self):
+        return True
+
+    def unhook(self):
+        return True
+
+
+class _Netnode(object):
+    """ Blob part of idaapi.netnode, kept in db.netnodes for the life of the database """
+    def __init__(self, db, name, value=0, do_create=False):
+        self.blobs = db.netnodes.setdefault(name, {})
+
+    def getblob(self, start, tag):
+        return self.blobs.get((tag, start))
+
+    def setblob(self, buf, start, tag):
+        self.blobs[(tag, start)] = bytes(buf)
+        return True
+
+    def delblob(self, start, tag):
+        return 1 if self.blobs.pop((tag, start), None) is not None else 0
+
+
+class _InfStructure(object):
+    class cc(object):
+        id = 0x01   # COMP_MS
+
+
+def _recorder(db, name, ret=None):
+    def record(*args, **kwargs):
+        db.ops.append((name, args))
+        return ret
+    record.__name__ = name
+    return record
+
+
+def _counter(db, name, start):
+    """ Recorder returning a new id per call, for struct and enum creation """
+    ids = [start]
+
+    def record(*args, **kwargs):
+        db.ops.append((name, args))
+        ids[0] += 1
+        return ids[0]
+    record.__name__ = name
+    return record
+
+
+def install(db):
+    """ Put idc/idaapi/... stand-ins bound to db into sys.modules """
+    BADADDR = db.BADADDR
+    consts = dict(
+        BADADDR=BADADDR,
+        __EA64__=db.is64,
+        # bytes.hpp flags
+        FF_DATA=0x400, FF_BYTE=0x0, FF_WORD=0x10000000, FF_DWORD=0x20000000, FF_QWORD=0x30000000,
+        FF_STRUCT=0x60000000, FF_0OFF=0x500000, FF_0ENUM=0x800000, FF_0NUMH=0x100000, FF_REF=0x1000,
+        FF_SIGN=0x20000,
+        REF_OFF32=2, REF_OFF64=9, DELIT_SIMPLE=0, SN_CHECK=0, SN_NOCHECK=1, SN_NOWARN=0x100,
+        FUNCATTR_START=0, FUNCATTR_END=4, FUNCATTR_FLAGS=8,
+        INF_MIN_EA=19, INF_MAX_EA=20, INF_LFLAGS=13, INF_FILETYPE=7,
+        LFLG_64BIT=0x4, LFLG_IS_DLL=0x8,
+        FT_PE=11, FT_COFF=10, FT_OMF=5, FT_ZIP=14, FT_OMFLIB=15, FT_AR=16,
+        COMP_MS=0x01, COMP_MASK=0x0F,
+        SEARCH_DOWN=1, SEARCH_CASE=4,
+        PLFM_386=0,
+        PLUGIN_SKIP=0, PLUGIN_OK=1, PLUGIN_KEEP=2,
+        AST_ENABLE_FOR_WIDGET=1, AST_DISABLE_FOR_WIDGET=3, BWN_DISASM=27, SETMENU_APP=1,
+        GN_VISIBLE=1, STRTYPE_C=0, MAX_MARK_SLOT=1024,
+    )
+
+    lflags = (consts["LFLG_64BIT"] if db.is64 else 0) | (consts["LFLG_IS_DLL"] if db.pe.is_dll else 0)
+    inf = {consts["INF_MIN_EA"]: db.min_ea, consts["INF_MAX_EA"]: db.max_ea,
+           consts["INF_LFLAGS"]: lflags, consts["INF_FILETYPE"]: consts["FT_PE"]}
+
+    def get_segm_start(ea):
+        seg = db.getseg(ea)
+        return seg.start_ea if seg is not None else BADADDR
+
+    def get_segm_end(ea):
+        seg = db.getseg(ea)
+        return seg.end_ea if seg is not None else BADADDR
+
+    def get_func_attr(ea, attr):
+        if ea not in db.funcs:
+            return BADADDR
+        return {consts["FUNCATTR_START"]: ea, consts["FUNCATTR_END"]: ea + 1}.get(attr, 0)
+
+    def enum_import_names(i, cb):
+        for ea, name, ordinal in db.imports[i][1]:
+            if not cb(ea, name, ordinal):
+                return 0
+        return 1
+
+    def demangle_name(name, flags=0):
+        # just enough for vftable and RTTI names: ??_7CFoo@NS@@6B@ -> const NS::CFoo::`vftable'
+        m = re.match(r"^\?\?_(7|R4)(.+?)@@6B", name or "")
+        if not m:
+            return None
+        scope = "::".join(reversed(m.group(2).split("@")))
+        what = "`vftable'" if m.group(1) == "7" else "`RTTI Complete Object Locator'"
+        return "const %s::%s" % (scope, what)
+
+    funcs = dict(
+        get_bytes=db.get_bytes, get_wide_byte=db.get_wide_byte, get_wide_word=db.get_wide_word,
+        get_wide_dword=db.get_wide_dword, get_qword=db.get_qword, is_loaded=db.is_loaded,
+        get_name=db.get_name, set_name=db.set_name, get_flags=db.get_flags,
+        has_user_name=lambda flags: flags & 0xC000 == 0x4000, get_func=db.get_func, get_func_name=db.get_func_name,
+        add_func=db.add_func, set_func_cmt=db.set_func_cmt, prev_head=db.prev_head,
+        print_insn_mnem=db.print_insn_mnem, find_binary=db.find_binary,
+        get_first_fixup_ea=lambda: db.get_next_fixup_ea(-1), get_next_fixup_ea=db.get_next_fixup_ea,
+        get_segm_start=get_segm_start, get_segm_end=get_segm_end, get_func_attr=get_func_attr,
+        get_inf_attr=lambda attr: inf.get(attr, 0),
+        get_imagebase=lambda: db.image_base,
+        get_import_module_qty=lambda: len(db.imports),
+        get_import_module_name=lambda i: db.imports[i][0],
+        enum_import_names=enum_import_names,
+        demangle_name=demangle_name,
+        ph_get_id=lambda: consts["PLFM_386"],
+        get_inf_structure=lambda: _InfStructure,
+        hex_flag=lambda: consts["FF_0NUMH"],
+        atoa=lambda ea: "%X" % ea,
+        get_screen_ea=lambda: BADADDR,
+        jumpto=lambda ea: False,
+        get_bookmark=lambda slot: BADADDR,
+        enable_auto=lambda enable: True,
+        auto_wait=lambda: True,
+        refresh_idaview_anyway=lambda: None,
+        show_wait_box=lambda msg: None,
+        replace_wait_box=lambda msg: None,
+        hide_wait_box=lambda: None,
+        register_action=lambda desc: True,
+        unregister_action=lambda name: True,
+        attach_action_to_menu=lambda *args: True,
+        detach_action_from_menu=lambda *args: True,
+        attach_action_to_popup=lambda *args: True,
+        get_widget_type=lambda widget: None,
+        register_addon=lambda addon: 0,
+        get_struc=lambda sid: None,
+        get_struc_id=lambda name: BADADDR,
+        get_struc_size=lambda sid: 0,
+        get_member_id=lambda sid, ofs: -1,
+        get_enum=lambda name: BADADDR,
+        get_enum_member=lambda eid, value, serial, bmask: -1,
+        Functions=lambda start=None, end=None: iter(sorted(db.funcs)),
+        XrefsTo=lambda ea, flags=0: iter(db.xrefs_to(ea)),
+    )
+    for name in ("create_struct", "create_data", "del_items", "SetType", "add_struc_member", "del_struc_members",
+                 "add_enum_member", "set_enum_member_cmt", "put_bookmark"):
+        funcs[name] = _recorder(db, name, True)
+    funcs["add_struc"] = _counter(db, "add_struc", 0xFF000000)
+    funcs["add_enum"] = _counter(db, "add_enum", 0xFF100000)
+
+    classes = dict(
+        Choose=_Choose,
+        action_handler_t=_Stub,
+        UI_Hooks=_Stub,
+        plugin_t=_Stub,
+        action_desc_t=_Stub,
+        addon_info_t=_Stub,
+        refinfo_t=_Stub,
+        opinfo_t=_Stub,
+        netnode=lambda *args: _Netnode(db, *args),
+    )
+
+    for modname in ("idaapi", "idc", "idautils", "ida_segment", "ida_nalt", "ida_moves", "ida_name",
+                    "ida_bytes", "ida_funcs", "ida_auto", "ida_fixup"):
+        mod = types.ModuleType(modname)
+        mod.__dict__.update(consts)
+        mod.__dict__.update(funcs)
+        mod.__dict__.update(classes)
+        sys.modules[modname] = mod
+
+    seg_mod = sys.modules["ida_segment"]
+    seg_mod.get_segm_qty = lambda: len(db.segments)
+    seg_mod.getnseg = lambda i: db.segments[i] if 0 <= i < len(db.segments) else None
+    seg_mod.getseg = db.getseg
+    seg_mod.get_segm_name = lambda seg, flags=0: seg.name if seg is not None else ""
+    seg_mod.get_segm_class = lambda seg: ("CODE" if seg.executable else "DATA") if seg is not None else ""
+
+
+def load_plugin(db):
+    """ (Re)import AFX_MSGMAP against db, module level constants like IS64 follow the binary """
+    install(db)
+    here = os.path.dirname(os.path.abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
+    sys.modules.pop("AFX_MSGMAP", None)
+    return importlib.import_module("AFX_MSGMAP")
+
+
+def load_module():
+    """ AFX_MSGMAP imported against an empty database, for tools that only need its tables """
+    return load_plugin(HeadlessDB(EmptyImage()))
+
+
+def open_binary(path):
+    """ AFXStructs scanning the PE file at path, its HeadlessDB is afx.db """
+    db = HeadlessDB(PEImage(path))
+    module = load_plugin(db)
+    afx = module.AFXStructs()
+    afx.db = db
+    return afx
+
+
+def check_export(path):
+    """ (handler EA, exported name, IDB name) of every exported handler named otherwise after the scan """
+    idc = sys.modules["idc"]
+    mismatches = []
+    with open(path) as f:
+        for line in f:
+            for entry in json.loads(line)["entries"]:
+                for key in ("handler", "pfn_name", "pfnSet_name"):
+                    if key not in entry:
+                        continue
+                    ea = entry["pfn"] if key != "pfnSet_name" else entry["pfnSet"]
+                    if entry[key] != idc.get_name(ea):
+                        mismatches.append((ea, entry[key], idc.get_name(ea)))
+    return mismatches
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("usage: %s <pe file> [maps.jsonl]" % argv[0])
+        return 2
+    afx = open_binary(argv[1])
+    # with an export file the maps are written there and not kept for the listing
+    export = argv[2] if len(argv) > 2 else None
+    for index, ea, name, count, kind in afx.Search_MSGMAP(export=export):
+        print("%4d  %X  %-40s %-20s %d" % (index, ea, name, kind, count))
+    if export:
+        mismatches = check_export(export)
+        for ea, exported, name in mismatches:
+            print("handler %X exported as %s, named %s" % (ea, exported, name))
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,92 @@
+# Build a known-IID table for AFX_MSGMAP.py
+#
+# AFX_MSGMAP.py names the GUIDs of interface, connection and OLE command maps
+# from its built-in KNOWN_IIDS and from AFX_MSGMAP_iids.bin next to it. This
+# writes that file from text files with one GUID per line, either
+#
+#     00000000-0000-0000-C000-000000000046 IID_IUnknown
+#     {00000000-0000-0000-C000-000000000046} IID_IUnknown
+#
+# or from the DEFINE_GUID lines of SDK headers and uuid sources. A later input
+# wins for a duplicate GUID.
+#
+# Usage:
+#     python afx_iids.py [-o AFX_MSGMAP_iids.bin] <text or header> ...
+#     python afx_iids.py -d AFX_MSGMAP_iids.bin
+
+# pylint: disable=C0301,C0103,C0111
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import uuid
+import struct
+import argparse
+
+import afx_headless
+
+# the table format is AFX_MSGMAP.IIDTable, read back with IIDIndex.read_table
+AFX_MSGMAP = afx_headless.load_module()
+
+_guid_line = re.compile(r"^\s*\{?([0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12})\}?\s+(\w+)")
+_define_guid = re.compile(r"DEFINE_GUID\s*\(\s*(\w+)\s*,((?:\s*0x[0-9A-Fa-f]+\s*,?){11})\)")
+_hex = re.compile(r"0x[0-9A-Fa-f]+")
+
+
+def parse_file(path):
+    """ Yield (guid bytes, name) of every GUID defined in path """
+    with open(path, "rb") as f:
+        text = f.read().decode("latin-1")
+    for line in text.splitlines():
+        m = _guid_line.match(line)
+        if m:
+            yield uuid.UUID(m.group(1)).bytes_le, m.group(2)
+    for m in _define_guid.finditer(text):
+        v = [int(x, 16) for x in _hex.findall(m.group(2))]
+        yield struct.pack("<IHH8B", *v), m.group(1)
+
+
+def write_table(path, items):
+    """ Write (guid bytes, name) items as an IIDTable, return the number of GUIDs """
+    names = dict(items)
+    guids = sorted(names)
+    blob = bytearray()
+    offsets = []
+    for guid in guids:
+        offsets.append(len(blob))
+        blob += names[guid].encode("latin-1") + b"\x00"
+    with open(path, "wb") as f:
+        f.write(AFX_MSGMAP.IIDTable.HEADER.pack(AFX_MSGMAP.IIDTable.MAGIC, len(guids)))
+        f.write(b"".join(guids))
+        f.write(struct.pack("<%dI" % len(guids), *offsets))
+        f.write(bytes(blob))
+    return len(guids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the known-IID table of AFX_MSGMAP.py")
+    parser.add_argument("inputs", nargs="*", help="GUID lists or headers with DEFINE_GUID")
+    parser.add_argument("-o", "--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "AFX_MSGMAP_iids.bin"),
+                        help="table to write (default: AFX_MSGMAP_iids.bin next to this script)")
+    parser.add_argument("-d", "--dump", metavar="TABLE", help="list the GUIDs of a table instead")
+    args = parser.parse_args(argv)
+
+    if args.dump:
+        for guid, name in AFX_MSGMAP.IIDIndex.read_table(args.dump):
+            print("%s %s" % (str(uuid.UUID(bytes_le=guid)).upper(), name))
+        return 0
+    if not args.inputs:
+        parser.error("no input files")
+
+    items = []
+    for path in args.inputs:
+        items.extend(parse_file(path))
+    count = write_table(args.output, items)
+    print("%d GUIDs written to %s" % (count, args.output), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+# SQLite store of afx_batch.py results, for queries across a corpus of binaries
+#
+# Every afx_batch record becomes one row in binaries plus its classes, maps,
+# entries and handlers, written in a single transaction per binary. A path
+# stored again replaces its previous rows.
+#
+#     binaries  (id, path, status, arch, image_base, seconds, error)
+#     classes   (binary_id, addr, name, base_addr, base_name, object_size, schema, create_object)
+#     maps      (binary_id, addr, type, name, class_name, base_map, entry_count)
+#     entries   (binary_id, map_addr, seq, message, nMessage, nCode, nID, nLastID, nSig, pfn, fields)
+#     handlers  (binary_id, pfn, name, entry_count)
+#
+# entries.fields holds the raw entry of the non AFX_MSGMAP tables as JSON.
+# Which samples handle WM_COPYDATA, which derive from the same base class:
+#
+#     SELECT DISTINCT b.path FROM entries e JOIN binaries b ON b.id = e.binary_id WHERE e.nMessage = 0x4A;
+#     SELECT base_name, COUNT(DISTINCT binary_id) FROM classes GROUP BY base_name ORDER BY 2 DESC;
+#
+# Usage:
+#     python afx_batch.py -s corpus.db samples/         # store while scanning
+#     python afx_store.py corpus.db results.jsonl ...   # load afx_batch output afterwards
+
+# pylint: disable=C0301,C0103,C0111
+
+from __future__ import print_function
+
+import sys
+import json
+import sqlite3
+import argparse
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS binaries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL,
+    arch TEXT,
+    image_base INTEGER,
+    seconds REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS classes (
+    binary_id INTEGER NOT NULL REFERENCES binaries(id),
+    addr INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    base_addr INTEGER,
+    base_name TEXT,
+    object_size INTEGER,
+    schema INTEGER,
+    create_object INTEGER,
+    PRIMARY KEY (binary_id, addr)
+);
+CREATE TABLE IF NOT EXISTS maps (
+    binary_id INTEGER NOT NULL REFERENCES binaries(id),
+    addr INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    name TEXT,
+    class_name TEXT,
+    base_map INTEGER,
+    entry_count INTEGER NOT NULL,
+    PRIMARY KEY (binary_id, addr)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    binary_id INTEGER NOT NULL REFERENCES binaries(id),
+    map_addr INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT,
+    nMessage INTEGER,
+    nCode INTEGER,
+    nID INTEGER,
+    nLastID INTEGER,
+    nSig INTEGER,
+    pfn INTEGER,
+    fields TEXT,
+    PRIMARY KEY (binary_id, map_addr, seq)
+);
+CREATE TABLE IF NOT EXISTS handlers (
+    binary_id INTEGER NOT NULL REFERENCES binaries(id),
+    pfn INTEGER NOT NULL,
+    name TEXT,
+    entry_count INTEGER NOT NULL,
+    PRIMARY KEY (binary_id, pfn)
+);
+CREATE INDEX IF NOT EXISTS classes_name ON classes(name);
+CREATE INDEX IF NOT EXISTS classes_base_name ON classes(base_name);
+CREATE INDEX IF NOT EXISTS maps_class_name ON maps(class_name);
+CREATE INDEX IF NOT EXISTS maps_type ON maps(type);
+CREATE INDEX IF NOT EXISTS entries_message ON entries(nMessage, nCode);
+CREATE INDEX IF NOT EXISTS entries_id ON entries(nID, nLastID);
+CREATE INDEX IF NOT EXISTS entries_pfn ON entries(binary_id, pfn);
+CREATE INDEX IF NOT EXISTS handlers_name ON handlers(name);
+"""
+
+# child tables of binaries, emptied before a path is stored again
+CHILD_TABLES = ("classes", "maps", "entries", "handlers")
+
+
+def map_class_name(kind, name):
+    """ Class part of a map named <class>_MSGMAP or <class>_<kind>MAP by the scanner, None otherwise """
+    suffix = "_MSGMAP" if kind == "MSGMAP" else "_%sMAP" % kind
+    if name and name.endswith(suffix) and len(name) > len(suffix):
+        return name[:-len(suffix)]
+    return None
+
+
+class ResultStore(object):
+    """ SQLite database of afx_batch records, see the schema above """
+    def __init__(self, path):
+        self.path = path
+        # transactions are opened explicitly, one per binary
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, record):
+        """ Store one afx_batch record, replacing what path had; return the binary id """
+        cur = self.db.cursor()
+        cur.execute("BEGIN")
+        try:
+            binary_id = self._add_binary(cur, record)
+            if record.get("status") == "ok":
+                self._add_results(cur, binary_id, record)
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        return binary_id
+
+    @staticmethod
+    def _add_binary(cur, record):
+        row = (record.get("status"), record.get("arch"), record.get("image_base"), record.get("seconds"), record.get("error"))
+        found = cur.execute("SELECT id FROM binaries WHERE path = ?", (record["path"],)).fetchone()
+        if found is None:
+            cur.execute("INSERT INTO binaries (status, arch, image_base, seconds, error, path) VALUES (?, ?, ?, ?, ?, ?)",
+                        row + (record["path"],))
+            return cur.lastrowid
+        binary_id = found[0]
+        cur.execute("UPDATE binaries SET status = ?, arch = ?, image_base = ?, seconds = ?, error = ? WHERE id = ?",
+                    row + (binary_id,))
+        for table in CHILD_TABLES:
+            cur.execute("DELETE FROM %s WHERE binary_id = ?" % table, (binary_id,))
+        return binary_id
+
+    @staticmethod
+    def _add_results(cur, binary_id, record):
+        classes = record.get("runtime_classes", [])
+        class_names = {c["addr"]: c["name"] for c in classes}
+        cur.executemany("INSERT OR REPLACE INTO classes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+            (binary_id, c["addr"], c["name"], c["pBaseClass"] or None, c.get("base_name") or class_names.get(c["pBaseClass"]),
+             c["nObjectSize"], c["wSchema"], c["pfnCreateObject"] or None)
+            for c in classes])
+
+        maps = []
+        entries = []
+        handlers = {}               # pfn -> [name, entry count]
+
+        def handler(pfn, name):
+            if not pfn:
+                return
+            h = handlers.get(pfn)
+            if h is None:
+                handlers[pfn] = [name, 1]
+            else:
+                h[0] = h[0] or name
+                h[1] += 1
+
+        for m in record.get("msgmaps", []):
+            maps.append((binary_id, m["addr"], "MSGMAP", m["name"], map_class_name("MSGMAP", m["name"]),
+                         m["base_map"], len(m["entries"])))
+            for seq, e in enumerate(m["entries"]):
+                entries.append((binary_id, m["addr"], seq, e["message"], e["nMessage"], e["nCode"],
+                                e["nID"], e["nLastID"], e["nSig"], e["pfn"], None))
+                handler(e["pfn"], e.get("handler"))
+        for m in record.get("maps", []):
+            maps.append((binary_id, m["addr"], m["type"], m["name"], map_class_name(m["type"], m["name"]),
+                         m["base_map"], len(m["entries"])))
+            for seq, e in enumerate(m["entries"]):
+                fields = {k: v for k, v in e.items() if not k.endswith("_name")}
+                entries.append((binary_id, m["addr"], seq, None, None, None,
+                                None, None, None, e.get("pfn") or None, json.dumps(fields)))
+                for key in ("pfn", "pfnSet"):
+                    handler(e.get(key), e.get(key + "_name"))
+
+        cur.executemany("INSERT OR REPLACE INTO maps VALUES (?, ?, ?, ?, ?, ?, ?)", maps)
+        cur.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+        cur.executemany("INSERT INTO handlers VALUES (?, ?, ?, ?)",
+                        [(binary_id, pfn, name, count) for pfn, (name, count) in handlers.items()])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load afx_batch.py JSON Lines output into a SQLite database")
+    parser.add_argument("database", help="SQLite file, created when missing")
+    parser.add_argument("inputs", nargs="+", help="afx_batch.py output files, - for stdin")
+    args = parser.parse_args(argv)
+
+    count = 0
+    with ResultStore(args.database) as store:
+        for path in args.inputs:
+            f = sys.stdin if path == "-" else open(path)
+            try:
+                for line in f:
+                    if line.strip():
+                        store.add(json.loads(line))
+                        count += 1
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+    print("%d binaries stored in %s" % (count, args.database), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
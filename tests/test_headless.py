@@ -0,0 +1,261 @@
+# Scan small synthetic PE files with afx_headless, run with python -m pytest
+#
+# The sample holds CWnd and CMyWnd AFX_MSGMAPs reached through their
+# GetThisMessageMap getters, their vtables (exported as ??_7CWnd@@6B@...) and
+# the CRuntimeClass chain CObject <- CCmdTarget <- CWnd <- CMyWnd, linked
+# through _GetBaseClass getters. loop=True adds CLoopA <-> CLoopB and CLeaf
+# derived from CLoopA, static=True gives CMyWnd the pre MFC 7 static pBaseMap.
+
+# pylint: disable=C0301,C0103,C0111
+
+import os
+import sys
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import afx_headless
+
+
+class PEBuilder(object):
+    """ .text and .rdata made of labels, bytes and pointers, an export directory naming labels """
+    def __init__(self, is64):
+        self.is64 = is64
+        self.ptrSize = 8 if is64 else 4
+        self.image_base = 0x140000000 if is64 else 0x400000
+        self.items = {".text": [], ".rdata": []}
+        self.exports = []           # (label, name)
+
+    def label(self, sec, name):
+        self.items[sec].append(("label", name))
+
+    def raw(self, sec, data):
+        self.items[sec].append(("bytes", data))
+
+    def u32(self, sec, value):
+        self.raw(sec, struct.pack("<I", value))
+
+    def ptr(self, sec, target):
+        """ Pointer to a label, or a number """
+        self.items[sec].append(("ptr", target))
+
+    def align(self, sec):
+        self.items[sec].append(("align", self.ptrSize))
+
+    def func(self, name, body=b"\x55\x8b\xec\x5d\xc3"):
+        self.label(".text", name)
+        self.raw(".text", body + b"\xcc" * 3)
+
+    def getter(self, name, target):
+        """ mov eax, offset target; ret / lea rax, [rip+target]; ret """
+        self.label(".text", name)
+        self.items[".text"].append(("getter", target))
+        self.raw(".text", b"\xcc" * 3)
+
+    def _size(self, kind, value, off):
+        if kind == "label":
+            return 0
+        if kind == "bytes":
+            return len(value)
+        if kind == "ptr":
+            return self.ptrSize
+        if kind == "getter":
+            return 8 if self.is64 else 6
+        return -off % value
+
+    def build(self, path):
+        """ Write the PE to path, return the address of every label """
+        labels = {}
+        rvas = {}
+        rva = 0x1000
+        for sec in (".text", ".rdata"):
+            rvas[sec] = rva
+            off = 0
+            for kind, value in self.items[sec]:
+                if kind == "label":
+                    labels[value] = self.image_base + rva + off
+                off += self._size(kind, value, off)
+            rva += (off + 0xFFF) & ~0xFFF
+        edata_rva = rva
+
+        blobs = {}
+        for sec in (".text", ".rdata"):
+            out = bytearray()
+            for kind, value in self.items[sec]:
+                ea = self.image_base + rvas[sec] + len(out)
+                if kind == "bytes":
+                    out += value
+                elif kind == "ptr":
+                    out += struct.pack("<Q" if self.is64 else "<I", labels.get(value, value))
+                elif kind == "getter" and self.is64:
+                    out += b"\x48\x8d\x05" + struct.pack("<i", labels[value] - (ea + 7)) + b"\xc3"
+                elif kind == "getter":
+                    out += b"\xb8" + struct.pack("<I", labels[value]) + b"\xc3"
+                elif kind == "align":
+                    out += b"\0" * self._size(kind, value, len(out))
+            blobs[sec] = bytes(out)
+
+        # export directory: functions, names and ordinals, then the strings
+        names = sorted(self.exports, key=lambda e: e[1])
+        count = len(names)
+        strings = bytearray(b"sample.exe\0")
+        name_rvas = []
+        for _, name in names:
+            name_rvas.append(edata_rva + 40 + 10 * count + len(strings))
+            strings += name.encode() + b"\0"
+        edata = bytearray(struct.pack("<IIHHIIIIIII", 0, 0, 0, 0, edata_rva + 40 + 10 * count, 1, count, count,
+                                      edata_rva + 40, edata_rva + 40 + 4 * count, edata_rva + 40 + 8 * count))
+        for label, _ in names:
+            edata += struct.pack("<I", labels[label] - self.image_base)
+        for name_rva in name_rvas:
+            edata += struct.pack("<I", name_rva)
+        for i in range(count):
+            edata += struct.pack("<H", i)
+        edata += strings
+        sections = [(".text", rvas[".text"], blobs[".text"], 0x60000020),
+                    (".rdata", rvas[".rdata"], blobs[".rdata"], 0x40000040),
+                    (".edata", edata_rva, bytes(edata), 0x40000040)]
+
+        opt_size = 240 if self.is64 else 224
+        hdr = bytearray(0x400)
+        hdr[0:2] = b"MZ"
+        struct.pack_into("<I", hdr, 0x3C, 0x80)
+        hdr[0x80:0x84] = b"PE\0\0"
+        struct.pack_into("<HHIIIHH", hdr, 0x84, 0x8664 if self.is64 else 0x14C, len(sections), 0, 0, 0, opt_size, 0x2102)
+        opt = 0x98
+        struct.pack_into("<HxxxxxxxxxxxxxxI", hdr, opt, 0x20B if self.is64 else 0x10B, rvas[".text"])
+        if self.is64:
+            struct.pack_into("<Q", hdr, opt + 24, self.image_base)
+        else:
+            struct.pack_into("<I", hdr, opt + 28, self.image_base)
+        struct.pack_into("<II", hdr, opt + 32, 0x1000, 0x200)
+        struct.pack_into("<II", hdr, opt + 56, edata_rva + 0x1000, 0x400)
+        dirs = opt + (108 if self.is64 else 92)
+        struct.pack_into("<III", hdr, dirs, 16, edata_rva, len(edata))
+
+        body = bytearray()
+        for i, (name, rva, data, characteristics) in enumerate(sections):
+            raw_size = (len(data) + 0x1FF) & ~0x1FF
+            struct.pack_into("<8sIIIIIIHHI", hdr, opt + opt_size + 40 * i, name.encode(), len(data), rva, raw_size,
+                             0x400 + len(body), 0, 0, 0, 0, characteristics)
+            body += data + b"\0" * (raw_size - len(data))
+        with open(path, "wb") as f:
+            f.write(bytes(hdr) + bytes(body))
+        return labels
+
+
+# (class, base class), CObject is the root
+CLASSES = [("CObject", None), ("CCmdTarget", "CObject"), ("CWnd", "CCmdTarget"), ("CMyWnd", "CWnd")]
+LOOP_CLASSES = [("CLoopA", "CLoopB"), ("CLoopB", "CLoopA"), ("CLeaf", "CLoopA")]
+
+# (nMessage, nCode, nID, nLastID, nSig, handler) of each map
+CWND_ENTRIES = [(0x1, 0, 0, 0, 0x13, "OnWndCreate"), (0x111, 0, 100, 100, 0x30, "OnCmd100")]
+CMYWND_ENTRIES = [(0x1, 0, 0, 0, 0x13, "OnCreate"), (0xF, 0, 0, 0, 0x14, "OnPaint"),
+                  (0x111, 0, 200, 210, 0x32, "OnCmdRange"), (0x4E, 5, 300, 300, 0x36, "OnNotify")]
+
+
+def build_sample(path, is64, static=False, loop=False):
+    p = PEBuilder(is64)
+    p.func("CCmdTarget_GetThisMessageMap", b"\x31\xc0\xc3")
+    p.getter("CWnd_GetThisMessageMap", "CWnd_msgmap")
+    p.getter("CMyWnd_GetThisMessageMap", "CMyWnd_msgmap")
+    for handler in sorted(set(e[5] for e in CWND_ENTRIES + CMYWND_ENTRIES)):
+        p.func(handler)
+
+    for name in ("CWnd", "CMyWnd"):
+        p.align(".rdata")
+        p.ptr(".rdata", 0)
+        p.label(".rdata", name + "_vftable")
+        p.ptr(".rdata", "OnPaint")
+        p.ptr(".rdata", name + "_GetThisMessageMap")
+        p.exports.append((name + "_vftable", "??_7%s@@6B@" % name))
+
+    for name, base, entries in (("CWnd", "CCmdTarget_GetThisMessageMap", CWND_ENTRIES),
+                                ("CMyWnd", "CWnd_msgmap" if static else "CWnd_GetThisMessageMap", CMYWND_ENTRIES)):
+        p.align(".rdata")
+        p.label(".rdata", name + "_msgmap")
+        p.ptr(".rdata", base)
+        p.ptr(".rdata", name + "_entries")
+        p.label(".rdata", name + "_entries")
+        for nMessage, nCode, nID, nLastID, nSig, handler in entries + [(0, 0, 0, 0, 0, 0)]:
+            for value in (nMessage, nCode, nID, nLastID):
+                p.u32(".rdata", value)
+            p.ptr(".rdata", nSig)
+            p.ptr(".rdata", handler)
+
+    classes = CLASSES + (LOOP_CLASSES if loop else [])
+    for name, base in classes:
+        p.func("CreateObject_" + name)
+        if base is not None:
+            p.getter("GetBaseClass_" + name, "classOf_" + base)
+        p.label(".rdata", "name_" + name)
+        p.raw(".rdata", name.encode() + b"\0")
+    for name, base in classes:
+        # m_lpszClassName, m_nObjectSize, m_wSchema, m_pfnCreateObject, m_pfnGetBaseClass, m_pNextClass, m_pClassInit
+        p.align(".rdata")
+        p.label(".rdata", "classOf_" + name)
+        p.ptr(".rdata", "name_" + name)
+        p.u32(".rdata", 0x40 + len(name))
+        p.u32(".rdata", 0xFFFF)
+        p.ptr(".rdata", "CreateObject_" + name if name != "CObject" else 0)
+        p.ptr(".rdata", "GetBaseClass_" + name if base is not None else 0)
+        p.ptr(".rdata", 0)
+        p.ptr(".rdata", 0)
+    return p.build(str(path))
+
+
+@pytest.mark.parametrize("is64", [False, True])
+@pytest.mark.parametrize("static", [False, True])
+def test_search_msgmap(tmp_path, is64, static):
+    labels = build_sample(tmp_path / "sample.exe", is64, static=static)
+    afx = afx_headless.open_binary(str(tmp_path / "sample.exe"))
+    values = afx.Search_MSGMAP()
+
+    assert sorted(v[1] for v in values) == sorted([labels["CWnd_msgmap"], labels["CMyWnd_msgmap"]])
+    maps = {m.addr: m for m in afx.msgmaps}
+    for name, entries in (("CWnd", CWND_ENTRIES), ("CMyWnd", CMYWND_ENTRIES)):
+        m = maps[labels[name + "_msgmap"]]
+        assert m.lpEntries == labels[name + "_entries"]
+        assert [tuple(e) for e in m.entries] == [e[:5] + (labels[e[5]],) for e in entries]
+    assert maps[labels["CMyWnd_msgmap"]].name == "CMyWnd_MSGMAP"
+    assert afx.db.get_name(labels["CMyWnd_GetThisMessageMap"]) == "GetMessage_CMyWnd"
+    assert afx.db.get_name(labels["OnCmdRange"]) == "On_WM_COMMAND_%X_200_to_210" % labels["OnCmdRange"]
+
+    # CMyWnd inherits the WM_COMMAND 100 handler of CWnd
+    graph = afx.get_msgmap_graph()
+    assert graph.chain(labels["CMyWnd_msgmap"]) == [labels["CMyWnd_msgmap"], labels["CWnd_msgmap"]]
+    hit = afx.Find_Message_Entry(labels["CMyWnd_msgmap"], 0x111, 0, 100)
+    assert hit.pfn == labels["OnCmd100"] and hit.map_addr == labels["CWnd_msgmap"]
+    assert afx.Find_Message_Entry("CMyWnd", 0x4E, 5, 300).pfn == labels["OnNotify"]
+
+
+@pytest.mark.parametrize("is64", [False, True])
+def test_search_runtime_class(tmp_path, is64):
+    labels = build_sample(tmp_path / "sample.exe", is64)
+    afx = afx_headless.open_binary(str(tmp_path / "sample.exe"))
+    values = afx.Search_CRuntimeClass()
+
+    assert [(v[1], v[2], v[3]) for v in values] == [(labels["classOf_" + name], name, base or "") for name, base in CLASSES]
+    assert afx.class_graph.get_ancestors(labels["classOf_CMyWnd"]) == ("CWnd", "CCmdTarget", "CObject")
+
+    # x86 static members are __stdcall, x64 pointers __ptr64
+    if is64:
+        create, get_base = "?CreateObject@CMyWnd@@SAPEAVCObject@@XZ", "?_GetBaseClass@CMyWnd@@KAPEAUCRuntimeClass@@XZ"
+    else:
+        create, get_base = "?CreateObject@CMyWnd@@SGPAVCObject@@XZ", "?_GetBaseClass@CMyWnd@@KGPAUCRuntimeClass@@XZ"
+    assert afx.db.get_name(labels["CreateObject_CMyWnd"]) == create
+    assert afx.db.get_name(labels["GetBaseClass_CMyWnd"]) == get_base
+
+
+def test_runtime_class_loop(tmp_path):
+    labels = build_sample(tmp_path / "sample.exe", False, loop=True)
+    afx = afx_headless.open_binary(str(tmp_path / "sample.exe"))
+    values = afx.Search_CRuntimeClass()
+
+    # the classes on the loop and the one leading into it never reach CObject
+    assert [v[2] for v in values] == [name for name, _ in CLASSES]
+    assert afx.class_graph.cycles >= set(labels["classOf_" + name] for name, _ in LOOP_CLASSES)
+    for name, _ in LOOP_CLASSES:
+        assert afx.db.get_name(labels["GetBaseClass_" + name]).startswith("sub_")